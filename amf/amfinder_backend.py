@@ -0,0 +1,318 @@
+# AMFinder - amfinder_backend.py
+#
+# MIT License
+# Copyright (c) 2021 Edouard Evangelisti, Carl Turner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+
+"""
+Inference backends.
+
+Converts trained networks into TensorFlow Lite models for CPU-only
+prediction, either as float32 models (run with XNNPACK), or with dynamic
+range or full integer (int8) quantisation. Converted models are cached in
+the folder containing trained networks, and are checked against the
+original network on a calibration set of tiles when they are created.
+
+Constants
+-----------
+BACKENDS - Available inference backends.
+
+Class
+------------
+:class TFLiteModel: Runs predictions with a TensorFlow Lite model.
+
+Functions
+------------
+:function artifact_path: Returns the path to the converted model.
+:function calibration_tiles: Samples tiles from input images.
+:function convert: Converts a Keras model to TensorFlow Lite.
+:function check_drift: Compares converted and original predictions.
+:function export: Converts the current network, unless already cached.
+:function load: Loads the current network with the selected backend.
+"""
+
+import os
+import json
+import threading
+import numpy as np
+import tensorflow as tf
+
+import amfinder_log as AmfLog
+import amfinder_model as AmfModel
+import amfinder_cache as AmfCache
+import amfinder_config as AmfConfig
+import amfinder_segmentation as AmfSegm
+
+
+
+BACKENDS = ['keras', 'tflite', 'tflite-dynamic', 'tflite-int8']
+
+
+
+class TFLiteModel:
+    """
+    Runs predictions with a TensorFlow Lite model. The <predict> method
+    mimics the Keras one, so that both can be used interchangeably.
+    """
+
+    def __init__(self, path, threads=None):
+        """
+        :param path: Path to the TensorFlow Lite model.
+        :param threads: Number of threads (defaults to all cores).
+        """
+
+        with open(f'{path}.json') as f:
+
+            meta = json.load(f)
+
+        self.name = meta['name']
+        self.input_name = meta['input']
+        self.output_names = meta['outputs']
+        self.interpreter = tf.lite.Interpreter(model_path=path,
+                                               num_threads=threads)
+        self.runner = self.interpreter.get_signature_runner()
+
+
+    def predict(self, x, batch_size=32, verbose=0):
+
+        results = []
+
+        for i in range(0, len(x), batch_size):
+
+            batch = np.asarray(x[i:i + batch_size], dtype=np.float32)
+            out = self.runner(**{self.input_name: batch})
+            results.append([out[name] for name in self.output_names])
+
+        outputs = [np.concatenate(y) for y in zip(*results)]
+
+        return outputs[0] if len(outputs) == 1 else outputs
+
+
+
+def artifact_path(backend):
+    """
+    Returns the path to the TensorFlow Lite version of the current network.
+    The file name includes a digest of the network, so that retrained
+    networks are converted again.
+
+    :param backend: Inference backend (see BACKENDS).
+    :return: Path to the converted model.
+    :rtype: str
+    """
+
+    path = AmfConfig.get('model')
+    st = os.stat(path)
+    digest = AmfCache.content_hash(os.path.abspath(path), st.st_mtime_ns,
+                                   st.st_size)
+    base = os.path.splitext(path)[0]
+
+    return f'{base}-{digest[:12]}-{backend}.tflite'
+
+
+
+def calibration_tiles(paths, count=256):
+    """
+    Samples tiles evenly from input images, to calibrate int8 quantisation
+    and measure the accuracy drift of converted models.
+
+    :param paths: Input images.
+    :param count: Maximum number of tiles.
+    :return: Normalised tiles.
+    :rtype: numpy.ndarray
+    """
+
+    tiles = []
+
+    for path in paths:
+
+        edge = AmfConfig.update_tile_edge(path)
+        image = AmfSegm.load(path, access='sequential', edge=edge)
+        nrows, ncols = AmfSegm.grid_size(image, edge)
+        step = max(1, nrows * ncols // count)
+
+        for r, strip in AmfSegm.strips(image, edge=edge):
+
+            # Tiles whose index is a multiple of <step>.
+            first = -(r * ncols) % step
+            tiles.extend(np.array(strip[first::step, ..., :3]))
+
+        if len(tiles) >= count:
+
+            break
+
+    return AmfSegm.preprocess(tiles[:count])
+
+
+
+def convert(model, backend, tiles):
+    """
+    Converts a Keras model to TensorFlow Lite.
+
+    :param model: Keras model.
+    :param backend: Inference backend (see BACKENDS).
+    :param tiles: Calibration tiles (used by int8 quantisation).
+    :return: Converted model.
+    :rtype: bytes
+    """
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+
+    if backend == 'tflite-dynamic':
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    elif backend == 'tflite-int8':
+
+        def representative_dataset():
+            for x in tiles:
+                yield [x[np.newaxis]]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = \
+            [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    return converter.convert()
+
+
+
+def check_drift(model, converted, tiles, tolerance=0.99):
+    """
+    Compares the predictions of a converted model with the original ones.
+    Reports the largest difference between probabilities and the fraction
+    of tiles assigned to the same class(es).
+
+    :param model: Keras model.
+    :param converted: Converted model.
+    :param tiles: Calibration tiles.
+    :param tolerance: Minimum acceptable agreement.
+    :return: Largest difference and agreement.
+    :rtype: dict
+    """
+
+    bs = AmfConfig.get('batch_size')
+    expected = model.predict(tiles, batch_size=bs, verbose=0)
+    observed = converted.predict(tiles, batch_size=bs)
+
+    if AmfConfig.get('level') == 1:
+
+        diff = np.abs(expected - observed).max()
+        agreement = np.mean(expected.argmax(-1) == observed.argmax(-1))
+
+    else:
+
+        expected = np.hstack(expected)
+        observed = np.hstack(observed)
+        diff = np.abs(expected - observed).max()
+        agreement = np.mean(np.all((expected > 0.5) == (observed > 0.5),
+                                   axis=-1))
+
+    AmfLog.info(f'Drift on {len(tiles)} tiles: max. difference {diff:.4f}, '
+                f'agreement {100 * agreement:.1f}%', indent=1)
+
+    if agreement < tolerance:
+
+        AmfLog.warning(f'Converted network disagrees with the original one '
+                       f'on {100 * (1 - agreement):.1f}% of tiles')
+
+    return {'tiles': len(tiles), 'max_diff': float(diff),
+            'agreement': float(agreement)}
+
+
+
+def export(input_images):
+    """
+    Converts the current network for the selected backend, unless it has
+    already been converted. The converted model is written to a temporary
+    file which is then renamed, so that other processes never read
+    incomplete files.
+
+    :param input_images: Input images (used to sample calibration tiles).
+    :return: Path to the converted model.
+    :rtype: str
+    """
+
+    backend = AmfConfig.get('backend')
+    target = artifact_path(backend)
+
+    if os.path.isfile(target):
+
+        return target
+
+    AmfLog.text(f'Converting network ({backend})')
+
+    model = AmfModel.load()
+    tiles = calibration_tiles(input_images)
+    data = convert(model, backend, tiles)
+
+    tmp = f'{target}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+    with open(tmp, 'wb') as f:
+
+        f.write(data)
+
+    meta = {'name': model.name,
+            'input': model.input_names[0],
+            'outputs': model.output_names}
+
+    with open(f'{tmp}.json', 'w') as f:
+
+        json.dump(meta, f)
+
+    if len(tiles) > 0:
+
+        meta['drift'] = check_drift(model, TFLiteModel(tmp), tiles)
+
+        with open(f'{tmp}.json', 'w') as f:
+
+            json.dump(meta, f)
+
+    # The model is renamed last, as it indicates a complete conversion.
+    os.replace(f'{tmp}.json', f'{target}.json')
+    os.replace(tmp, target)
+
+    return target
+
+
+
+def load(input_images=None, threads=None):
+    """
+    Loads the current network with the selected backend, converting it
+    first if required.
+
+    :param input_images: Input images (used to sample calibration tiles).
+    :param threads: Number of threads used by TensorFlow Lite.
+    :return: AmfModel.Inference, or TFLiteModel.
+    """
+
+    # AmfModel.load also reports missing networks.
+    if AmfConfig.get('backend') == 'keras' or \
+       not os.path.isfile(AmfConfig.get('model')):
+
+        return AmfModel.inference(AmfModel.load())
+
+    path = export([] if input_images is None else input_images)
+    AmfLog.text(f'Model: {path}')
+    model = TFLiteModel(path, threads)
+    AmfModel.configure(model)
+
+    return model
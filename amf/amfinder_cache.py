@@ -0,0 +1,311 @@
+# AMFinder - amfinder_cache.py
+#
+# MIT License
+# Copyright (c) 2021 Edouard Evangelisti, Carl Turner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+"""
+On-disk tile cache.
+
+Stores the whole tile grid of an image as a memory-mapped NumPy array, so
+that training, diagnostic and prediction runs on unchanged images do not
+decode them again. Cache entries are keyed by image content, tile edge,
+CNN input size, super-resolution mode and image downsampling factor, and
+the least recently used entries are removed when the cache grows beyond
+its size limit.
+
+Functions
+------------
+:function enabled: Indicates whether the tile cache is active.
+:function content_hash: Returns the SHA-1 digest of a file.
+:function load_factor: Returns the downsampling factor used to load an image.
+:function entry_path: Returns the path to the cache entry of an image.
+:function evict: Removes the least recently used cache entries.
+:function build: Extracts all tiles of an image into a cache entry.
+:function grid: Returns the cached tile grid of an image.
+:function tile: Extracts a single tile, using the cache if active.
+:function batches: Streams tile batches, using the cache if active.
+"""
+
+import os
+import glob
+import hashlib
+import functools
+import threading
+import numpy as np
+
+import amfinder_log as AmfLog
+import amfinder_model as AmfModel
+import amfinder_config as AmfConfig
+import amfinder_segmentation as AmfSegm
+
+
+
+# Prevents concurrent threads from building the same entry twice.
+LOCK = threading.Lock()
+
+
+
+def enabled():
+    """
+    Indicates whether the tile cache is active.
+    """
+
+    return AmfConfig.get('tile_cache') is not None
+
+
+
+@functools.lru_cache(maxsize=None)
+def content_hash(path, mtime, size):
+    """
+    Returns the SHA-1 digest of a file. Digests are memoised as long as
+    the file modification time and size remain unchanged.
+
+    :param path: path to the file.
+    :param mtime: file modification time (in nanoseconds).
+    :param size: file size (in bytes).
+    :return: hexadecimal digest.
+    :rtype: str
+    """
+
+    sha1 = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+
+
+@functools.lru_cache(maxsize=None)
+def load_factor(path, mtime, edge):
+    """
+    Returns the downsampling factor used to load an image (see
+    <AmfSegm.load>). Factors are memoised as long as the file modification
+    time remains unchanged.
+
+    :param path: path to the input image.
+    :param mtime: file modification time (in nanoseconds).
+    :param edge: tile edge.
+    :return: downsampling factor.
+    :rtype: int
+    """
+
+    image = AmfSegm.load(path, edge=edge)
+    return edge // AmfSegm.scaled_edge(image, edge)
+
+
+
+def entry_path(path, edge):
+    """
+    Returns the path to the cache entry of an image.
+
+    :param path: path to the input image.
+    :param edge: tile edge.
+    :return: path to the cache entry.
+    :rtype: str
+    """
+
+    st = os.stat(path)
+    digest = content_hash(os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    sr = int(bool(AmfConfig.get('super_resolution')))
+    shrink = load_factor(os.path.abspath(path), st.st_mtime_ns, edge)
+    key = f'{digest}-{edge}-{AmfModel.INPUT_SIZE}-{sr}-{shrink}'
+
+    return os.path.join(AmfConfig.get('tile_cache'), f'{key}.npy')
+
+
+
+def evict(keep=None):
+    """
+    Removes the least recently used cache entries until the cache size
+    falls below the size limit.
+
+    :param keep: cache entry to keep in all cases (optional).
+    """
+
+    limit = AmfConfig.get('tile_cache_size') * (1024 ** 3)
+    pattern = os.path.join(AmfConfig.get('tile_cache'), '*.npy')
+
+    entries = []
+
+    for x in glob.glob(pattern):
+
+        try:
+
+            st = os.stat(x)
+            entries.append((st.st_mtime, st.st_size, x))
+
+        except FileNotFoundError:
+
+            pass # removed by another process.
+
+    total = sum([x[1] for x in entries])
+
+    for _, size, x in sorted(entries):
+
+        if total <= limit:
+
+            break
+
+        if x != keep:
+
+            try:
+
+                os.remove(x)
+
+            except FileNotFoundError:
+
+                pass
+
+            total -= size
+
+
+
+def build(path, edge, target):
+    """
+    Extracts all tiles of an image into a cache entry. Tiles are written
+    strip by strip to a temporary file, which is then renamed, so that
+    other processes never read incomplete entries.
+
+    :param path: path to the input image.
+    :param edge: tile edge.
+    :param target: path to the cache entry.
+    """
+
+    image = AmfSegm.load(path, access='sequential', edge=edge)
+    nrows, ncols = AmfSegm.grid_size(image, edge)
+    size = AmfSegm.tile_size()
+
+    shape = (nrows, ncols, size, size, image.bands)
+    tmp = f'{target}.{os.getpid()}.{threading.get_ident()}.tmp'
+    array = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.uint8,
+                                      shape=shape)
+
+    for r, tiles in AmfSegm.strips(image, edge=edge):
+
+        array[r] = tiles
+
+    array.flush()
+    del array
+
+    os.replace(tmp, target)
+
+
+
+@functools.lru_cache(maxsize=32)
+def open_grid(target):
+    """
+    Opens a cache entry as a read-only memory-mapped array.
+
+    :param target: path to the cache entry.
+    :return: tile grid of shape (nrows, ncols, size, size, bands).
+    :rtype: numpy.memmap
+    """
+
+    return np.load(target, mmap_mode='r')
+
+
+
+def grid(path, edge=None):
+    """
+    Returns the cached tile grid of an image, extracting tiles first
+    if the image is not cached yet.
+
+    :param path: path to the input image.
+    :param edge: tile edge (defaults to the current tile edge).
+    :return: tile grid of shape (nrows, ncols, size, size, bands).
+    :rtype: numpy.memmap
+    """
+
+    edge = edge if edge is not None else AmfConfig.get('tile_edge')
+    target = entry_path(path, edge)
+
+    with LOCK:
+
+        if not os.path.isfile(target):
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            AmfLog.info(f'Caching tiles of {os.path.basename(path)}', indent=1)
+            build(path, edge, target)
+            open_grid.cache_clear()
+            evict(keep=target)
+
+        # Marks the entry as recently used, including when it is already
+        # open, so that eviction follows actual use.
+        os.utime(target)
+
+        return open_grid(target)
+
+
+
+def tile(image, r, c, edge=None):
+    """
+    Extracts a tile from a large image. Same as <AmfSegm.tile>, but reads
+    the tile from the cache when it is active.
+
+    :param image: The source image used to extract tiles.
+    :param r: The row index of the tile to extract.
+    :param c: The column index of the tile to extract.
+    :param edge: Tile edge (defaults to the current tile edge).
+    :return: The tile, as a NumPy array.
+    :rtype: numpy.ndarray
+    """
+
+    if enabled():
+
+        return np.array(grid(AmfSegm.filename(image), edge)[r, c])
+
+    else:
+
+        return AmfSegm.tile(image, r, c, edge)
+
+
+
+def batches(image, coords, batch_size, edge=None):
+    """
+    Streams tiles from a large image as fixed-size batches. Same as
+    <AmfSegm.batches>, but reads tiles from the cache when it is active.
+
+    :param image: The source image used to extract tiles.
+    :param coords: List of (row, column) pairs, sorted by row.
+    :param batch_size: Number of tiles per batch.
+    :param edge: Tile edge (defaults to the current tile edge).
+    :return: Generator of (coordinates, tiles) pairs.
+    :rtype: generator
+    """
+
+    if not enabled():
+
+        yield from AmfSegm.batches(image, coords, batch_size, edge)
+        return
+
+    tiles = grid(AmfSegm.filename(image), edge)
+
+    for i in range(0, len(coords), batch_size):
+
+        batch = coords[i:i + batch_size]
+        rows = [r for r, _ in batch]
+        cols = [c for _, c in batch]
+        yield (batch, tiles[rows, cols])
@@ -43,8 +43,10 @@ Functions
 :function set: Assign a new value to the given parameter ID.
 :function training_subparser: Define the command-line parser used in training mode.
 :function prediction_subparser: Define the command-line parser used in prediction mode.
+:function server_subparser: Define the command-line parser used in server mode.
 :function build_arg_parser: Build the full command-line parser.
-:function import_settings: Read tile size from `settings.json`.
+:function get_zipfile: Returns the path of the ZIP archive associated with an image.
+:function update_tile_edge: Read tile size from `settings.json`.
 :function get_input_files: Return the list of vaid input images (based on MIME type).
 :function initialize: Read command-line arguments and store user-defined values.
 """
@@ -75,6 +77,17 @@ PAR = {
     'tile_edge': 126,
     'input_files': ['*.jpg'],
     'batch_size': 32,
+    'prefetch': 2,
+    'fully_convolutional': False,
+    'background_threshold': None,
+    'incremental': False,
+    'backend': 'keras',
+    'sr_strip_height': 1,
+    'workers': 1,
+    'socket': None,
+    'tile_cache': None,
+    'tile_cache_size': 10,
+    'networks': ['CNN1v2.h5', 'CNN2v2.h5'],
     'learning_rate': 0.001,
     'drop': True,
     'epochs': 100,
@@ -82,6 +95,7 @@ PAR = {
     'threshold': 0.5,
     'data_augm': False,
     'save_augmented_tiles': 0,
+    'seed': 42,
     'summary': False,
     'patience': 12,
     'outdir': os.getcwd(),
@@ -263,6 +277,25 @@ def training_subparser(subparsers):
         help='training batch size.'
              '\ndefault value: {}'.format(x))
 
+    x = PAR['workers']
+    parser.add_argument('-w', '--workers',
+        action='store', dest='workers', metavar='NUM', type=int, default=x,
+        help='number of processes preparing tile batches.'
+             '\ndefault value: {}'.format(x))
+
+    x = PAR['tile_cache']
+    parser.add_argument('-tc', '--tile_cache',
+        action='store', dest='tile_cache', metavar='DIR', type=str, default=x,
+        help='folder where extracted tiles are cached.'
+             '\ndefault value: {} (no cache)'.format(x))
+
+    x = PAR['tile_cache_size']
+    parser.add_argument('-tcs', '--tile_cache_size',
+        action='store', dest='tile_cache_size', metavar='GB', type=float,
+        default=x,
+        help='maximum size of the tile cache, in gigabytes.'
+             '\ndefault value: {}'.format(x))
+
     x = PAR['drop']
     parser.add_argument('-k', '--keep_background',
         action='store_false', dest='drop', default=x,
@@ -282,6 +315,12 @@ def training_subparser(subparsers):
         help='save a subset of augmented tiles.'
              '\nby default, does not save any tile.')
 
+    x = PAR['seed']
+    parser.add_argument('-sd', '--seed',
+        action='store', dest='seed', metavar='NUM', type=int, default=x,
+        help='seed of all random choices made during training.'
+             '\ndefault value: {}'.format(x))
+
     x = PAR['summary']
     parser.add_argument('-s', '--summary',
         action='store_true', dest='summary', default=x,
@@ -379,6 +418,68 @@ def prediction_subparser(subparsers):
         help='Tile size (in pixels) used for image segmentation.'
              '\ndefault value: {} pixels'.format(x))
 
+    x = PAR['batch_size']
+    parser.add_argument('-b', '--batch_size',
+        action='store', dest='batch_size', metavar='NUM', type=int, default=x,
+        help='prediction batch size.'
+             '\ndefault value: {}'.format(x))
+
+    x = PAR['prefetch']
+    parser.add_argument('-pf', '--prefetch',
+        action='store', dest='prefetch', metavar='NUM', type=int, default=x,
+        help='number of tile batches prepared in background (0: disabled).'
+             '\ndefault value: {}'.format(x))
+
+    x = PAR['workers']
+    parser.add_argument('-w', '--workers',
+        action='store', dest='workers', metavar='NUM', type=int, default=x,
+        help='number of images processed in parallel.'
+             '\ndefault value: {}'.format(x))
+
+    x = PAR['fully_convolutional']
+    parser.add_argument('-fc', '--fully_convolutional',
+        action='store_true', dest='fully_convolutional', default=x,
+        help='predict whole tile rows at once (CNN1 only).'
+             '\nby default, tiles are predicted one by one.')
+
+    x = PAR['background_threshold']
+    parser.add_argument('-bg', '--background_threshold',
+        action='store', dest='background_threshold', metavar='X', type=float,
+        default=x,
+        help='classify tiles as background without CNN1 when the standard'
+             '\ndeviation of their pixel values is below X (e.g. 3).'
+             '\ndefault value: {} (all tiles are predicted)'.format(x))
+
+    x = PAR['incremental']
+    parser.add_argument('-inc', '--incremental',
+        action='store_true', dest='incremental', default=x,
+        help='reuse predictions made with the same image, network and'
+             '\nsettings, and only predict new colonised tiles (CNN2).'
+             '\nby default, all tiles are predicted.')
+
+    x = PAR['backend']
+    parser.add_argument('-be', '--backend',
+        action='store', dest='backend', metavar='NAME', default=x,
+        choices=['keras', 'tflite', 'tflite-dynamic', 'tflite-int8'],
+        help='inference backend: keras, tflite (float32), tflite-dynamic'
+             '\n(dynamic range quantisation) or tflite-int8 (full integer'
+             '\nquantisation). Converted networks are cached next to the'
+             '\noriginal ones, and checked against them on sample tiles.'
+             '\ndefault value: {}'.format(x))
+
+    x = PAR['tile_cache']
+    parser.add_argument('-tc', '--tile_cache',
+        action='store', dest='tile_cache', metavar='DIR', type=str, default=x,
+        help='folder where extracted tiles are cached.'
+             '\ndefault value: {} (no cache)'.format(x))
+
+    x = PAR['tile_cache_size']
+    parser.add_argument('-tcs', '--tile_cache_size',
+        action='store', dest='tile_cache_size', metavar='GB', type=float,
+        default=x,
+        help='maximum size of the tile cache, in gigabytes.'
+             '\ndefault value: {}'.format(x))
+
     parser.add_argument('-sr', '--super_resolution',
         action='store_const', dest='super_resolution', const=True,
         help='Apply super-resolution before predictions.'
@@ -390,6 +491,14 @@ def prediction_subparser(subparsers):
         help='name of the pre-trained generator.'
              '\ndefault value: {}'.format(x))
 
+    x = PAR['sr_strip_height']
+    parser.add_argument('-srh', '--sr_strip_height',
+        action='store', dest='sr_strip_height', metavar='NUM', type=int,
+        default=x,
+        help='number of tile rows processed at once by the generator'
+             '\n(together with --batch_size, determines memory usage).'
+             '\ndefault value: {}'.format(x))
+
     x = PAR['colormap']
     parser.add_argument('-map', '--colormap',
         action='store', dest='colormap', metavar='id', type=str, default=x,
@@ -412,6 +521,13 @@ def prediction_subparser(subparsers):
         help='save convolution kernels in a separate zip file (takes time).'
              '\ndefault value: False')
 
+    x = None
+    parser.add_argument('-sock', '--socket',
+        action='store', dest='socket', metavar='PATH', type=str, default=x,
+        help='socket of the prediction daemon (see amf serve).'
+             '\ndefault value: amfinder.sock in $XDG_RUNTIME_DIR, or in'
+             '\nthe private folder amfinder-<uid> of the temporary folder.')
+
     x = PAR['input_files']
     parser.add_argument('image', nargs='*', default=x,
         help='plant root scan to be processed.'
@@ -421,6 +537,46 @@ def prediction_subparser(subparsers):
 
 
 
+def server_subparser(subparsers):
+    """
+    Defines arguments used in server mode.
+    
+    :param subparsers: subparser generator.
+    """
+
+    parser = subparsers.add_parser('serve',
+        help='Runs AMFinder as a prediction daemon.',
+        formatter_class=RawTextHelpFormatter)
+
+    x = PAR['networks']
+    parser.add_argument('-net', '--network',
+        action='store', dest='networks', metavar='H5', type=str, nargs='+',
+        default=x,
+        help='names of the pre-trained models to keep in memory.'
+             '\ndefault value: {}'.format(' '.join(x)))
+
+    parser.add_argument('-sr', '--super_resolution',
+        action='store_const', dest='super_resolution', const=True,
+        help='Keep the super-resolution generator in memory.'
+             '\ndefault value: no super-resolution.')
+
+    x = 'SRGANGenv1beta.h5'
+    parser.add_argument('-g', '--generator',
+        action='store', dest='generator', metavar='H5', type=str, default=x,
+        help='name of the pre-trained generator.'
+             '\ndefault value: {}'.format(x))
+
+    x = None
+    parser.add_argument('-sock', '--socket',
+        action='store', dest='socket', metavar='PATH', type=str, default=x,
+        help='socket used to receive prediction jobs.'
+             '\ndefault value: amfinder.sock in $XDG_RUNTIME_DIR, or in'
+             '\nthe private folder amfinder-<uid> of the temporary folder.')
+
+    return parser
+
+
+
 def diagnostic_subparser(subparsers):
     """
     Defines arguments used in diagnostic mode.
@@ -438,6 +594,19 @@ def diagnostic_subparser(subparsers):
         help='name of the pre-trained model to use for diagnostic.'
              '\ndefault value: {}'.format(x))
 
+    x = PAR['tile_cache']
+    parser.add_argument('-tc', '--tile_cache',
+        action='store', dest='tile_cache', metavar='DIR', type=str, default=x,
+        help='folder where extracted tiles are cached.'
+             '\ndefault value: {} (no cache)'.format(x))
+
+    x = PAR['tile_cache_size']
+    parser.add_argument('-tcs', '--tile_cache_size',
+        action='store', dest='tile_cache_size', metavar='GB', type=float,
+        default=x,
+        help='maximum size of the tile cache, in gigabytes.'
+             '\ndefault value: {}'.format(x))
+
     x = PAR['input_files']
     parser.add_argument('image', nargs='*', default=x,
         help='plant root scan to be processed.'
@@ -458,6 +627,12 @@ def conversion_subparser(subparsers):
         action='store', dest='threshold', metavar='N', type=float, default=x,
         help='threshold for conversion: {}'.format(x))
 
+    x = PAR['workers']
+    parser.add_argument('-w', '--workers',
+        action='store', dest='workers', metavar='NUM', type=int, default=x,
+        help='number of archives processed in parallel.'
+             '\ndefault value: {}'.format(x))
+
     level = parser.add_mutually_exclusive_group()
 
     level.add_argument('-1', '--CNN1',
@@ -491,6 +666,7 @@ def build_arg_parser():
 
     _ = training_subparser(subparsers)
     _ = prediction_subparser(subparsers)
+    _ = server_subparser(subparsers)
     _ = diagnostic_subparser(subparsers)
     _ = conversion_subparser(subparsers)
 
@@ -510,6 +686,20 @@ def abspath(files):
 
 
 
+def get_zipfile(path):
+    """
+    Returns the path of the auxiliary ZIP archive associated
+    with the given image.
+
+    :param path: Path to an input image.
+    :return: Path to the corresponding auxiliary ZIP archive.
+    :rtype: string
+    """
+
+    return '{}.zip'.format(os.path.splitext(path)[0])
+
+
+
 def update_tile_edge(path):
     """
     Import image settings (currently tile edge).
@@ -517,7 +707,7 @@ def update_tile_edge(path):
     :param path: path to the input image.
     """
 
-    zfile = os.path.splitext(path)[0] + '.zip'
+    zfile = get_zipfile(path)
 
     if zf.is_zipfile(zfile):
 
@@ -556,18 +746,24 @@ def initialize():
 
     # Main arguments.
     set('run_mode', par.run_mode)
-    set('input_files', par.image)
+    # The prediction daemon does not take input images.
+    set('input_files', par.image if 'image' in par else [])
 
     # Sub-parser specific arguments.
     if par.run_mode == 'train':
 
         set('batch_size', par.batch_size)
+        set('workers', par.workers)
         set('drop', par.drop)
+        set('tile_cache', par.tile_cache)
+        set('tile_cache_size', par.tile_cache_size)
         set('epochs', par.epochs)
         set('model', par.model)
         set('level', par.level)
         set('vfrac', par.vfrac)
         set('data_augm', par.data_augm)
+        set('save_augmented_tiles', par.save_augmented_tiles)
+        set('seed', par.seed)
         set('summary', par.summary)
         set('outdir', par.outdir)
         # Parameters associated with super-resolution. 
@@ -578,6 +774,16 @@ def initialize():
     elif par.run_mode == 'predict':
 
         set('tile_edge', par.edge)
+        set('batch_size', par.batch_size)
+        set('prefetch', par.prefetch)
+        set('fully_convolutional', par.fully_convolutional)
+        set('background_threshold', par.background_threshold)
+        set('incremental', par.incremental)
+        set('backend', par.backend)
+        set('workers', par.workers)
+        set('tile_cache', par.tile_cache)
+        set('tile_cache_size', par.tile_cache_size)
+        set('socket', par.socket)
         set('model', par.model)
         set('save_conv2d_kernels', par.save_conv2d_kernels)   
         set('save_conv2d_outputs', par.save_conv2d_outputs)   
@@ -585,15 +791,26 @@ def initialize():
         # Parameters associated with super-resolution. 
         set('super_resolution', par.super_resolution)
         set('generator', par.generator)
+        set('sr_strip_height', par.sr_strip_height)
+
+    elif par.run_mode == 'serve':
+
+        set('networks', par.networks)
+        set('super_resolution', par.super_resolution)
+        set('generator', par.generator)
+        set('socket', par.socket)
 
     elif par.run_mode == 'diagnose': 
         
-        set('model', par.model)   
+        set('model', par.model)
+        set('tile_cache', par.tile_cache)
+        set('tile_cache_size', par.tile_cache_size)
     
     elif par.run_mode == 'convert':
    
         set('level', par.level)
         set('threshold', par.threshold)
+        set('workers', par.workers)
         
     else:
     
@@ -22,42 +22,63 @@
 # IN THE SOFTWARE.
 
 
+"""
+Converts predictions to annotations.
+
+Functions
+------------
+
+:function grid_size: Returns the number of tile rows and columns of an image.
+:function preds_to_python_annot_1: Converts level 1 predictions.
+:function preds_to_python_annot_2: Converts level 2 predictions.
+:function ocaml_text: Serialises an annotation matrix.
+:function python_annot_to_ocaml_1: Builds level 1 OCaml annotations.
+:function python_annot_to_ocaml_2: Builds level 2 OCaml annotations.
+:function preds_to_python_annot: Converts predictions to Python annotations.
+:function python_annot_to_ocaml: Builds OCaml annotations.
+:function python_annot_entry: Builds Python annotations.
+:function create_annotations: Converts the predictions of a single image.
+:function init_worker: Initialises a worker process.
+:function run_worker: Converts a single image in a worker process.
+:function run: Converts predictions for a bunch of images.
+"""
+
 import io
 import os
+import sys
 import json
 import imagesize
 import numpy as np
 import pandas as pd
+from contextlib import redirect_stdout
+from contextlib import redirect_stderr
+from concurrent.futures import ProcessPoolExecutor
 #import zipfile as zf
 # Reference: https://stackoverflow.com/a/69115481
-# Local version of zipfile to get access to <remove>.
+# Local version of zipfile to get access to <remove> and <remove_all>.
 import amfinder_zipfile as zf
 import amfinder_log as AmfLog
 import amfinder_save as AmfSave
-import amfinder_train as AmfTrain
 import amfinder_config as AmfConfig
-import amfinder_diagnose as AmfDiagnose
-
 
-NROWS = None
-NCOLS = None
 
-
-def initialize_size(path, zfile):
+def grid_size(path, z):
     """
     Retrieve the number of rows and columns based on image and tile sizes.
+
+    :param path: path to the input image.
+    :param z: ZIP archive containing image settings.
+    :return: row and column counts.
+    :rtype: tuple
     """
-    tile_size = None
+
     width, height = imagesize.get(path)
 
-    with zf.ZipFile(zfile, 'r') as z:
-        data = z.read(AmfSave.IMG_SETTINGS).decode('utf-8')
-        tile_size = json.loads(data)['tile_edge']
+    data = z.read(AmfSave.IMG_SETTINGS).decode('utf-8')
+    tile_size = json.loads(data)['tile_edge']
 
-    global NROWS, NCOLS
     assert tile_size is not None
-    NCOLS = width // tile_size
-    NROWS = height // tile_size
+    return (height // tile_size, width // tile_size)
 
 
 
@@ -72,7 +93,7 @@ def preds_to_python_annot_1(path, preds):
 
     # Get the predictions for automatic conversion.
     coord = preds[['row', 'col']]
-    preds = AmfDiagnose.remove_coordinates(preds)
+    preds = preds.drop(['row', 'col'], axis=1)
     preds = preds.to_numpy()
 
     # Perform the conversion, ignoring ties.
@@ -101,7 +122,7 @@ def preds_to_python_annot_2(path, preds):
 
     # Get the predictions for automatic conversion.
     coord = preds[['row', 'col']]
-    preds = AmfDiagnose.remove_coordinates(preds)
+    preds = preds.drop(['row', 'col'], axis=1)
     preds = preds.to_numpy()
 
     # Perform the conversion, ignoring ties.
@@ -126,64 +147,60 @@ def preds_to_python_annot_2(path, preds):
     return final
 
 
-def python_annot_to_ocaml_1(out, zfile):
+def ocaml_text(mat):
+    """
+    Serialise an annotation matrix as tab-separated text.
+    """
+
+    return '\n'.join(['\t'.join(row) for row in mat.tolist()])
+
+
+
+def python_annot_to_ocaml_1(out, nrows, ncols):
     """
     Convert level 1 predictions to OCaml annotations.
     """
-    
-    mat1 = np.zeros((NROWS, NCOLS)).astype('<U1')
-    mat2 = np.zeros((NROWS, NCOLS)).astype('<U1')
+
+    # Tiles without predictions are labelled '0'.
+    mat1 = np.full((nrows, ncols), '0', dtype='<U1')
+    mat2 = np.full((nrows, ncols), '0', dtype='<U1')
     
     header = AmfConfig.get('header')
-    out = out.reset_index()
-
-    for _, row in out.iterrows():
-        r = row['row']
-        c = row['col']
-        mat1[r, c] = header[np.argmax(row[header])]
-        mat2[r, c] = '' # this one will remain empty.
+    rows = out['row'].to_numpy()
+    cols = out['col'].to_numpy()
 
-    with zf.ZipFile(zfile, 'a') as z:
+    # Scatter the active class of each tile into the matrix.
+    labels = np.array(header)[np.argmax(out[header].to_numpy(), axis=1)]
+    mat1[rows, cols] = labels
+    mat2[rows, cols] = '' # this one will remain empty.
 
-        d1 = pd.DataFrame(mat1).to_csv(sep='\t', encoding='utf-8',
-                                       index=False, header=False,
-                                       mode='a', line_terminator='')
-        zi = AmfSave.get_zip_info('annotations/col.caml', 1)
-        # There is still a trailing character at the end of the csv text.
-        z.writestr(zi, d1[:-1])
-        d2 = pd.DataFrame(mat2).to_csv(sep='\t', encoding='utf-8',
-                                       index=False, header=False,
-                                       mode='a', line_terminator='')
-        zi = AmfSave.get_zip_info('annotations/myc.caml', 0)
-        # There is still a trailing character at the end of the csv text.
-        z.writestr(zi, d2[:-1])
+    return [(AmfSave.get_zip_info('annotations/col.caml', 1), ocaml_text(mat1)),
+            (AmfSave.get_zip_info('annotations/myc.caml', 0), ocaml_text(mat2))]
 
 
 
-def python_annot_to_ocaml_2(out, zfile):
+def python_annot_to_ocaml_2(out, nrows, ncols):
     """
     Convert level 2 predictions to OCaml annotations.
     """
 
-    mat2 = np.zeros((NROWS, NCOLS), str).astype('<U4')
+    mat2 = np.full((nrows, ncols), '', dtype='<U4')
     
     header = AmfConfig.get('header')
-    out = out.reset_index()
+    rows = out['row'].to_numpy()
+    cols = out['col'].to_numpy()
 
-    for _, row in out.iterrows():
-        r = row['row']
-        c = row['col']
-        indices = [i for i, x in enumerate(row[header]) if x == 1]
-        mat2[r, c] = ''.join(sorted([header[i] for i in indices]))
+    # Encode active classes as bit fields, in alphabetical order, and
+    # build the corresponding labels (e.g. 0b0101 -> 'AI').
+    order = np.argsort(header)
+    active = out[header].to_numpy()[:, order] == 1
+    codes = active.dot(1 << np.arange(len(header)))
+    labels = np.array([''.join([header[i] for k, i in enumerate(order)
+                                if code & (1 << k)])
+                       for code in range(1 << len(header))])
+    mat2[rows, cols] = labels[codes]
 
-    with zf.ZipFile(zfile, 'a') as z:
-        z.remove('annotations/myc.caml')
-        d2 = pd.DataFrame(mat2).to_csv(sep='\t', encoding='utf-8',
-                                       index=False, header=False,
-                                       mode='a', line_terminator='')
-        zi = AmfSave.get_zip_info('annotations/myc.caml', 0)
-        # There is still a trailing character at the end of the csv text.
-        z.writestr(zi, d2[:-1])
+    return [(AmfSave.get_zip_info('annotations/myc.caml', 0), ocaml_text(mat2))]
 
 
 
@@ -201,39 +218,57 @@ def preds_to_python_annot(path, preds):
 
 
 
-def python_annot_to_ocaml(out, zfile):
+def python_annot_to_ocaml(out, nrows, ncols):
     """
-    Convert and save predictions to OCaml annotations.
+    Convert predictions to OCaml annotations.
+
+    :return: list of (ZIP information, data) pairs to write.
+    :rtype: list
     """
     if AmfConfig.get('level') == 1:
     
-        python_annot_to_ocaml_1(out, zfile)
+        return python_annot_to_ocaml_1(out, nrows, ncols)
     
     else:
     
-        python_annot_to_ocaml_2(out, zfile)
+        return python_annot_to_ocaml_2(out, nrows, ncols)
 
-    update_archive(out, zfile)
 
 
-def update_archive(out, zfile):
+def python_annot_entry(out):
     """
-    Save annotations in Python format.
+    Convert annotations to Python format.
+
+    :return: ZIP information and data to write.
+    :rtype: tuple
     """
-    with zf.ZipFile(zfile, 'a') as z:
 
-        data = out.to_csv(sep='\t', encoding='utf-8', index=False,
-                          mode='a', line_terminator='')
-        zi = AmfSave.get_zip_info(AmfConfig.tsv_name(), AmfConfig.string_of_level())
-        z.writestr(zi, data[:-1])
+    data = out.to_csv(sep='\t', encoding='utf-8', index=False,
+                      mode='a', line_terminator='')
+    zi = AmfSave.get_zip_info(AmfConfig.tsv_name(), AmfConfig.string_of_level())
+    return (zi, data[:-1])
 
 
 
-def create_annotations(path, zfile):
+def create_annotations(path):
+    """
+    Convert the predictions of a single image to annotations. The archive
+    is opened once, and existing entries are replaced in a single pass.
+
+    :param path: path to the input image.
+    """
+
+    # Make sure the image comes with a valid zip file.
+    zfile = AmfConfig.get_zipfile(path)
+
+    if not zf.is_zipfile(zfile):
+
+        AmfLog.warning(f'File {path} has no associated zip file')
+        return
 
     preds = []
 
-    with zf.ZipFile(zfile, 'r') as z:
+    with zf.ZipFile(zfile, 'a') as z:
 
         if AmfConfig.tsv_name() in z.namelist():
 
@@ -253,10 +288,22 @@ def create_annotations(path, zfile):
             AmfLog.info(f'Skipping {path} as no predictions could be found')
 
         elif len(preds) == 1:
-            
-                data = z.read(preds[0]).decode('utf-8')
-                out = preds_to_python_annot(path, data)
-                python_annot_to_ocaml(out, zfile)
+
+            nrows, ncols = grid_size(path, z)
+            data = z.read(preds[0]).decode('utf-8')
+            out = preds_to_python_annot(path, data)
+
+            entries = python_annot_to_ocaml(out, nrows, ncols)
+            entries.append(python_annot_entry(out))
+
+            # Replaced entries are removed first, in a single pass.
+            names = z.namelist()
+            z.remove_all([zi.filename for zi, _ in entries
+                          if zi.filename in names])
+
+            for zi, data in entries:
+
+                z.writestr(zi, data)
 
         else:
 
@@ -265,21 +312,61 @@ def create_annotations(path, zfile):
 
 
 
+def init_worker(settings):
+    """
+    Initialises a worker process with the settings of the parent process.
+
+    :param settings: user settings of the parent process.
+    """
+
+    AmfConfig.PAR.update(settings)
+
+
+
+def run_worker(path):
+    """
+    Converts the predictions of a single image in a worker process.
+
+    :param path: path to the input image.
+    :return: standard output and standard error messages.
+    :rtype: tuple
+    """
+
+    out = io.StringIO()
+    err = io.StringIO()
+
+    with redirect_stdout(out), redirect_stderr(err):
+
+        create_annotations(path)
+
+    return (out.getvalue(), err.getvalue())
+
+
 
 def run(input_images):
+    """
+    Converts predictions to annotations for a bunch of images.
+
+    :param input_images: input images whose predictions are converted.
+    """
 
     print('Image\t' + '\t'.join(AmfConfig.human_redable_header()))
 
-    for path in input_images:
-    
-        # Make sure the image comes with a valid zip file.
-        zfile = AmfTrain.get_zipfile(path)
+    workers = min(AmfConfig.get('workers'), len(input_images))
 
-        if not zf.is_zipfile(zfile):
+    if workers <= 1:
 
-            AmfLog.warning(f'File {path} has no associated zip file.')
-       
-        initialize_size(path, zfile)
-        create_annotations(path, zfile)
-        
-        
+        for path in input_images:
+
+            create_annotations(path)
+
+    else:
+
+        with ProcessPoolExecutor(workers, initializer=init_worker,
+                                 initargs=(AmfConfig.PAR,)) as pool:
+
+            # Messages are printed in input order.
+            for out, err in pool.map(run_worker, input_images):
+
+                print(out, end='', flush=True)
+                print(err, end='', file=sys.stderr, flush=True)
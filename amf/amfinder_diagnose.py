@@ -56,10 +56,10 @@ from contextlib import redirect_stdout
 
 import amfinder_log as AmfLog
 import amfinder_save as AmfSave
+import amfinder_cache as AmfCache
 import amfinder_train as AmfTrain
 import amfinder_config as AmfConfig
 import amfinder_predict as AmfPredict
-import amfinder_segmentation as AmfSegm
 
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
@@ -229,7 +229,7 @@ def save_mispredicted_tile(image, a, p, rc, samples_per_class=-1):
     
         ID[p] += 1
         num = ID[p]
-        img = Image.fromarray(AmfSegm.tile(image, rc[0], rc[1]))
+        img = Image.fromarray(AmfCache.tile(image, rc[0], rc[1]))
         byt = io.BytesIO()   
         img.save(byt, 'PNG')
         path = f'mispredicted_tiles/p{p}_a{a}_{num:06d}.png'
@@ -24,20 +24,52 @@
 """
 Image modifications for the purpose of data augmentation.
 Adapted from https://www.degeneratestate.org/posts/2016/Oct/23/image-processing-with-numpy/
-
+All functions operate on whole tile batches of shape (B, H, W, 3), so that
+augmentation does not involve any per-tile Python loop. Random choices are
+drawn from a numpy.random.Generator supplied by the caller.
 
 Functions
 ------------
+:function flip: random horizontal and vertical flips.
+:function brightness: random brightness alteration.
 :function invert: invert colours.
 :function grayscale: convert an image to grayscale.
+:function hue_lut: precomputed hue rotations.
 :function rotate_colours: transform colours.
+:function augment: apply all modifications to a tile batch.
 
 """
 
-import random
-random.seed(42)
+import functools
 import numpy as np
-from scipy.ndimage import median_filter
+
+
+
+# Number of hue rotation angles (multiples of pi/10, from 0 to 2pi).
+ANGLES = 21
+
+
+
+def flip(batch, rng):
+    """
+    Flips each tile horizontally and vertically with probability 0.5.
+    """
+
+    size = (len(batch), 1, 1, 1)
+    h = rng.random(size) < 0.5
+    batch = np.where(h, batch[:, :, ::-1], batch)
+    v = rng.random(size) < 0.5
+    return np.where(v, batch[:, ::-1], batch)
+
+
+
+def brightness(batch, rng, low=0.75, high=1.25):
+    """
+    Multiplies each tile by a random brightness factor.
+    """
+
+    factor = rng.uniform(low, high, (len(batch), 1, 1, 1))
+    return np.clip(batch * factor, 0, 255)
 
 
 
@@ -67,31 +99,95 @@ def do_normalise(tile):
 
 def undo_normalise(tile):
 
-    return (1 + 1/(np.exp(-tile) + 1) * 257)
+    return 257 / (np.exp(-tile) + 1) - 1
 
 
 
 def rotation_matrix(theta):
     """
-    3D rotation matrix around the X-axis by angle theta
+    3D rotation matrices around the X-axis by angles theta, with
+    shape (3, 3) for a scalar angle, or (N, 3, 3) for an array of angles.
     """
-   
-    return np.c_[
-        [1,0,0],
-        [0,np.cos(theta),-np.sin(theta)],
-        [0,np.sin(theta),np.cos(theta)]
-    ]
+
+    theta = np.asarray(theta, dtype=np.float32)
+    cos = np.cos(theta)
+    sin = np.sin(theta)
+    one = np.ones_like(theta)
+    zero = np.zeros_like(theta)
+
+    return np.stack([
+        np.stack([one, zero, zero], axis=-1),
+        np.stack([zero, cos, -sin], axis=-1),
+        np.stack([zero, sin, cos], axis=-1)
+    ], axis=-1)
 
 
 
-def rotate_colours(tile):
+@functools.lru_cache(maxsize=None)
+def hue_lut():
     """
-    Rotate the color wheels, resulting in altered hue.
+    Precomputes hue rotations for all 8-bit colours. Rotations around the
+    X-axis leave the red channel unchanged, and the new green and blue
+    values only depend on the original green and blue values. The table
+    therefore has shape (ANGLES, 256, 256, 2), and maps an angle index and
+    a (green, blue) pair to the rotated (green, blue) pair.
     """
-    norm = do_normalise(tile)
-    theta = random.randint(0, 20) * np.pi / 10
-    print(theta)
-    norm_rot = np.einsum("ijk,lk->ijl", norm, rotation_matrix(theta))
-    return undo_normalise(norm_rot)
 
+    norm = do_normalise(np.arange(256, dtype=np.float64))
+    gb = np.zeros((256, 256, 3))
+    gb[..., 1] = norm[:, None]
+    gb[..., 2] = norm[None, :]
+    theta = np.arange(ANGLES) * np.pi / 10
+    rot = np.einsum("ijk,alk->aijl", gb, rotation_matrix(theta))
+    rot = undo_normalise(rot[..., 1:])
+    return np.clip(np.rint(rot), 0, 255).astype(np.uint8)
+
+
+
+def rotate_colours(batch, rng):
+    """
+    Rotate the color wheels, resulting in altered hue. Each tile
+    of the batch is rotated by its own random angle, using <hue_lut>.
+    """
+
+    theta = rng.integers(0, ANGLES, len(batch))
+    output = batch.copy()
+    output[..., 1:] = hue_lut()[theta[:, None, None],
+                                batch[..., 1], batch[..., 2]]
+    return output
+
+
+
+def augment(batch, rng):
+    """
+    Two-step random augmentation of a tile batch. Tiles are randomly
+    flipped and their brightness altered (step 1), then either inverted,
+    converted to grayscale, hue-rotated, or left unchanged (step 2).
+    Random rotations and zoom are not used due to fungal structures
+    occurring on edges in some tiles.
+
+    :param batch: The tiles to augment, as an uint8 array (B, H, W, 3).
+    :param rng: The random number generator.
+    :return: The augmented tiles.
+    :rtype: numpy.ndarray
+    """
+
+    batch = brightness(flip(batch, rng).astype(np.float32), rng)
+    batch = np.rint(batch).astype(np.uint8)
+
+    choice = rng.integers(0, 4, len(batch))
+
+    mask = choice == 0
+    if mask.any():
+        batch[mask] = invert(batch[mask])
+
+    mask = choice == 1
+    if mask.any():
+        batch[mask] = np.rint(grayscale(batch[mask]))
+
+    mask = choice == 2
+    if mask.any():
+        batch[mask] = rotate_colours(batch[mask], rng)
+
+    return batch
 
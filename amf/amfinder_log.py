@@ -36,6 +36,8 @@ ERR_MISSING_ARCHIVE - Cannot find the zip archive associated with an image.
 ERR_MISSING_SETTINGS - File settings.json not found.
 ERR_MISSING_ANNOTATIONS - The given archive lacks stage 1 annotations.
 ERR_CORRUPTED_ARCHIVE - Corrupted ZIP archive.
+ERR_DAEMON_RUNNING - A prediction daemon is already running.
+ERR_UNSAFE_SOCKET - The daemon socket belongs to another user.
 
 Functions
 -----------
@@ -60,6 +62,8 @@ ERR_MISSING_SETTINGS = 31
 ERR_MISSING_ANNOTATIONS = 32
 ERR_INVALID_MODEL = 40
 ERR_CORRUPTED_ARCHIVE = 41
+ERR_DAEMON_RUNNING = 50
+ERR_UNSAFE_SOCKET = 51
 
 
 
@@ -31,22 +31,34 @@ Builds the convolutional neural networks used by AMFinder.
 Constants
 -----------
 INPUT_SIZE - Size (in pixels) of input images.
+DOWNSAMPLING - Downsampling factor of convolution/maxpooling blocks.
+TILE_PITCH - Distance (in pixels) between tiles laid out as strips.
 CNN1_NAME - Name of the root segmentation network.
 CNN2_NAME - Name of the AM fungal structure prediction network.
 
+Class
+------------
+:class Inference: Runs predictions with a compiled inference step.
+
 Functions
 ------------
 :function convolutions: Builds convolution/maxpooling blocks.
 :function fc_layers: Builds fully connected/dropout layers.
 :function create_cnn1: Builds a network for root segmentation.
 :function create_cnn2: Builds a network for AM fungal structure prediction.
+:function configure: Sets the annotation level of a pre-trained network.
 :function load: main function, to be called from outside.
+:function inference: Wraps a network for predictions.
+:function fully_convolutional: Converts CNN1 to a fully convolutional network.
 """
 
 
 
 import os
 import keras
+import functools
+import numpy as np
+import tensorflow as tf
 
 from keras.models import Model
 from keras.layers import Input, Conv2D, MaxPooling2D, Flatten, Dense, Dropout
@@ -63,6 +75,9 @@ import amfinder_config as AmfConfig
 
 
 INPUT_SIZE = 126
+DOWNSAMPLING = 16
+# Smallest multiple of DOWNSAMPLING that can hold a tile.
+TILE_PITCH = 128
 CNN1_NAME = 'col'
 CNN2_NAME = 'myc'
 
@@ -188,6 +203,25 @@ def create_cnn2():
 
 
 
+def configure(model):
+    """
+    Sets the annotation level corresponding to a pre-trained network.
+
+    :param model: pre-trained network.
+    """
+
+    if model.name == CNN1_NAME:
+
+        AmfConfig.set('level', 1)
+
+    else:
+
+        AmfConfig.set('level', 2)
+        
+    AmfLog.text(f'Classes: {AmfConfig.get_class_documentation()}.')
+
+
+
 def load(name=None):
     """
     Loads or initialises a convolutional neural network.
@@ -205,16 +239,7 @@ def load(name=None):
     
         AmfLog.text(f'Model: {path}')
         model = keras.models.load_model(path)
-
-        if model.name == CNN1_NAME:
-
-            AmfConfig.set('level', 1)
-
-        else:
-
-            AmfConfig.set('level', 2)
-            
-        AmfLog.text(f'Classes: {AmfConfig.get_class_documentation()}.')
+        configure(model)
         return model
 
     else:
@@ -238,6 +263,134 @@ def load(name=None):
 
 
 
+class Inference:
+    """
+    Runs predictions with a compiled inference step, i.e. a tf.function
+    traced once per batch shape. Unlike <model.predict>, calls do not set
+    up a new data adapter each time. The last batch is padded to full size,
+    so that all batches share the same traced step. Other attributes are
+    those of the wrapped model.
+    """
+
+    def __init__(self, model):
+        """
+        :param model: Keras model.
+        """
+
+        self.model = model
+        self.steps = {}
+
+
+    def __getattr__(self, name):
+
+        if name == 'model':
+
+            raise AttributeError(name)
+
+        return getattr(self.model, name)
+
+
+    def step(self, shape):
+        """
+        Returns the inference step for the given batch shape.
+        """
+
+        if shape not in self.steps:
+
+            spec = tf.TensorSpec(shape, tf.float32)
+            call = lambda x: self.model(x, training=False)
+            self.steps[shape] = tf.function(call, input_signature=[spec])
+
+        return self.steps[shape]
+
+
+    def predict(self, x, batch_size=32, verbose=0):
+
+        x = np.asarray(x, dtype=np.float32)
+        step = self.step((batch_size,) + x.shape[1:])
+        results = []
+
+        for i in range(0, len(x), batch_size):
+
+            batch = x[i:i + batch_size]
+            n = len(batch)
+
+            if n < batch_size:
+
+                padding = np.zeros((batch_size - n,) + x.shape[1:], np.float32)
+                batch = np.concatenate([batch, padding])
+
+            out = step(batch)
+            out = out if isinstance(out, (list, tuple)) else [out]
+            results.append([y.numpy()[:n] for y in out])
+
+        outputs = [np.concatenate(y) for y in zip(*results)]
+
+        return outputs[0] if len(outputs) == 1 else outputs
+
+
+
+def inference(model):
+    """
+    Wraps a network for predictions (see <Inference>).
+
+    :param model: Keras model.
+    :return: wrapped model.
+    :rtype: Inference
+    """
+
+    return Inference(model)
+
+
+
+@functools.lru_cache(maxsize=4)
+def fully_convolutional(model, stride=TILE_PITCH):
+    """
+    Converts a trained CNN1 into an equivalent fully convolutional network,
+    which processes image strips of any width in a single pass. Trained
+    convolution/maxpooling layers are reused as such, while dense layers are
+    converted into convolutions. The network returns one prediction every
+    <stride> pixels, which matches the prediction of <model> on the tile
+    starting at this position. <stride> must be a multiple of DOWNSAMPLING,
+    so that tiles are aligned with maxpooling windows.
+
+    :param model: trained CNN1.
+    :param stride: distance (in pixels) between consecutive tiles.
+    :return: network with output shape (batch, 1, strip width // stride, 3).
+    :rtype: Inference
+    """
+
+    assert stride % DOWNSAMPLING == 0
+
+    input_layer = Input(shape=(INPUT_SIZE, None, 3))
+    x = input_layer
+
+    for layer in model.layers:
+
+        if isinstance(layer, (Conv2D, MaxPooling2D)):
+
+            x = layer(x)
+
+    # The first dense layer covers the whole output of the last maxpooling
+    # layer (5x5), and following ones are equivalent to 1x1 convolutions.
+    size = x.shape[1]
+    strides = (1, stride // DOWNSAMPLING)
+
+    for dense in filter(model, Dense):
+
+        kernel, bias = dense.get_weights()
+        conv = Conv2D(dense.units, kernel_size=size, strides=strides,
+                      activation=dense.activation, name=f'{dense.name}_conv')
+        x = conv(x)
+        conv.set_weights([kernel.reshape(conv.kernel.shape), bias])
+        size = 1
+        strides = 1
+
+    return inference(Model(inputs=input_layer, outputs=x,
+                           name=f'{CNN1_NAME}_fcn'))
+
+
+
 def filter(model, layer_type):
     """
     Return all layers from a <model> that belong to a given <layer_type>.
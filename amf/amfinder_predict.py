@@ -27,18 +27,31 @@ Predicts fungal colonisation (CNN1) and intraradical hyphal structures (CNN2).
 Functions
 ------------
 
+:function tile_stream: Streams tile batches prepared in background.
+:function predict_tiles: Batched predictions on a set of tiles.
+:function predict_strips: Fully convolutional predictions on whole rows.
+:function background_tiles: Identifies obviously empty tiles.
+:function fingerprint: Summarises the inputs of a prediction table.
+:function previous_table: Retrieves a prediction table with a given fingerprint.
 :function predict_level2: CNN2 predictions.
 :function predict_level1: CNN1 predictions.
+:function predict_image: Predictions on a single image.
+:function init_worker: Initialises a worker process.
+:function run_worker: Predictions on a single image in a worker process.
+:function run_parallel: Spreads images across worker processes.
 :function run: main prediction function.
 """
 
 import io
 import os
+import sys
+import json
+import tempfile
 import pyvips
 import numpy as np
 import pandas as pd
+import multiprocessing as mp
 import amfinder_zipfile as zf
-from itertools import zip_longest
 # For intermediate images
 from PIL import Image
 import matplotlib.pyplot as plt
@@ -48,6 +61,8 @@ import amfinder_log as AmfLog
 import amfinder_calc as AmfCalc
 import amfinder_save as AmfSave
 import amfinder_model as AmfModel
+import amfinder_cache as AmfCache
+import amfinder_backend as AmfBackend
 import amfinder_config as AmfConfig
 import amfinder_segmentation as AmfSegm
 import amfinder_superresolution as AmfSRGAN
@@ -63,25 +78,239 @@ def table_header():
 
 
 
-def process_row_1(cnn1, image, nrows, ncols, batch_size, r, sr_image):
+def tile_stream(image, coords, batch_size, normalise=True, sr_image=None):
     """
-    Predict colonisation (CNN1) on a single tile row.
+    Streams tile batches from an image. Batches are extracted (and
+    normalised) in a background thread while the current batch is
+    being predicted.
+
+    :param image: input image (to extract tiles).
+    :param coords: list of (row, column) pairs of the tiles to extract.
+    :param batch_size: number of tiles per batch.
+    :param normalise: whether to normalise pixel values (defaults to True).
+    :param sr_image: super-resolution canvas (optional). When given, tiles
+                     are generated from whole strips by the SRGAN generator.
+    :return: generator of (coordinates, tiles) pairs.
+    :rtype: generator
+    """
+
+    if sr_image is None:
+
+        batches = AmfCache.batches(image, coords, batch_size)
+
+    else:
+
+        batches = AmfSRGAN.batches(image, coords, batch_size, sr_image)
+
+    if normalise:
+
+        batches = ((x, AmfSegm.preprocess(y)) for x, y in batches)
+
+    return AmfSegm.prefetch(batches, AmfConfig.get('prefetch'))
+
+
+
+def predict_tiles(model, image, coords, batch_size, sr_image=None):
+    """
+    Predicts a set of tiles. Tiles are streamed from the whole image into
+    fixed-size batches, regardless of row boundaries, to reduce the number
+    of calls to <model.predict>.
+
+    :param model: trained CNN used for predictions.
+    :param image: input image (to extract tiles).
+    :param coords: list of (row, column) pairs of the tiles to predict.
+    :param batch_size: number of tiles per batch.
+    :param sr_image: super-resolution canvas (optional).
+    :return: predictions (one column per class), in the same order
+             as <coords>.
+    :rtype: numpy.ndarray
     """
-    # First, extract all tiles within a row.
-    row = [AmfSegm.tile(image, r, c) for c in range(ncols)]
-    # Generate super-resolution tiles.
-    row = AmfSRGAN.generate(sr_image, row, r)
-    # Convert to NumPy array, and normalize.
-    row = AmfSegm.preprocess(row)
-    # Predict mycorrhizal structures.
-    prd = cnn1.predict(row, batch_size=batch_size, verbose=0)
-    # Update the progress bar.
-    AmfLog.progress_bar(r + 1, nrows, indent=1)
-    # Return prediction as Pandas data frame.
-    return pd.DataFrame(prd)
-
-
-def predict_level2(path, image, nrows, ncols, model):
+
+    results = []
+    processed = 0
+
+    # Initialize the progress bar.
+    AmfLog.progress_bar(0, len(coords), indent=1)
+
+    for batch, tiles in tile_stream(image, coords, batch_size,
+                                    sr_image=sr_image):
+
+        # Predict mycorrhizal structures.
+        prd = model.predict(tiles, batch_size=batch_size, verbose=0)
+
+        # CNN2 returns one (n, 1) array per class.
+        if isinstance(prd, list):
+
+            prd = np.hstack(prd)
+
+        results.append(prd)
+        # Update the progress bar.
+        processed += len(batch)
+        AmfLog.progress_bar(processed, len(coords), indent=1)
+
+    return np.concatenate(results)
+
+
+
+def predict_strips(model, image, rows, ncols, batch_size):
+    """
+    Predicts whole tile rows with a fully convolutional CNN1 (see
+    <AmfModel.fully_convolutional>). Rows are laid out as strips,
+    and each strip is predicted in a single pass.
+
+    :param model: trained CNN1 used for predictions.
+    :param image: input image (to extract tiles).
+    :param rows: indices of the rows to predict, in ascending order.
+    :param ncols: column count.
+    :param batch_size: number of tiles per batch (at least one row).
+    :return: predictions, in row order.
+    :rtype: numpy.ndarray
+    """
+
+    fcn = AmfModel.fully_convolutional(model)
+    pitch = AmfModel.TILE_PITCH
+
+    k = max(1, batch_size // ncols)
+    coords = [(r, c) for r in rows for c in range(ncols)]
+
+    results = []
+    processed = 0
+
+    AmfLog.progress_bar(0, len(coords), indent=1)
+
+    for batch, tiles in tile_stream(image, coords, k * ncols, False):
+
+        strips = AmfSegm.layout_strips(tiles, ncols, pitch)
+        strips = AmfSegm.preprocess(strips)
+
+        # (k, 1, ncols, classes) -> (k * ncols, classes)
+        prd = fcn.predict(strips, batch_size=k, verbose=0)
+        results.append(prd.reshape(-1, prd.shape[-1]))
+
+        processed += len(batch)
+        AmfLog.progress_bar(processed, len(coords), indent=1)
+
+    return np.concatenate(results)
+
+
+
+def background_tiles(image, nrows, ncols, threshold, size=8):
+    """
+    Identifies obviously empty tiles, i.e. tiles whose colours are nearly
+    uniform. Statistics are computed on a thumbnail in which each tile is
+    reduced to <size>x<size> pixels. The thumbnail is generated from a
+    separate instance of the loaded image (same resolution level, see
+    <AmfSegm.load>), so that tile extraction can still read the image
+    sequentially, and tiles are not rotated according to EXIF metadata.
+
+    :param image: input image.
+    :param nrows: row count.
+    :param ncols: column count.
+    :param threshold: maximum standard deviation of pixel values.
+    :param size: edge of reduced tiles (defaults to 8 pixels).
+    :return: boolean array of shape (nrows, ncols), True for empty tiles.
+    :rtype: numpy.ndarray
+    """
+
+    edge = AmfConfig.get('tile_edge')
+    level = AmfSegm.load(AmfSegm.filename(image), 'sequential', edge)
+    edge = AmfSegm.scaled_edge(level, edge)
+
+    # Box filter: each tile is averaged down to <size>x<size> pixels.
+    thumb = level.crop(0, 0, ncols * edge, nrows * edge)
+    thumb = thumb.shrink(edge / size, edge / size)
+    thumb = thumb.crop(0, 0, ncols * size, nrows * size)
+    thumb = np.ndarray(buffer=thumb.write_to_memory(),
+                       dtype=np.uint8,
+                       shape=[nrows, size, ncols, size, thumb.bands])
+
+    # Largest per-channel standard deviation within each tile.
+    std = thumb[..., :3].std(axis=(1, 3)).max(axis=-1)
+
+    return std < threshold
+
+
+
+def fingerprint(path):
+    """
+    Summarises the inputs which prediction tables depend on, i.e. image and
+    network contents, and prediction settings. CNN2 annotations are not
+    included, as they only determine which tiles are predicted.
+
+    :param path: path to the input image.
+    :return: fingerprint.
+    :rtype: dict
+    """
+
+    def digest(x):
+        st = os.stat(x)
+        return AmfCache.content_hash(os.path.abspath(x), st.st_mtime_ns,
+                                     st.st_size)
+
+    level = AmfConfig.get('level')
+    generator = None
+
+    if AmfConfig.get('super_resolution') and level == 1:
+
+        generator = digest(AmfConfig.get('generator'))
+
+    return {
+        'image': digest(path),
+        'model': digest(AmfConfig.get('model')),
+        'level': level,
+        'tile_edge': AmfConfig.get('tile_edge'),
+        'input_size': AmfModel.INPUT_SIZE,
+        # Quantised backends return slightly different probabilities.
+        'backend': AmfConfig.get('backend'),
+        # Whole-row predictions differ slightly from tile predictions.
+        'fully_convolutional': bool(AmfConfig.get('fully_convolutional')) \
+                               if level == 1 else None,
+        'generator': generator,
+        'background_threshold': AmfConfig.get('background_threshold') \
+                                if level == 1 else None
+    }
+
+
+
+def previous_table(path, fp):
+    """
+    Retrieves the most recent prediction table saved with the given
+    fingerprint in the auxiliary ZIP archive of an image.
+
+    :param path: path to the input image.
+    :param fp: fingerprint (see <fingerprint>).
+    :return: prediction table, or None if there is no such table.
+    :rtype: pd.DataFrame
+    """
+
+    zfile = AmfConfig.get_zipfile(path)
+
+    if not zf.is_zipfile(zfile):
+
+        return None
+
+    with zf.ZipFile(zfile) as z:
+
+        names = z.namelist()
+        prefix = AmfSave.FINGERPRINTS + '/'
+
+        # Time stamps sort in chronological order.
+        for name in sorted([x for x in names if x.startswith(prefix)],
+                           reverse=True):
+
+            uniq = os.path.splitext(os.path.basename(name))[0]
+            tsv = f'predictions/{uniq}.tsv'
+
+            if tsv in names and json.loads(z.read(name)) == fp:
+
+                data = io.StringIO(z.read(tsv).decode('utf-8'))
+                return pd.read_csv(data, sep='\t')
+
+    return None
+
+
+
+def predict_level2(path, image, nrows, ncols, model, previous=None):
     """
     Identifies AM fungal structures in colonized root segments.
     
@@ -90,6 +319,7 @@ def predict_level2(path, image, nrows, ncols, model):
     :param nrows: row count.
     :param ncols: column count.
     :para model: CNN2 model used for predictions.
+    :param previous: previous predictions to reuse (optional).
     """
    
     zfile = os.path.splitext(path)[0] + '.zip'
@@ -110,41 +340,43 @@ def predict_level2(path, image, nrows, ncols, model):
             
             # Retrieve tiles corresponding to colonized root segments.
             colonized = annotations.loc[annotations["Y"] == 1, ["row", "col"]]
-            colonized = [x for x in colonized.values.tolist()]
-
-            # Create tile batches.
-            batches = zip_longest(*(iter(colonized),) * 25)
-            nbatches = len(colonized) // 25 + int(len(colonized) % 25 != 0)
-
-            def process_batch(batch, b):
-                batch = [x for x in batch if x is not None]
-                # First, extract all tiles from the batch.
-                row = [AmfSegm.tile(image, x[0], x[1]) for x in batch]
-                row = AmfSegm.preprocess(row)
-                # Returns three prediction tables (one per class).
-                prd = model.predict(row, batch_size=25, verbose=0)
-                # Converts to a table of predictions.
-                ap = prd[0].tolist()
-                vp = prd[1].tolist()
-                hp = prd[2].tolist()       
-                ip = prd[3].tolist()
-                dat = [[a[0], v[0], h[0], i[0]] for a, v, h, i in 
-                       zip(ap, vp, hp, ip)]
-                #AmfMapping.generate(cams, model, row, batch)
-                res = [[x[0], x[1], y[0], y[1], y[2], y[3]] for (x, y) in
-                        zip(batch, dat)]
-                AmfLog.progress_bar(b, nbatches, indent=1)
-                return pd.DataFrame(res)
-
-            AmfLog.progress_bar(0, nbatches, indent=1)
-            results = [process_batch(x, b) for x, b in zip(batches, 
-                                                           range(1, nbatches + 1))]
-            
-            table = None                                       
-            if len(results) > 0:
-                table = pd.concat(results, ignore_index=True)
+            colonized = sorted([tuple(x) for x in colonized.values.tolist()])
+
+            # Reuse predictions of tiles which are still colonized.
+            reused = None
+
+            if previous is not None:
+
+                current = set(colonized)
+                done = list(zip(previous['row'], previous['col']))
+                reused = previous[[x in current for x in done]]
+                done = set(done)
+                colonized = [x for x in colonized if x not in done]
+
+                AmfLog.info(f'{len(reused)} tiles reused, {len(colonized)} '
+                            'tiles to predict', indent=1)
+
+                if colonized == [] and len(reused) == len(previous):
+
+                    reused.attrs['unchanged'] = True
+                    return (reused, None)
+
+            # Colonized tiles are streamed into full batches, regardless
+            # of row boundaries, like CNN1 tiles.
+            table = None
+
+            if colonized != []:
+
+                bs = AmfConfig.get('batch_size')
+                table = pd.DataFrame(predict_tiles(model, image, colonized, bs))
+                table.insert(0, column='col', value=[c for _, c in colonized])
+                table.insert(0, column='row', value=[r for r, _ in colonized])
                 table.columns = table_header()
 
+            if reused is not None:
+                table = pd.concat([reused, table], ignore_index=True)
+                table = table.sort_values(['row', 'col'], ignore_index=True)
+
             return (table, None) # None was cams
 
         else:
@@ -169,19 +401,68 @@ def predict_level1(image, nrows, ncols, cnn1):
     :param cnn1: trained CNN1 used for predictions.
     """
 
-    # Creates the images to save the class activation maps.
-    sr_image = AmfSRGAN.initialize(nrows, ncols)
+    sr_image = None
+    bs = AmfConfig.get('batch_size')
+    threshold = AmfConfig.get('background_threshold')
 
-    # Initialize the progress bar.
-    AmfLog.progress_bar(0, nrows, indent=1)
+    # Obviously empty tiles are not sent to the CNN.
+    if threshold is None:
 
-    # Retrieve predictions for all rows within the image.
-    bs = AmfConfig.get('batch_size')
-    results = [process_row_1(cnn1, image, nrows, ncols, bs, r, sr_image)
-               for r in range(nrows)]
+        skip = np.zeros((nrows, ncols), dtype=bool)
+
+    else:
+
+        skip = background_tiles(image, nrows, ncols, threshold)
+        x = round(100 * skip.mean())
+        AmfLog.info(f'{x}% of tiles skipped as background', indent=1)
+
+    # Empty tiles are assigned to background with probability 1.
+    header = AmfConfig.get('header')
+    predictions = np.zeros((nrows * ncols, len(header)), dtype=np.float32)
+    predictions[:, header.index('X')] = 1
+
+    # Retrieve predictions for other tiles within the image, in row order.
+    # Fully convolutional predictions require the Keras model.
+    if AmfConfig.get('fully_convolutional') and \
+       not AmfConfig.get('super_resolution') and \
+       AmfConfig.get('backend') == 'keras':
+
+        # Whole rows are predicted, unless all their tiles are empty.
+        rows = [r for r in range(nrows) if not skip[r].all()]
+
+        if rows != []:
+
+            rs = predict_strips(cnn1, image, rows, ncols, bs)
+            rs = rs.reshape(len(rows), ncols, -1)
+            grid = predictions.reshape(nrows, ncols, -1)
+            grid[rows] = np.where(skip[rows, :, None], grid[rows], rs)
 
-    # Concat to a single Pandas dataframe.
-    table = pd.concat(results, ignore_index=True)
+    else:
+
+        # Creates the image to save super-resolution tiles (if active).
+        sr_image = AmfSRGAN.initialize(nrows, ncols)
+
+        coords = [(r, c) for r in range(nrows) for c in range(ncols)
+                  if not skip[r, c]]
+
+        try:
+
+            if coords != []:
+
+                rs = predict_tiles(cnn1, image, coords, bs, sr_image)
+                predictions[~skip.reshape(-1)] = rs
+
+            # Rows without predicted tiles are not generated.
+            AmfSRGAN.blank(sr_image, [r for r in range(nrows)
+                                      if skip[r].all()])
+
+        except BaseException:
+
+            # Do not leave the canvas file behind (e.g. on Ctrl-C).
+            AmfSRGAN.discard(sr_image)
+            raise
+
+    table = pd.DataFrame(predictions)
 
     # Add row and column indexes to the Pandas data frame.
     # col_values = 0, 1, ..., c, 0, ..., c, ..., 0, ..., c; c = ncols - 1
@@ -266,51 +547,241 @@ def save_conv2d_kernels(model):
 
 
 
-def run(input_images, postprocess=None):
+def predict_image(model, path, sequential=True):
     """
-    Runs prediction on a bunch of images.
-    
-    :param input_images: input images to use for predictions.
-    :param save: indicate whether results should be saved or returned.
+    Runs prediction on a single image.
+
+    :param model: trained CNN used for predictions.
+    :param path: path to the input image.
+    :param sequential: whether to open the image in sequential mode.
+    :return: the input image, the prediction table and the super-resolution
+             image, or None if the image is too small to be tiled.
+    :rtype: tuple
     """
 
-    model = AmfModel.load()
+    base = os.path.basename(path)
+    AmfLog.text(f'Image {base}')
+
+    edge = AmfConfig.update_tile_edge(path)
+
+    image = AmfSegm.load(path, 'sequential' if sequential else 'random', edge)
+
+    nrows, ncols = AmfSegm.grid_size(image, edge)
+
+    if nrows == 0 or ncols == 0:
+
+        AmfLog.warning(f'Tile size ({edge} pixels) is too large')
+        return None
+        
+    else:
        
+        # Incremental mode reuses predictions made with the same inputs.
+        fp = fingerprint(path) if AmfConfig.get('incremental') else None
+        previous = None if fp is None else previous_table(path, fp)
+
+        if AmfConfig.get('level') == 1 and previous is not None:
+
+            AmfLog.info('Predictions are up to date', indent=1)
+            table, sr_image = previous, None
+            table.attrs['unchanged'] = True
+
+        elif AmfConfig.get('level') == 1:
+        
+            table, sr_image = predict_level1(image, nrows, ncols, model)
+
+            if AmfConfig.get('save_conv2d_outputs'):
+
+                try:
+
+                    # Layer outputs require the Keras model.
+                    keras_model = model \
+                                  if AmfConfig.get('backend') == 'keras' \
+                                  else AmfModel.load()
+                    save_conv2d_outputs(keras_model, image, base)
+
+                except BaseException:
+
+                    AmfSRGAN.discard(sr_image)
+                    raise
+
+        else:
+
+            table, sr_image = predict_level2(path, image, nrows, ncols, model,
+                                             previous)
+
+        # The fingerprint is saved along with the table.
+        if table is not None and fp is not None:
+
+            table.attrs['fingerprint'] = fp
+
+        return (image, table, sr_image)
+
+
+
+# Model used by worker processes.
+WORKER_MODEL = None
+
+def init_worker(settings, threads, canvas_dir=None):
+    """
+    Initialises a worker process: restores user settings, limits the number
+    of TensorFlow threads, and loads the model once.
+
+    :param settings: user settings of the parent process.
+    :param threads: number of threads available to the worker.
+    :param canvas_dir: folder of super-resolution canvases (optional).
+    """
+
+    global WORKER_MODEL
+
+    # Worker output would interleave with the parent process output.
+    sys.stdout = open(os.devnull, 'w')
+
+    AmfConfig.PAR.update(settings)
+    AmfSRGAN.CANVAS_DIR = canvas_dir
+
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    WORKER_MODEL = AmfBackend.load(threads=threads)
+
+
+
+def run_worker(path):
+    """
+    Runs prediction on a single image in a worker process.
+
+    :param path: path to the input image.
+    :return: the image path, the settings needed to save predictions, the
+             prediction table and the super-resolution image.
+    :rtype: tuple
+    """
+
+    sequential = not AmfConfig.get('save_conv2d_outputs')
+    result = predict_image(WORKER_MODEL, path, sequential)
+    settings = {'level': AmfConfig.get('level'),
+                'tile_edge': AmfConfig.get('tile_edge')}
+
+    if result is None:
+
+        return (path, settings, None, None)
+
+    else:
+
+        _, table, sr_image = result
+
+        # Canvases are memory-mapped files: only their path is sent back.
+        if sr_image is not None:
+
+            sr_image.flush()
+            sr_image = sr_image.filename
+
+        return (path, settings, table, sr_image)
+
+
+
+def run_parallel(input_images, workers):
+    """
+    Spreads images across a pool of worker processes. Each worker loads the
+    model once, and sends its prediction tables back to the parent process,
+    which saves them one at a time.
+
+    :param input_images: input images to use for predictions.
+    :param workers: number of worker processes.
+    """
+
     if AmfConfig.get('save_conv2d_kernels'):
     
-        save_conv2d_kernels(model)
+        save_conv2d_kernels(AmfModel.load())
 
+    AmfLog.text(f'Workers: {workers}')
 
-    for path in input_images:
+    # Networks are converted once, before workers start.
+    if AmfConfig.get('backend') != 'keras':
 
-        base = os.path.basename(path)
-        AmfLog.text(f'Image {base}')
+        AmfBackend.export(input_images)
 
-        edge = AmfConfig.update_tile_edge(path)
+    # Prevents workers from oversubscribing CPU cores.
+    threads = max(1, (os.cpu_count() or 1) // workers)
 
-        image = AmfSegm.load(path)
+    # TensorFlow does not support fork after initialisation.
+    context = mp.get_context('spawn')
 
-        nrows = image.height // edge
-        ncols = image.width // edge
+    # Worker canvases are removed along with this folder, even if the pool
+    # fails or is interrupted while workers are still running.
+    with tempfile.TemporaryDirectory(prefix='amfinder-sr-') as canvas_dir, \
+         context.Pool(workers, initializer=init_worker,
+                      initargs=(AmfConfig.PAR, threads, canvas_dir)) as pool:
 
-        if nrows == 0 or ncols == 0:
+        for path, settings, table, sr_image in pool.imap_unordered(run_worker,
+                                                                   input_images):
 
-            AmfLog.warning('Tile size ({edge} pixels) is too large')
-            continue
-            
-        else:
-           
-            if AmfConfig.get('level') == 1:
-            
-                table, sr_image = predict_level1(image, nrows, ncols, model)
+            base = os.path.basename(path)
+            AmfLog.text(f'Image {base}')
 
-                if AmfConfig.get('save_conv2d_outputs'):
+            for key, value in settings.items():
 
-                    save_conv2d_outputs(model, image, base) 
+                AmfConfig.set(key, value)
 
-            else:
+            if sr_image is not None:
+
+                sr_image = AmfSRGAN.reopen(sr_image)
+
+            try:
+
+                # ZIP archives are only written by the parent process.
+                AmfSave.prediction_table(table, sr_image, path)
+
+            finally:
 
-                table, sr_image = predict_level2(path, image, nrows, ncols, model)               
+                AmfSRGAN.discard(sr_image)
+
+
+
+def run(input_images, postprocess=None, model=None):
+    """
+    Runs prediction on a bunch of images.
+    
+    :param input_images: input images to use for predictions.
+    :param postprocess: continuation function applied to predictions
+                        (default: predictions are saved).
+    :param model: pre-loaded model (default: load the model from settings).
+    """
+
+    workers = min(AmfConfig.get('workers'), len(input_images))
+
+    # Continuations need predictions in the current process.
+    if postprocess is None and model is None and workers > 1:
+
+        run_parallel(input_images, workers)
+        return
+
+    if model is None:
+
+        model = AmfBackend.load(input_images)
+       
+    if AmfConfig.get('save_conv2d_kernels'):
+
+        # Kernels require the Keras model.
+        keras_model = model if AmfConfig.get('backend') == 'keras' \
+                      else AmfModel.load()
+        save_conv2d_kernels(keras_model)
+
+    # Tiles are extracted row by row, unless random access is required
+    # by continuations or to save conv2d outputs.
+    sequential = postprocess is None and \
+                 not AmfConfig.get('save_conv2d_outputs')
+
+    for path in input_images:
+
+        result = predict_image(model, path, sequential)
+
+        if result is None:
+
+            continue
+
+        image, table, sr_image = result
+
+        try:
 
             # Save results or use continuation for further processing.
             if postprocess is None:
@@ -321,3 +792,7 @@ def run(input_images, postprocess=None):
             else:
             
                 postprocess(image, table, path)
+
+        finally:
+
+            AmfSRGAN.discard(sr_image)
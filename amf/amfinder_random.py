@@ -0,0 +1,100 @@
+# AMFinder - amfinder_random.py
+#
+# MIT License
+# Copyright (c) 2021 Edouard Evangelisti, Carl Turner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+"""
+Random number generation.
+
+All random choices made during training (background subsampling, dataset
+split, shuffling, data augmentation, super-resolution tile sampling) are
+drawn from numpy.random.Generator streams derived from a single run seed.
+Each stream is identified by a purpose and optional integer keys (e.g.
+epoch and batch index), so that a given batch always receives the same
+random numbers, whichever data loader process prepares it.
+
+Constants
+-----------
+SUBSAMPLING - Stream used to discard background tiles.
+SPLIT - Stream used to split training and validation datasets.
+SHUFFLE - Stream used to shuffle tiles between epochs.
+AUGMENTATION - Stream used for data augmentation.
+SUPER_RESOLUTION - Stream used to sample super-resolution tiles.
+
+Functions
+------------
+:function seed: Returns the run seed.
+:function generator: Returns the random number generator of a stream.
+:function state: Returns an integer drawn from a stream.
+"""
+
+import numpy as np
+
+import amfinder_config as AmfConfig
+
+
+
+SUBSAMPLING = 0
+SPLIT = 1
+SHUFFLE = 2
+AUGMENTATION = 3
+SUPER_RESOLUTION = 4
+
+
+
+def seed():
+    """
+    Returns the run seed.
+    """
+
+    return AmfConfig.get('seed')
+
+
+
+def generator(stream, *keys):
+    """
+    Returns an independent random number generator for the given stream.
+    Generators created with the same run seed, stream and keys produce
+    identical sequences, while distinct streams or keys do not overlap.
+
+    :param stream: Stream identifier (e.g. AUGMENTATION).
+    :param keys: Additional non-negative integers (e.g. epoch, batch index).
+    :return: Random number generator.
+    :rtype: numpy.random.Generator
+    """
+
+    return np.random.default_rng([seed(), stream, *keys])
+
+
+
+def state(stream, *keys):
+    """
+    Returns an integer drawn from the given stream, for use with libraries
+    which expect an integer seed (e.g. scikit-learn).
+
+    :param stream: Stream identifier.
+    :param keys: Additional non-negative integers.
+    :return: 32-bit unsigned integer.
+    :rtype: int
+    """
+
+    return int(generator(stream, *keys).integers(2 ** 32))
@@ -30,27 +30,29 @@ Functions
 :function now: Returns the current date/time.
 :function training_data: Saves training weights, history and plots.
 :function get_zip_info: Creates a ZIP information object.
+:function save_sr_image: Saves a super-resolution image.
 :function save_settings: Saves image settings.
+:function save_fingerprint: Saves the fingerprint of a prediction table.
 :function prediction_table: Saves or append predictions to an archive.
 """
 
 import os
-import io
 import json
-import h5py
 import pickle
+import shutil
+import tempfile
 import datetime
 import numpy as np
 import amfinder_zipfile as zf
-import matplotlib as plt
 
 import amfinder_log as AmfLog
-import amfinder_plot as AmfPlot
-import amfinder_model as AmfModel
 import amfinder_config as AmfConfig
 
 CORRUPTED_ARCHIVE = 30
 IMG_SETTINGS = 'settings.json'
+FINGERPRINTS = 'fingerprints'
+# Largest image edge supported by the JPEG format.
+JPEG_MAX_EDGE = 65535
 
 
 
@@ -72,6 +74,10 @@ def training_data(history, model):
     :param model: The CNN model that was used for training.
     """
 
+    # Only required in training mode.
+    import h5py
+    import amfinder_plot as AmfPlot
+
     zipf = now() + '_training.zip'
     zipf = os.path.join(AmfConfig.get('outdir'), zipf)
 
@@ -156,11 +162,47 @@ def get_zip_info(path, comment):
 
 
 def save_sr_image(uniq, z, sr_image):
-    buf = io.BytesIO()
-    plt.image.imsave(buf, sr_image, format='jpg')
+    """
+    Saves a super-resolution image. The image is encoded strip by strip
+    from the (memory-mapped) canvas and streamed to the archive, so that
+    neither the image nor its encoded copy are held in memory. Images
+    too large for the JPEG format are saved as tiled, pyramidal TIFF.
+
+    :param uniq: unique identifier of the prediction table.
+    :param z: ZIP archive.
+    :param sr_image: super-resolution canvas.
+    """
+
+    # Only required in super-resolution mode.
+    import pyvips
+
+    height, width, bands = sr_image.shape
+    image = pyvips.Image.new_from_memory(sr_image, width, height, bands,
+                                         'uchar')
     comment = os.path.basename(AmfConfig.get('generator'))
-    zi = get_zip_info(f'sr/{uniq}.jpg', comment)
-    z.writestr(zi, buf.getvalue())
+
+    if max(width, height) <= JPEG_MAX_EDGE:
+
+        zi = get_zip_info(f'sr/{uniq}.jpg', comment)
+
+        with z.open(zi, mode='w', force_zip64=True) as s:
+            target = pyvips.TargetCustom()
+            target.on_write(s.write)
+            image.jpegsave_target(target)
+
+    else:
+
+        # TIFF encoding needs a seekable output.
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'sr.tif')
+            image.tiffsave(path, tile=True, pyramid=True, bigtiff=True,
+                           compression='jpeg')
+            zi = get_zip_info(f'sr/{uniq}.tif', comment)
+            zi.compress_type = zf.ZIP_STORED
+
+            with open(path, 'rb') as f, \
+                 z.open(zi, mode='w', force_zip64=True) as s:
+                shutil.copyfileobj(f, s, 1 << 20)
 
 
 
@@ -182,6 +224,22 @@ def save_settings(z):
 
 
 
+def save_fingerprint(uniq, z, fp):
+    """
+    Saves the fingerprint of a prediction table (see AmfPredict.fingerprint),
+    so that incremental predictions can reuse the table. Fingerprints are
+    not stored in the predictions folder, which only contains tables.
+
+    :param uniq: unique identifier of the prediction table.
+    :param z: ZIP archive.
+    :param fp: fingerprint.
+    """
+
+    zi = get_zip_info(f'{FINGERPRINTS}/{uniq}.json', AmfConfig.string_of_level())
+    z.writestr(zi, json.dumps(fp))
+
+
+
 def prediction_table(results, sr_image, path):
     """
     Saves or append predictions to an archive.
@@ -191,9 +249,13 @@ def prediction_table(results, sr_image, path):
     :param path: path to the ZIP archive.
     """
 
-    if results is not None:
+    if results is not None and results.attrs.get('unchanged'):
 
-        zipf = '{}.zip'.format(os.path.splitext(path)[0])
+        print('    - predictions are up to date.')
+
+    elif results is not None:
+
+        zipf = AmfConfig.get_zipfile(path)
         print(f'    - saving as {zipf}... ', end='')
 
         uniq = now()
@@ -213,6 +275,9 @@ def prediction_table(results, sr_image, path):
                     
                     if sr_image is not None:
                         save_sr_image(uniq, z, sr_image)
+
+                    if 'fingerprint' in results.attrs:
+                        save_fingerprint(uniq, z, results.attrs['fingerprint'])
         
             else:
 
@@ -227,5 +292,7 @@ def prediction_table(results, sr_image, path):
                 z.writestr(zi, data)
                 if sr_image is not None:
                     save_sr_image(uniq, z, sr_image)
+                if 'fingerprint' in results.attrs:
+                    save_fingerprint(uniq, z, results.attrs['fingerprint'])
 
         print('OK')
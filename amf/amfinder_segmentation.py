@@ -29,18 +29,40 @@ Crop tiles (squares) and apply diverse image modifications.
 Constants
 -----------
 INTERPOLATION - Interpolation mode for image resizing.
+SHRINK - Name of the image metadata storing the downsampling factor of
+         an image loaded at reduced resolution.
+WIDTH, HEIGHT - Names of the image metadata storing the full resolution
+                size of an image loaded at reduced resolution.
+PATH - Name of the image metadata storing the path of an image loaded at
+       reduced resolution.
 
 Functions
 ------------
+:function shrink_factor: Returns the shrink-on-load factor of a tile edge.
+:function downsampled: Marks an image as loaded at reduced resolution.
+:function pyramid_level: Opens a reduced resolution level of a TIFF image.
+:function load: Loads an image using the vips library.
+:function scaled_edge: Returns the tile edge within a loaded image.
+:function base_size: Returns the full resolution size of a loaded image.
+:function filename: Returns the path of the file an image was loaded from.
+:function grid_size: Returns the row and column counts of an image.
+:function tile_size: Returns the size of extracted tiles.
 :function tile: Extracts a tile from a large image.
+:function strips: Extracts whole tile rows from a large image.
+:function rebatch: Regroups tiles streamed row by row into batches.
+:function batches: Streams tiles from a large image as fixed-size batches.
+:function layout_strips: Lays out whole tile rows side by side.
+:function prefetch: Produces items in a background thread.
 :function preprocess: Convert a tile list to NumPy array and normalise pixels.
 """
 
+import queue
 import pyvips
-import random
-random.seed(42)
+import threading
 import numpy as np
+from itertools import groupby
 
+import amfinder_log as AmfLog
 import amfinder_model as AmfModel
 import amfinder_config as AmfConfig
 
@@ -49,15 +71,245 @@ import amfinder_config as AmfConfig
 # Not the best quality, but optimized for speed.
 # To check availability, type in a terminal: vips -l interpolate
 INTERPOLATION = pyvips.vinterpolate.Interpolate.new('nearest')
+SHRINK = 'amfinder-shrink'
+WIDTH = 'amfinder-width'
+HEIGHT = 'amfinder-height'
+PATH = 'amfinder-path'
 
 
 
-def load(image_path, access='random'):
+def shrink_factor(edge):
     """
-    Loads an image using the vips library.
+    Returns the largest JPEG shrink-on-load factor (2, 4 or 8) which keeps
+    tiles at least as large as extracted tiles, and tile boundaries on
+    whole pixels. Returns 1 if tiles cannot be shrunk.
+
+    :param edge: Tile edge, in pixels.
+    :return: Shrink factor.
+    :rtype: int
+    """
+
+    size = tile_size()
+
+    for shrink in [8, 4, 2]:
+
+        if edge % shrink == 0 and edge // shrink >= size:
+
+            return shrink
+
+    return 1
+
+
+
+def downsampled(image, shrink, width, height):
+    """
+    Records the downsampling factor and the full resolution size of an
+    image loaded at reduced resolution, for use by tile extraction
+    functions. The size of the loaded image may be rounded up, so that
+    the tile grid is always computed from the full resolution size.
+    The image path is also recorded, as copies do not keep it (see
+    <filename>).
+
+    :param image: The loaded image.
+    :param shrink: Downsampling factor.
+    :param width: Full resolution width.
+    :param height: Full resolution height.
+    :return: The image, with metadata.
+    :rtype: pyvips.Image
+    """
+
+    if shrink == 1:
+
+        return image
+
+    path = image.filename
+    image = image.copy()
+    image.set_type(pyvips.GValue.gint_type, SHRINK, shrink)
+    image.set_type(pyvips.GValue.gint_type, WIDTH, width)
+    image.set_type(pyvips.GValue.gint_type, HEIGHT, height)
+    image.set_type(pyvips.GValue.gstr_type, PATH, path)
+    return image
+
+
+
+def pyramid_level(image_path, image, access, edge):
+    """
+    Opens the lowest resolution level of a pyramidal TIFF image (either as
+    pages, or as OME-TIFF sub-IFDs) that still provides at least as many
+    pixels per tile as extracted tiles, and keeps tile boundaries on whole
+    pixels. Only levels downsampled by an integer factor are considered.
+    The tile grid remains that of the base level (see <grid_size>).
+
+    :param image_path: Path to the image.
+    :param image: Base level of the image.
+    :param access: Access mode.
+    :param edge: Tile edge in the base level.
+    :return: The selected level.
+    :rtype: pyvips.Image
+    """
+
+    size = tile_size()
+
+    if image.get_typeof('n-subifds') != 0 and image.get('n-subifds') > 0:
+
+        levels = [{'subifd': i} for i in range(image.get('n-subifds'))]
+
+    elif image.get_typeof('n-pages') != 0:
+
+        levels = [{'page': i} for i in range(1, image.get('n-pages'))]
+
+    else:
+
+        levels = []
+
+    best, best_shrink = image, 1
+
+    # The tile grid is always defined on the base level.
+    nrows, ncols = image.height // edge, image.width // edge
+
+    for options in levels:
+
+        level = pyvips.Image.new_from_file(image_path, access=access,
+                                           **options)
+        shrink = round(image.width / level.width)
+
+        # Other pages may contain unrelated images (e.g. slide labels).
+        # Levels may be rounded either way, but must cover the grid.
+        if shrink > best_shrink and edge % shrink == 0 and \
+           edge // shrink >= size and \
+           abs(image.width / shrink - level.width) <= 1 and \
+           abs(image.height / shrink - level.height) <= 1 and \
+           level.width >= ncols * (edge // shrink) and \
+           level.height >= nrows * (edge // shrink):
+
+            best, best_shrink = level, shrink
+
+    return downsampled(best, best_shrink, image.width, image.height)
+
+
+
+def load(image_path, access='random', edge=None):
+    """
+    Loads an image using the vips library. Use sequential access when tiles
+    are extracted with <strips> or <batches> only. When the tile edge is
+    given and tiles are larger than extracted tiles, images are loaded at
+    reduced resolution: JPEG images are shrunk while being decoded (libjpeg
+    DCT scaling), and the most suitable level of pyramidal TIFF images is
+    used (see <pyramid_level>). Tile extraction functions read the
+    downsampling factor from image metadata (see <scaled_edge>), so that
+    tile coordinates always refer to the full resolution image.
+    """
+
+    image = pyvips.Image.new_from_file(image_path, access=access)
+
+    if edge is None:
+
+        return image
+
+    loader = image.get('vips-loader')
+
+    if loader == 'jpegload':
+
+        shrink = shrink_factor(edge)
+        width, height = image.width, image.height
+
+        if shrink > 1:
+
+            image = pyvips.Image.new_from_file(image_path, access=access,
+                                               shrink=shrink)
+
+        return downsampled(image, shrink, width, height)
+
+    elif loader == 'tiffload':
+
+        return pyramid_level(image_path, image, access, edge)
+
+    else:
+
+        return image
+
+
+
+def scaled_edge(image, edge):
+    """
+    Returns the tile edge within a loaded image, which may have been
+    loaded at reduced resolution (see <load>).
+
+    :param image: The source image.
+    :param edge: Tile edge in the original image.
+    :return: Tile edge in the loaded image.
+    :rtype: int
+    """
+
+    if image.get_typeof(SHRINK) != 0:
+
+        return edge // image.get(SHRINK)
+
+    return edge
+
+
+
+def base_size(image):
+    """
+    Returns the full resolution size of an image, which may have been
+    loaded at reduced resolution (see <load>).
+
+    :param image: The source image.
+    :return: Width and height.
+    :rtype: tuple
+    """
+
+    if image.get_typeof(WIDTH) != 0:
+
+        return (image.get(WIDTH), image.get(HEIGHT))
+
+    return (image.width, image.height)
+
+
+
+def filename(image):
+    """
+    Returns the path of the file an image was loaded from, including when
+    it was loaded at reduced resolution (see <load>).
+
+    :param image: The source image.
+    :return: Path to the image file.
+    :rtype: str
+    """
+
+    if image.get_typeof(PATH) != 0:
+
+        return image.get(PATH)
+
+    return image.filename
+
+
+
+def grid_size(image, edge=None):
+    """
+    Returns the row and column counts of the tile grid of an image, based
+    on its full resolution size.
+
+    :param image: The source image.
+    :param edge: Tile edge (defaults to the current tile edge).
+    :return: Row and column counts.
+    :rtype: tuple
+    """
+
+    edge = edge if edge is not None else AmfConfig.get('tile_edge')
+    width, height = base_size(image)
+
+    return (height // edge, width // edge)
+
+
+
+def tile_size():
+    """
+    Returns the size of extracted tiles, i.e. 42 pixels in super-resolution
+    mode, or the CNN input size otherwise.
     """
 
-    return pyvips.Image.new_from_file(image_path, access=access)
+    return 42 if AmfConfig.get('super_resolution') else AmfModel.INPUT_SIZE
 
 
 
@@ -75,20 +327,16 @@ def tile(image, r, c, edge=None):
     """
 
     edge = edge if edge is not None else AmfConfig.get('tile_edge')
+    edge = scaled_edge(image, edge)
     tile = image.crop(c * edge, r * edge, edge, edge)
 
     # In super-resolution mode, ensure the tile is 42x42 pixels.
-    if AmfConfig.get('super_resolution'):
-      
-        if edge != 42:
-        
-            ratio = 42 / edge
-            tile = tile.resize(ratio, interpolate=INTERPOLATION)
-    
     # Otherwise, use interpolation to bring tile to 126x126 pixels.
-    elif AmfModel.INPUT_SIZE != edge:
+    size = tile_size()
+
+    if size != edge:
 
-        ratio = AmfModel.INPUT_SIZE / edge
+        ratio = size / edge
         tile = tile.resize(ratio, interpolate=INTERPOLATION)
 
     return np.ndarray(buffer=tile.write_to_memory(),
@@ -97,6 +345,213 @@ def tile(image, r, c, edge=None):
 
 
 
+def strips(image, rows=None, edge=None):
+    """
+    Extracts whole tile rows (strips) from a large image. The tile grid is
+    resized once, and each strip is read in a single pass then sliced into
+    tiles without copying. Rows must be given in ascending order, so that
+    images can be opened in sequential mode.
+
+    :param image: The source image used to extract tiles.
+    :param rows: Indices of the rows to extract (defaults to all rows).
+    :param edge: Tile edge (defaults to the current tile edge).
+    :return: Generator of (row, tiles) pairs, where tiles is an array
+             of shape (ncols, size, size, bands).
+    :rtype: generator
+    """
+
+    edge = edge if edge is not None else AmfConfig.get('tile_edge')
+    nrows, ncols = grid_size(image, edge)
+    edge = scaled_edge(image, edge)
+    size = tile_size()
+
+    rows = range(nrows) if rows is None else rows
+
+    if nrows == 0 or ncols == 0:
+
+        return
+
+    grid = image.crop(0, 0, ncols * edge, nrows * edge)
+
+    if size != edge:
+
+        # Explicit scales ensure the output is exactly a multiple of <size>.
+        grid = grid.resize(ncols * size / grid.width,
+                           vscale=nrows * size / grid.height,
+                           interpolate=INTERPOLATION)
+
+    # A single pipeline is used for all strips.
+    region = pyvips.Region.new(grid)
+
+    for r in rows:
+
+        data = region.fetch(0, r * size, ncols * size, size)
+        strip = np.ndarray(buffer=data,
+                           dtype=np.uint8,
+                           shape=[size, ncols, size, grid.bands])
+
+        # (size, ncols, size, bands) -> (ncols, size, size, bands)
+        yield r, strip.transpose(1, 0, 2, 3)
+
+
+
+def rebatch(coords, strips, batch_size):
+    """
+    Regroups tiles streamed row by row into fixed-size batches. Batches are
+    independent of row boundaries, i.e. a batch may contain tiles from
+    consecutive rows. The last batch may be smaller than <batch_size>.
+
+    :param coords: List of (row, column) pairs of the tiles to extract,
+                   sorted by row.
+    :param strips: Iterable of (row, tiles) pairs covering the rows of
+                   <coords> in ascending order, where tiles is an array of
+                   shape (ncols, size, size, bands).
+    :param batch_size: Number of tiles per batch.
+    :return: Generator of (coordinates, tiles) pairs.
+    :rtype: generator
+    """
+
+    groups = [(r, [x[1] for x in g]) for r, g in groupby(coords,
+                                                         key=lambda x: x[0])]
+
+    pending_coords = []
+    pending_tiles = []
+
+    for (r, cols), (_, strip) in zip(groups, strips):
+
+        pending_coords.extend([(r, c) for c in cols])
+        pending_tiles.append(strip[cols])
+
+        if len(pending_coords) >= batch_size:
+
+            tiles = np.concatenate(pending_tiles)
+            n = len(tiles) // batch_size * batch_size
+
+            for i in range(0, n, batch_size):
+
+                yield pending_coords[i:i + batch_size], tiles[i:i + batch_size]
+
+            pending_coords = pending_coords[n:]
+            pending_tiles = [tiles[n:]]
+
+    if pending_coords != []:
+
+        yield pending_coords, np.concatenate(pending_tiles)
+
+
+
+def batches(image, coords, batch_size, edge=None):
+    """
+    Streams tiles from a large image as fixed-size batches (see <rebatch>).
+
+    :param image: The source image used to extract tiles.
+    :param coords: List of (row, column) pairs of the tiles to extract,
+                   sorted by row.
+    :param batch_size: Number of tiles per batch.
+    :param edge: Tile edge (defaults to the current tile edge).
+    :return: Generator of (coordinates, tiles) pairs.
+    :rtype: generator
+    """
+
+    rows = sorted(set([r for r, _ in coords]))
+
+    yield from rebatch(coords, strips(image, rows, edge), batch_size)
+
+
+
+def layout_strips(tiles, ncols, pitch):
+    """
+    Lays out whole tile rows as image strips, in which consecutive tiles
+    start every <pitch> pixels. Gaps between tiles are filled with zeros.
+
+    :param tiles: Tiles of consecutive rows, of shape (k * ncols, size,
+                  size, bands).
+    :param ncols: Column count.
+    :param pitch: Distance (in pixels) between consecutive tiles.
+    :return: Array of shape (k, size, ncols * pitch, bands).
+    :rtype: numpy.ndarray
+    """
+
+    n, size, _, bands = tiles.shape
+    k = n // ncols
+
+    strips = np.zeros((k, size, ncols, pitch, bands), dtype=tiles.dtype)
+    # (k, ncols, size, size, bands) -> (k, size, ncols, size, bands)
+    strips[..., :size, :] = tiles.reshape(k, ncols, size, size, bands) \
+                                 .transpose(0, 2, 1, 3, 4)
+
+    return strips.reshape(k, size, ncols * pitch, bands)
+
+
+
+def prefetch(iterable, depth):
+    """
+    Consumes an iterable in a background thread, so that the next items
+    (e.g. tile batches) are produced while the current one is processed.
+    pyvips and NumPy release the GIL, so tile extraction overlaps with
+    CNN predictions. At most <depth> items are buffered to cap memory use.
+
+    :param iterable: The iterable to consume (e.g. a <batches> generator).
+    :param depth: Maximum number of buffered items (0: no background thread).
+    :return: Generator yielding the same items as <iterable>, in order.
+    :rtype: generator
+    """
+
+    if depth <= 0:
+
+        yield from iterable
+        return
+
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        # Gives up when the consumer has stopped early.
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer():
+        try:
+            for x in iterable:
+                if not put((True, x)):
+                    return
+            put((False, None))
+        except Exception as err:
+            put((False, err))
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+
+    try:
+
+        while True:
+
+            active, x = buffer.get()
+
+            if active:
+
+                yield x
+
+            elif x is None:
+
+                break
+
+            else:
+
+                raise x
+
+    finally:
+
+        stop.set()
+        thread.join()
+
+
+
 def preprocess(tile_list):
     """
     Preprocess a list of tiles.
@@ -106,31 +561,32 @@ def preprocess(tile_list):
     :rtype: numpy.ndarray
     """
     
-    return np.array(tile_list, np.float32) / 255.0
+    # In-place division avoids an extra float32 copy.
+    tiles = np.array(tile_list, np.float32)
+    tiles /= 255.0
+    return tiles
 
 
 
 def mosaic(image, edge=None):
+    """
+    Extracts all tiles from a large image, row by row.
+
+    :param image: The source image used to extract tiles.
+    :param edge: Tile edge (defaults to the current tile edge).
+    :return: List of tiles, converted to numpy arrays.
+    :rtype: list
+    """
 
     edge = edge if edge is not None else AmfConfig.get('tile_edge')
 
-    nrows = int(image.height // edge)
-    ncols = int(image.width // edge)
+    nrows, ncols = grid_size(image, edge)
 
     if nrows == 0 or ncols == 0:
 
-        AmfLog.warning('Tile size ({edge} pixels) is too large')
+        AmfLog.warning(f'Tile size ({edge} pixels) is too large')
         return None
         
     else:
 
-        tiles = []
-
-        for r in range(nrows):
-
-            for c in range(ncols):
- 
-                tiles.append(tile(image, r, c, edge))
-
-        return tiles
-
+        return [x for _, strip in strips(image, edge=edge) for x in strip]
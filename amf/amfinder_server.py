@@ -0,0 +1,424 @@
+# AMFinder - amfinder_server.py
+#
+# MIT License
+# Copyright (c) 2021 Edouard Evangelisti, Carl Turner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Prediction daemon.
+
+Keeps pre-trained networks in memory and runs prediction jobs submitted
+by `amf predict` over a local UNIX socket. This avoids paying TensorFlow
+start-up, model loading and graph tracing costs on every invocation. Jobs
+are processed one at a time, and their output is streamed back to the
+client. Heavy modules are only imported by the daemon, so that the client
+starts quickly.
+
+Constants
+-----------
+END_OF_JOB - Marker sent after the output of a job, followed by its exit code.
+
+Functions
+------------
+:function socket_dir: Returns a private folder for the daemon socket.
+:function socket_path: Returns the path to the daemon socket.
+:function peer_uid: Returns the user ID of the process on the other end.
+:function owned: Indicates whether a socket belongs to the current user.
+:function submit: Submits a prediction job to a running daemon.
+:function get_model: Returns a resident model.
+:function run_job: Runs a prediction job received from a client.
+:function accept_job: Runs a job, unless the client is run by another user.
+:function serve: Runs the prediction daemon.
+"""
+
+import os
+import sys
+import copy
+import json
+import stat
+import struct
+import socket
+import tempfile
+import traceback
+from contextlib import redirect_stdout
+from contextlib import redirect_stderr
+
+import amfinder_log as AmfLog
+import amfinder_config as AmfConfig
+
+
+
+END_OF_JOB = '\0'
+
+# Resident models, indexed by path.
+MODELS = {}
+
+
+
+def socket_dir():
+    """
+    Returns a folder that only the current user can access, i.e.
+    $XDG_RUNTIME_DIR, or a private (0700) folder in the temporary folder.
+    """
+
+    path = os.environ.get('XDG_RUNTIME_DIR')
+
+    if path is None or not os.path.isdir(path):
+
+        path = os.path.join(tempfile.gettempdir(), f'amfinder-{os.getuid()}')
+
+        try:
+
+            os.mkdir(path, 0o700)
+
+        except FileExistsError:
+
+            pass
+
+    st = os.lstat(path)
+
+    # Another user may have created the folder first.
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or \
+       stat.S_IMODE(st.st_mode) & 0o077:
+
+        AmfLog.error(f'Unsafe socket folder {path} (not private)',
+                     AmfLog.ERR_UNSAFE_SOCKET)
+
+    return path
+
+
+
+def socket_path():
+    """
+    Returns the path to the daemon socket.
+    """
+
+    path = AmfConfig.get('socket')
+
+    if path is None:
+
+        path = os.path.join(socket_dir(), 'amfinder.sock')
+
+    return path
+
+
+
+def peer_uid(conn):
+    """
+    Returns the user ID of the process on the other end of a connection,
+    or None if the platform does not provide it.
+
+    :param conn: connected UNIX socket.
+    :rtype: int
+    """
+
+    if not hasattr(socket, 'SO_PEERCRED'):
+
+        return None
+
+    size = struct.calcsize('3i')
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, size)
+    _, uid, _ = struct.unpack('3i', creds)
+
+    return uid
+
+
+
+def owned(path):
+    """
+    Indicates whether a socket belongs to the current user.
+
+    :param path: path to the socket.
+    :rtype: bool
+    """
+
+    st = os.lstat(path)
+
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid()
+
+
+
+def submit(input_files):
+    """
+    Submits a prediction job to a running daemon, and prints its output.
+
+    :param input_files: input images to use for predictions.
+    :return: the job exit code, or None if no daemon is running.
+    :rtype: int
+    """
+
+    path = socket_path()
+
+    if not os.path.exists(path):
+
+        return None
+
+    # Never send jobs to a daemon run by another user.
+    if not owned(path):
+
+        AmfLog.warning(f'Ignoring socket {path} (owned by another user)')
+        return None
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+
+        client.connect(path)
+
+    except OSError:
+
+        # Stale socket file: fall back to in-process predictions.
+        client.close()
+        return None
+
+    uid = peer_uid(client)
+
+    if uid is not None and uid != os.getuid():
+
+        AmfLog.warning(f'Ignoring daemon on {path} (run by another user)')
+        client.close()
+        return None
+
+    with client:
+
+        job = {'settings': AmfConfig.PAR, 'images': input_files}
+        client.sendall((json.dumps(job) + '\n').encode('utf-8'))
+        client.shutdown(socket.SHUT_WR)
+
+        AmfLog.text(f'Job submitted to {path}')
+
+        with client.makefile('r', encoding='utf-8', newline='') as stream:
+
+            while True:
+
+                data = stream.read(1)
+
+                if data == '':
+
+                    AmfLog.warning('Connection to prediction daemon lost')
+                    return 1
+
+                elif data == END_OF_JOB:
+
+                    break
+
+                sys.stdout.write(data)
+
+                if data in '\r\n':
+
+                    sys.stdout.flush()
+
+            code = stream.read()
+
+        return int(code) if code.strip().isdigit() else 1
+
+
+
+def get_model():
+    """
+    Returns the model given in settings, loading it on first use only.
+    """
+
+    import amfinder_model as AmfModel
+
+    path = AmfConfig.get('model')
+
+    if path in MODELS:
+
+        AmfLog.text(f'Model: {path}')
+        AmfModel.configure(MODELS[path])
+
+    else:
+
+        MODELS[path] = AmfModel.inference(AmfModel.load())
+
+    return MODELS[path]
+
+
+
+def run_job(conn):
+    """
+    Runs a prediction job received from a client, and streams its output
+    back to the client.
+
+    :param conn: client connection.
+    """
+
+    import amfinder_predict as AmfPredict
+
+    with conn.makefile('r', encoding='utf-8') as request:
+
+        job = json.loads(request.readline())
+
+    stream = conn.makefile('w', encoding='utf-8', buffering=1)
+    code = 0
+
+    # Job settings must not leak into the next job.
+    settings = copy.deepcopy(AmfConfig.PAR)
+
+    try:
+
+        with redirect_stdout(stream), redirect_stderr(stream):
+
+            try:
+
+                AmfConfig.PAR.update(job['settings'])
+
+                # Resident models are used by the daemon process only.
+                if AmfConfig.get('backend') != 'keras':
+
+                    AmfLog.warning('The daemon ignores --backend (uses keras)')
+
+                if AmfConfig.get('workers') > 1:
+
+                    AmfLog.warning('The daemon ignores --workers (uses 1)')
+
+                AmfConfig.set('workers', 1)
+                AmfConfig.set('backend', 'keras')
+                AmfPredict.run(job['images'], model=get_model())
+
+            except SystemExit as err:
+
+                code = err.code if isinstance(err.code, int) else 1
+
+            except Exception:
+
+                traceback.print_exc()
+                code = 1
+
+        stream.write(f'{END_OF_JOB}{code}')
+        stream.flush()
+
+    except OSError:
+
+        print(f'{AmfLog.invite()} WARNING: Client disconnected.', file=sys.stderr)
+
+    finally:
+
+        stream.close()
+        AmfConfig.PAR.clear()
+        AmfConfig.PAR.update(settings)
+
+
+
+def accept_job(conn):
+    """
+    Runs a prediction job received from a client, unless the client is
+    run by another user.
+
+    :param conn: client connection.
+    :return: whether the job was run.
+    :rtype: bool
+    """
+
+    uid = peer_uid(conn)
+
+    if uid is not None and uid != os.getuid():
+
+        AmfLog.warning(f'Rejected job from user {uid}')
+        return False
+
+    run_job(conn)
+    return True
+
+
+
+def serve():
+    """
+    Runs the prediction daemon until interrupted.
+    """
+
+    import amfinder_superresolution as AmfSRGAN
+
+    path = socket_path()
+
+    if os.path.exists(path):
+
+        try:
+
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+
+                s.connect(path)
+
+            AmfLog.error(f'A prediction daemon is already listening on {path}',
+                         AmfLog.ERR_DAEMON_RUNNING)
+
+        except OSError:
+
+            if not owned(path):
+
+                AmfLog.error(f'Socket {path} belongs to another user',
+                             AmfLog.ERR_UNSAFE_SOCKET)
+
+            # Stale socket file left by a previous daemon.
+            os.remove(path)
+
+    # Preload networks.
+    for name in AmfConfig.get('networks'):
+
+        AmfConfig.set('model', name)
+
+        if os.path.isfile(AmfConfig.get('model')):
+
+            get_model()
+
+        else:
+
+            AmfLog.warning(f'Cannot find network {name}')
+
+    if AmfConfig.get('super_resolution'):
+
+        AmfSRGAN.load_generator()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    # The socket is private from the moment it is created.
+    umask = os.umask(0o177)
+
+    try:
+
+        server.bind(path)
+
+    finally:
+
+        os.umask(umask)
+
+    server.listen()
+
+    AmfLog.text(f'Listening on {path}')
+
+    try:
+
+        while True:
+
+            conn, _ = server.accept()
+
+            with conn:
+
+                accept_job(conn)
+
+    except KeyboardInterrupt:
+
+        pass
+
+    finally:
+
+        server.close()
+        os.remove(path)
@@ -26,6 +26,7 @@ import sys
 import cv2
 import numpy as np
 import datetime
+import tempfile
 import matplotlib.pyplot as plt
 
 from tensorflow.keras.optimizers import Adam
@@ -42,6 +43,7 @@ from keras import backend as K
 
 import amfinder_model as AmfModel
 import amfinder_config as AmfConfig
+import amfinder_random as AmfRandom
 import amfinder_segmentation as AmfSegm
 
 BIN_SIZE = 3
@@ -51,6 +53,11 @@ LR_EDGE = HR_EDGE // BIN_SIZE
 LR_SHAPE = (LR_EDGE, LR_EDGE, CHANNELS)
 HR_SHAPE = (HR_EDGE, HR_EDGE, CHANNELS)
 OPTIMIZER = Adam(0.0002, 0.5)
+# Overlap (in low-resolution pixels) between neighbouring strips and
+# chunks. It exceeds the receptive field radius of the generator (18 px).
+HALO = 24
+# Width (in tiles) of the chunks processed by the generator.
+CHUNK = 8
 
 
 
@@ -190,10 +197,11 @@ def upscale_block(layer_input):
 
 
 
-def build_generator(residual_blocks=5):
+def build_generator(residual_blocks=5, shape=LR_SHAPE):
 
-    # Low resolution image input
-    img_lr = Input(shape=LR_SHAPE)
+    # Low resolution image input. The generator is fully convolutional,
+    # and also accepts images of any size (shape=(None, None, CHANNELS)).
+    img_lr = Input(shape=shape)
 
     # Pre-residual block
     c1 = Conv2D(64, kernel_size=9, strides=1, padding='same')(img_lr)
@@ -226,16 +234,16 @@ def build_generator(residual_blocks=5):
 
 
 
-def get_random_tile_pairs(tiles, batch_size=1, training=True):
+def get_random_tile_pairs(tiles, rng, batch_size=1, training=True):
     """
     Return randomly selected tile pairs.
     """
 
-    indices = np.random.choice(len(tiles), size=batch_size)
+    indices = rng.choice(len(tiles), size=batch_size)
     
     may_flip = lambda x: x
     
-    if training and np.random.random() < 0.5:
+    if training and rng.random() < 0.5:
     
         may_flip = lambda x: np.fliplr(x)
     
@@ -337,9 +345,10 @@ def train(paths, batch_size=2, sample_interval=20):
 
     for epoch in range(epochs):
 
+        rng = AmfRandom.generator(AmfRandom.SUPER_RESOLUTION, epoch)
         print('Epoch {}/{}... '.format(epoch + 1, epochs), end='')
 
-        hr_tile, lr_tile = get_random_tile_pairs(tiles,
+        hr_tile, lr_tile = get_random_tile_pairs(tiles, rng,
                                                  batch_size=batch_size)
         
         # From low res. image generate high res. version
@@ -352,7 +361,7 @@ def train(paths, batch_size=2, sample_interval=20):
         d_loss_fake = discriminator.train_on_batch(fake_hr, fake)
         d_loss = 0.5 * np.add(d_loss_real, d_loss_fake)
 
-        hr_tile, lr_tile = get_random_tile_pairs(tiles,
+        hr_tile, lr_tile = get_random_tile_pairs(tiles, rng,
                                                  batch_size=batch_size)
 
         # The generators want the discriminators 
@@ -383,70 +392,269 @@ def train(paths, batch_size=2, sample_interval=20):
 
 
 
+# Folder of canvas files (defaults to the temporary folder).
+CANVAS_DIR = None
+
+
+
 def initialize(nrows, ncols):
     """
-    Creates an empty image.
+    Creates an empty super-resolution canvas. The canvas is a memory-mapped
+    array stored in a temporary file, so that large images do not have to
+    fit in memory. Generated strips are written to the canvas as they come
+    (see <batches>), and rows which are never generated are filled with
+    white (see <blank>). The file is sparse until then.
+
+    :param nrows: row count.
+    :param ncols: column count.
+    :return: canvas (None if super-resolution is inactive).
+    :rtype: numpy.memmap
     """
     
     canvas = None
     
     if AmfConfig.get('super_resolution'):
-    
-        canvas = np.zeros([nrows * 126, ncols * 126, 3], dtype=np.uint8)
-        canvas.fill(255)
+
+        fd, path = tempfile.mkstemp(prefix='amfinder-sr-', suffix='.npy',
+                                    dir=CANVAS_DIR)
+        os.close(fd)
+
+        shape = (nrows * HR_EDGE, ncols * HR_EDGE, CHANNELS)
+        canvas = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8,
+                                           shape=shape)
 
     return canvas
 
 
 
-def generate(sr_image, row, r):
+def blank(canvas, rows):
+    """
+    Fills tile rows of a canvas with white.
 
-    # Super-resolution is not active, then return the row unaltered.
-    if sr_image is None:
+    :param canvas: canvas (None if super-resolution is inactive).
+    :param rows: indices of the rows to fill.
+    """
 
-        return row
+    if canvas is not None:
 
-    else:
-    
-        sr_row = improve(row)
+        for r in rows:
 
-        x_ini = 0
-        y_ini = r * 126
-        # Update the image.
-        
-        for i, tile in enumerate(sr_row): 
-        
-            sr_image[y_ini:y_ini + 126, i * 126:(i + 1) * 126] = tile
+            canvas[r * HR_EDGE:(r + 1) * HR_EDGE] = 255
+
+
+
+def reopen(path):
+    """
+    Opens a canvas created by another process (see <initialize>).
+
+    :param path: path to the canvas file.
+    :return: read-only canvas.
+    :rtype: numpy.memmap
+    """
+
+    return np.load(path, mmap_mode='r')
+
+
+
+def discard(canvas):
+    """
+    Removes the temporary file of a canvas.
+
+    :param canvas: canvas (None if super-resolution is inactive).
+    """
+
+    if canvas is not None:
+
+        try:
+
+            os.remove(canvas.filename)
+
+        except OSError:
+
+            pass # still mapped (Windows) or already removed.
+
+
+
+def improve_strip(above, strip, below, batch_size):
+    """
+    Generates the high-resolution version of a low-resolution strip. The
+    strip is extended with HALO pixels from neighbouring strips (or mirrored
+    at image borders), and split into chunks of CHUNK tiles which overlap by
+    HALO pixels. Halos are discarded after generation, so that chunks join
+    without seams.
+
+    :param above: low-resolution strip above (None for the first strip).
+    :param strip: low-resolution strip, of shape (h, w, CHANNELS).
+    :param below: low-resolution strip below (None for the last strip).
+    :param batch_size: number of chunks per generator call.
+    :return: high-resolution strip, of shape (h * 3, w * 3, CHANNELS).
+    :rtype: numpy.ndarray
+    """
+
+    height, width = strip.shape[:2]
+    chunk = CHUNK * LR_EDGE
+    nchunks = -(-width // chunk)
+
+    parts = [strip]
+    pad_top = pad_bottom = HALO
+
+    if above is not None:
+
+        parts.insert(0, above[-HALO:])
+        pad_top = 0
+
+    if below is not None:
+
+        parts.append(below[:HALO])
+        pad_bottom = 0
+
+    # All chunks have the same shape, so that the generator is traced once.
+    padded = np.pad(np.concatenate(parts),
+                    ((pad_top, pad_bottom),
+                     (HALO, HALO + nchunks * chunk - width),
+                     (0, 0)), mode='reflect')
+
+    chunks = [padded[:, x:x + chunk + 2 * HALO]
+              for x in range(0, nchunks * chunk, chunk)]
+
+    # Narrow strips do not need full (padded) batches.
+    generator = load_generator()
+    output = restore(generator.predict(preprocess(chunks),
+                                       batch_size=min(batch_size, nchunks)))
+
+    # Discard halos, then join chunks.
+    h = HALO * BIN_SIZE
+    output = np.concatenate(list(output[:, h:-h, h:-h]), axis=1)
+
+    return output[:, :width * BIN_SIZE]
+
+
+
+def strips(image, rows, height):
+    """
+    Generates super-resolution tile rows, <height> rows at a time, using the
+    generator on whole strips instead of individual tiles. Strips which do
+    not contain any of the requested rows are skipped.
+
+    :param image: input image (to extract low-resolution tiles).
+    :param rows: indices of the rows to generate, in ascending order.
+    :param height: number of tile rows per strip.
+    :return: generator of (row, high-resolution strip) pairs, where strips
+             have shape (height * HR_EDGE, ncols * HR_EDGE, CHANNELS).
+    :rtype: generator
+    """
+
+    rows = set(rows)
+    bs = max(1, AmfConfig.get('batch_size') // (height * CHUNK))
+
+    def lr_strip(tiles):
+        # (ncols, LR_EDGE, LR_EDGE, bands) -> (LR_EDGE, ncols * LR_EDGE, 3)
+        return np.concatenate(list(tiles[..., :CHANNELS]), axis=1)
+
+    def process(first, above, group, below):
+        if rows.isdisjoint(range(first, first + len(group))):
+            return None
+        strip = np.concatenate(group)
+        return first, improve_strip(above, strip, below, bs)
+
+    first = 0
+    above = None
+    pending = []
+
+    # One more row is read to provide the halo below each strip.
+    for _, tiles in AmfSegm.strips(image):
+
+        pending.append(lr_strip(tiles))
+
+        if len(pending) == height + 1:
+
+            result = process(first, above, pending[:height], pending[height])
+
+            if result is not None:
+
+                yield result
+
+            first += height
+            above = pending[height - 1]
+            pending = pending[height:]
+
+    if pending != []:
+
+        result = process(first, above, pending, None)
+
+        if result is not None:
+
+            yield result
+
+
+
+def batches(image, coords, batch_size, sr_image):
+    """
+    Streams super-resolution tiles as fixed-size batches (see
+    <AmfSegm.batches>), and copies generated strips to the canvas.
+
+    :param image: input image (to extract low-resolution tiles).
+    :param coords: list of (row, column) pairs, sorted by row.
+    :param batch_size: number of tiles per batch.
+    :param sr_image: super-resolution canvas.
+    :return: generator of (coordinates, tiles) pairs.
+    :rtype: generator
+    """
+
+    rows = sorted(set([r for r, _ in coords]))
+    wanted = set(rows)
+    height = AmfConfig.get('sr_strip_height')
+
+    def tile_rows():
+        for first, strip in strips(image, rows, height):
+            h = strip.shape[0] // HR_EDGE
+            sr_image[first * HR_EDGE:(first + h) * HR_EDGE] = strip
+            # (h * HR_EDGE, ncols * HR_EDGE) -> (h, ncols, HR_EDGE, HR_EDGE)
+            tiles = strip.reshape(h, HR_EDGE, -1, HR_EDGE, CHANNELS) \
+                         .transpose(0, 2, 1, 3, 4)
+            for i in range(h):
+                if first + i in wanted:
+                    yield first + i, tiles[i]
+
+    yield from AmfSegm.rebatch(coords, tile_rows(), batch_size)
 
-        return sr_row
 
 
 GENERATOR = None
-def improve(raw_tiles):
+GENERATOR_PATH = None
+
+def load_generator():
     """
-    Generate high-resolution versions of the given tiles.
+    Loads the pre-trained generator, or reuses the one already loaded.
     """
-    
-    global GENERATOR
-    
-    if GENERATOR is None:
+
+    global GENERATOR, GENERATOR_PATH
+
+    path = AmfConfig.get('generator')
+
+    if GENERATOR is None or GENERATOR_PATH != path:
    
-        GENERATOR = build_generator()
+        generator = build_generator(shape=(None, None, CHANNELS))
 
-        GENERATOR.load_weights(AmfConfig.get('generator'))
+        generator.load_weights(path)
 
-        GENERATOR.compile(loss='mse',
+        generator.compile(loss='mse',
                           optimizer=OPTIMIZER,
                           metrics=['mse', PSNR])
-    
-    return restore(GENERATOR.predict(preprocess(raw_tiles)))
+
+        GENERATOR = AmfModel.inference(generator)
+
+        GENERATOR_PATH = path
+
+    return GENERATOR
 
 
 
 def save_sample_images(epoch, generator, tiles, batch_size=2):
     r, c = batch_size, 4
 
-    imgs_hr, imgs_lr = get_random_tile_pairs(tiles,
+    rng = AmfRandom.generator(AmfRandom.SUPER_RESOLUTION, epoch, 1)
+    imgs_hr, imgs_lr = get_random_tile_pairs(tiles, rng,
                                              batch_size=batch_size,
                                              training=False)
 
@@ -33,45 +33,45 @@ Annotations are stored in an auxiliary ZIP archive.
 
 Class
 ------------
-:class ImageDataGeneratorMO:
-    Custom data generator for multiple single-variable outputs.
-    Reference: https://github.com/keras-team/keras/issues/3761
+:class TileSequence:
+    Streams tile batches from a memory-mapped tile store, so that
+    data loader processes share tiles through the page cache.
 
 Functions
 ------------
-:function get_zipfile: Returns the path of an auxiliary ZIP archive.
 :function import_settings: Imports image settings from a ZIP archive.
 :function import_annotations: Imports tile annotations from a ZIP archive.
 :function estimate_background_subsampling: Estimates background subsampling.
-:function load_dataset: Loads training dataset.
+:function load_dataset: Loads training dataset index.
+:function write_tile_store: Extracts training tiles to a memory-mapped file.
 :function class_weights: Computes class weights
 :function get_callbacks: Configures Keras callbacks.
 :function save_model_architecture: Saves neural network architecture.
 :function print_memory_usage: Prints memory used to load training data.
+:function save_augmented_tiles: Saves a subset of augmented tiles.
 :function run: Runs a training session.
 """
 
 import io
 import os
+import math
 #import cv2
 import yaml
 import keras
 import psutil
-import random
-random.seed(42)
+import tempfile
 import pyvips
 import operator
 import functools
 import amfinder_zipfile as zf
 import numpy as np
 import pandas as pd
-#from PIL import Image # debug
+from PIL import Image
 
 from contextlib import redirect_stdout
 
 from keras.callbacks import EarlyStopping
 from keras.callbacks import ReduceLROnPlateau
-from keras.preprocessing.image import ImageDataGenerator
 
 from sklearn.model_selection import train_test_split
 from sklearn.utils.class_weight import compute_class_weight
@@ -81,25 +81,13 @@ import amfinder_plot as AmfPlot
 import amfinder_save as AmfSave
 import amfinder_image as AmfImage
 import amfinder_model as AmfModel
+import amfinder_cache as AmfCache
+import amfinder_random as AmfRandom
 import amfinder_config as AmfConfig
 import amfinder_segmentation as AmfSegm
 
 
 
-def get_zipfile(path):
-    """
-    Returns the path of the auxiliary ZIP archive associated
-    with the given image.
-
-    :param path: Path to an input image.
-    :return: Path to the corresponding auxiliary ZIP archive.
-    :rtype: string
-    """
-
-    return '{}.zip'.format(os.path.splitext(path)[0])
-
-
-
 def import_settings(path):
     """
     Imports image settings stored in the auxiliary ZIP archive
@@ -110,7 +98,7 @@ def import_settings(path):
     :rtype: dict
     """
 
-    zfile = get_zipfile(path)
+    zfile = AmfConfig.get_zipfile(path)
 
     try:
 
@@ -139,7 +127,7 @@ def import_annotations(path):
     :rtype: pd.DataFrame
     """
 
-    zfile = get_zipfile(path)
+    zfile = AmfConfig.get_zipfile(path)
 
     try:
 
@@ -253,14 +241,17 @@ def print_image_stats(path, image, config, annots, discarded):
 
 def load_dataset(input_files):
     """
-    Loads training tile set and their corresponding annotations.
+    Loads the training dataset index, i.e. the coordinates of annotated tiles
+    and their corresponding annotations. Tiles are not extracted here, but
+    by <write_tile_store>.
 
     :param input_files: List of input images to use for training.
-    :return: Numpy arrays containing tiles and one-hot encoded annotations.
+    :return: Source images (path and tile edge), tile index (image, row, col)
+             and one-hot encoded annotations.
     :rtype: tuple
     """
 
-    print(f'[{AmfConfig.invite()}] Tile extraction.')
+    print(f'[{AmfConfig.invite()}] Tile indexing.')
 
     # Load image settings and annotations.
     settings = [import_settings(path) for path in input_files]
@@ -279,44 +270,180 @@ def load_dataset(input_files):
 
     # Determine the required amount of background subsampling (if active).
     subsampling = estimate_background_subsampling(filtered_dataset)
+    rng = AmfRandom.generator(AmfRandom.SUBSAMPLING)
 
-    tiles = []
+    images = []
+    index = []
     hot_labels = []
-    header = AmfConfig.get('header')
 
     print_table_header()
 
     for path, config, annots in filtered_dataset:
 
         edge = config['tile_edge']
-        AmfConfig.set('tile_edge', edge)
-
-        # FIXME: Random access is inefficient. To achieve better
-        # efficiency we would have to load tiles row by row.
-        image = AmfSegm.load(path)
-        
-        # Extract tile sets (= original tile and augmented versions).
-        # Repeat one-hot encoded annotations for each tile.
+        uid = len(images)
+        images.append((path, edge))
+
+        # Only the image header is read here.
+        image = AmfSegm.load(path, access='sequential')
+
+        # Record tile coordinates and one-hot encoded annotations.
         discarded = 0
-        for annot in annots.itertuples():
+        for annot in annots.sort_values(['row', 'col']).itertuples():
 
             if AmfConfig.get('level') == 1 and subsampling > 0 and \
-               annot.X == 1 and random.uniform(0, 100) < subsampling:
+               annot.X == 1 and rng.uniform(0, 100) < subsampling:
 
                 discarded += 1
                 pass
 
             else:
 
-                tile = AmfSegm.tile(image, annot.row, annot.col)
-                tiles.append(tile)
+                index.append((uid, annot.row, annot.col))
                 hot_labels.append(list(annot[3:]))
 
         print_image_stats(path, image, config, annots, discarded)
 
         del image
 
-    return np.array(tiles, np.float32), np.array(hot_labels, np.uint8)
+    return images, np.array(index, np.int32), np.array(hot_labels, np.uint8)
+
+
+
+def write_tile_store(store, images, index, labels):
+    """
+    Extracts training tiles once, and writes them to a memory-mapped uint8
+    array (tiles.npy), along with a sidecar file containing the one-hot
+    encoded annotations (labels.npy). Tiles follow the order of the index,
+    so that each image is read sequentially.
+
+    :param store: Folder where the tile store is written.
+    :param images: Source images (path and tile edge).
+    :param index: Tile index (image, row, col), sorted by image then row.
+    :param labels: One-hot encoded annotations.
+    """
+
+    print(f'[{AmfConfig.invite()}] Tile extraction.')
+
+    size = AmfSegm.tile_size()
+    tiles = np.lib.format.open_memmap(os.path.join(store, 'tiles.npy'),
+                                      mode='w+', dtype=np.uint8,
+                                      shape=(len(index), size, size, 3))
+
+    np.save(os.path.join(store, 'labels.npy'), labels)
+
+    bs = AmfConfig.get('batch_size')
+    pos = 0
+
+    for uid, (path, edge) in enumerate(images):
+
+        image = AmfSegm.load(path, access='sequential', edge=edge)
+        coords = [(r, c) for _, r, c in index[index[:, 0] == uid].tolist()]
+
+        for _, batch in AmfCache.batches(image, coords, bs, edge):
+
+            tiles[pos:pos + len(batch)] = batch[..., :3]
+            pos += len(batch)
+
+        AmfLog.progress_bar(uid + 1, len(images), indent=1)
+
+        del image
+
+    tiles.flush()
+    del tiles
+
+
+
+class TileSequence(keras.utils.Sequence):
+    """
+    Streams tile batches from a memory-mapped tile store written by
+    <write_tile_store>. Only tile positions are pickled when the sequence
+    is sent to data loader processes, which then read tiles directly from
+    the page cache. Data augmentation is applied to whole batches, which
+    remain 8-bit integers until they are normalised at once before being
+    passed to the network. Random numbers used to shuffle tiles and augment
+    a batch are derived from the run seed, the epoch and the batch index,
+    so that batches do not depend on the process which prepares them.
+    This class also supports the multiple single-variable outputs of CNN2.
+    """
+
+    def __init__(self, store, positions, augment=False, shuffle=False):
+        """
+        :param store: Path to the folder containing the tile store.
+        :param positions: Positions of the tiles to use within the store.
+        :param augment: Apply data augmentation to tile batches.
+        :param shuffle: Shuffle tiles at the end of each epoch.
+        """
+
+        super().__init__()
+        self.store = store
+        self.positions = np.sort(positions)
+        self.augment = augment
+        self.shuffle = shuffle
+        self.batch_size = AmfConfig.get('batch_size')
+        self.epoch = -1
+        self.tiles = None
+        self.labels = None
+        self.order = self.positions
+        self.on_epoch_end()
+
+
+    def __getstate__(self):
+
+        # Memory maps are reopened by each process.
+        state = self.__dict__.copy()
+        state['tiles'] = None
+        state['labels'] = None
+        return state
+
+
+    def __len__(self):
+
+        return math.ceil(len(self.positions) / self.batch_size)
+
+
+    def __getitem__(self, i):
+
+        if self.tiles is None:
+
+            self.tiles = np.load(os.path.join(self.store, 'tiles.npy'),
+                                 mmap_mode='r')
+            self.labels = np.load(os.path.join(self.store, 'labels.npy'),
+                                  mmap_mode='r')
+
+        batch = self.order[i * self.batch_size:(i + 1) * self.batch_size]
+
+        # Sorted positions read the store in ascending order.
+        batch = np.sort(batch)
+        tiles = self.tiles[batch]
+
+        if self.augment:
+
+            rng = AmfRandom.generator(AmfRandom.AUGMENTATION, self.epoch, i)
+            tiles = AmfImage.augment(tiles, rng)
+            save_augmented_tiles(tiles, i * self.batch_size)
+
+        tiles = AmfSegm.preprocess(tiles)
+        labels = np.array(self.labels[batch])
+
+        if AmfConfig.get('level') == 1:
+
+            return tiles, labels
+
+        else:
+
+            # [[a1 v1 h1]...[aN vN hN]] -> [[a1...aN] [v1...vN] [h1...hN]]
+            return tiles, [y for y in labels.T]
+
+
+    def on_epoch_end(self):
+
+        self.epoch += 1
+
+        if self.shuffle:
+
+            rng = AmfRandom.generator(AmfRandom.SHUFFLE, self.epoch)
+            self.order = rng.permutation(self.positions)
 
 
 
@@ -414,35 +541,6 @@ def get_callbacks():
 
 
 
-class ImageDataGeneratorMO(ImageDataGenerator):
-    """
-    Patched version of Keras's ImageDataGenerator to support multiple
-    single-variable outputs. This requires output data to be a list of
-    identical-length 1D NumPy arrays. Any inefficiency is negligible.
-    Reference: https://github.com/keras-team/keras/issues/3761
-    """
-
-    def flow(self, x, y=None, **kwargs):
-        if y is None or \
-        not isinstance(y,list) or \
-        any([yy.ndim != 1 for yy in y]) or \
-        any([yy.size != len(x) for yy in y]):
-           raise ValueError('ImageDataGeneratorMO requires a '
-                            'list of outputs, each a 1D NumPy array of the '
-                             'same length as the input.')
-
-        y_sing = np.transpose(np.asarray(y))
-
-        generator_sing = super(ImageDataGeneratorMO,
-                               self).flow(x, y_sing, **kwargs)
-
-        while True:
-            batch_x, batch_y_sing = next(generator_sing)
-            batch_y = [yy for yy in np.transpose(batch_y_sing)]
-            yield batch_x, batch_y
-
-
-
 def save_model_architecture(model):
     """
     Saves neural network architecture, parameters count, etc.
@@ -466,60 +564,45 @@ def save_model_architecture(model):
 
 
 
-def print_memory_usage():
+def print_memory_usage(tile_count):
     """
-    Prints the amount of memory used to load training data.
+    Prints the amount of memory used to load training data, and the
+    amount saved by storing tiles as 8-bit integers.
+
+    :param tile_count: Number of tiles in the training dataset.
     """
 
     process = psutil.Process(os.getpid())
     mb = process.memory_info().rss / (1024 * 1024)
-    print(f"* Total memory used: {mb} Mb.")
+    print(f"* Total memory used: {mb:.1f} Mb.")
 
+    size = AmfSegm.tile_size()
+    uint8_mb = tile_count * size * size * 3 / (1024 * 1024)
+    float32_mb = 4 * uint8_mb
+    print(f"* Tile storage: {uint8_mb:.1f} Mb as uint8 instead of "
+          f"{float32_mb:.1f} Mb as float32 (saved: "
+          f"{float32_mb - uint8_mb:.1f} Mb).")
 
 
-img_index = 0
 
-def data_augm(tile):
-    """
-    Two-step random tile augmentation based on blur and anticlockwise 90-degree
-    rotation (step 1), and desaturation, inversion, chroma/hue alteration, or
-    histogram equalisation (step 2). Random rotations and zoom are not used
-    due to fungal structures occurring on edges in some tiles.
-
-    :param tile: The tile to augment.
-    :return: The augmented tile.
-    :rtype: pyvips.Image
+def save_augmented_tiles(tiles, first):
     """
+    Saves augmented tiles as PNG files, until the number of tiles requested
+    with --save_augmented_tiles is reached. Files are named after the rank
+    of the tile within the epoch, so that data loader processes do not need
+    to share a counter.
 
-    global img_index
-    num = random.randint(1, 4)
-
-    if num == 1:
-
-        output = AmfImage.invert(tile)
-
-    elif num == 2:
-
-        output = AmfImage.grayscale(tile)
-
-    elif num == 3:
-
-        output = AmfImage.rotate_colours(tile)
-
-    else:
-
-        output = tile
+    :param tiles: Batch of augmented tiles.
+    :param first: Rank of the first tile of the batch.
+    """
 
-    # May randomly save some augmented tiles.
-    if img_index < AmfConfig.get('save_augmented_tiles') \
-    and bool(random.getrandbits(1)):
+    count = AmfConfig.get('save_augmented_tiles') - first
 
-        im = Image.fromarray(output.astype(np.uint8))
-        img_index += 1
-        im.save(os.path.join(AmfConfig.get('outdir'),
-                'tile_%06d.png' % (img_index)))
+    for k, tile in enumerate(tiles[:max(0, count)]):
 
-    return output
+        path = os.path.join(AmfConfig.get('outdir'),
+                            'tile_%06d.png' % (first + k + 1))
+        Image.fromarray(tile).save(path)
 
 
 
@@ -531,76 +614,71 @@ def run(input_files):
     :param input_files: List of input images to train with.
     """
 
+    # Seeds Python, NumPy and TensorFlow (e.g. weight initialisation).
+    keras.utils.set_random_seed(AmfRandom.seed())
+
     # Input model (either new or pre-trained).
     model = AmfModel.load()
 
     # Save model information (layers and graph) upon user request.
     save_model_architecture(model)
 
-    # Input tiles and their corresponding annotations.
-    tiles, labels = load_dataset(input_files)
+    # Index of input tiles and their corresponding annotations.
+    images, index, labels = load_dataset(input_files)
 
-    print_memory_usage()
+    print_memory_usage(len(index))
 
     # Generates training and validation datasets.
-    xt, xc, yt, yc = train_test_split(tiles, labels,
-                                      shuffle=True,
-                                      test_size=AmfConfig.get('vfrac') / 100.0,
-                                      random_state=42)
+    t_set, v_set = train_test_split(np.arange(len(index)),
+                                    shuffle=True,
+                                    test_size=AmfConfig.get('vfrac') / 100.0,
+                                    random_state=AmfRandom.state(
+                                        AmfRandom.SPLIT))
 
-    t_gen = None
-    v_gen = None
+    # Tiles are extracted once, and shared by data loader processes. The
+    # tile store goes to the tile cache folder, or to the temporary folder,
+    # and is removed once training is over, even if it fails.
+    parent = AmfConfig.get('tile_cache')
 
-    if AmfConfig.get('level') == 1:
+    if parent is not None:
 
-        # Root segmentation (colonized vs non-colonized vs background).
-        # ConvNet I has a standard, single input/single output architecture,
-        # and can use ImageDataGenerator.
-        if AmfConfig.get('data_augm'):
-            t_gen = ImageDataGenerator(rescale=1.0 / 255,
-                                       horizontal_flip=True,
-                                       vertical_flip=True,
-                                       brightness_range=[0.75, 1.25],
-                                       preprocessing_function=data_augm)
-        else:
-            t_gen = ImageDataGenerator(rescale=1.0 / 255)
+        os.makedirs(parent, exist_ok=True)
 
-        v_gen = ImageDataGenerator(rescale=1.0 / 255)
+    with tempfile.TemporaryDirectory(prefix='amfinder-tiles-',
+                                     dir=parent) as store:
 
-    else:
+        write_tile_store(store, images, index, labels)
 
-        # AM fungal structures (arbuscules, vesicles, hyphae).
-        # ConvNet II has multiple outputs. ImageDataGenerator is not suitable.
+        # Both CNN1 and CNN2 read tiles through TileSequence, which also
+        # handles the multiple outputs of CNN2.
         # Reference: https://github.com/keras-team/keras/issues/3761
-        if AmfConfig.get('data_augm'):
-            t_gen = ImageDataGeneratorMO(rescale=1.0 / 255,
-                                         horizontal_flip=True,
-                                         vertical_flip=True,
-                                         brightness_range=[0.75, 1.25],
-                                         preprocessing_function=data_augm)
-        else:
-            t_gen = ImageDataGeneratorMO(rescale=1.0 / 255)
-
-        v_gen = ImageDataGeneratorMO(rescale=1.0 / 255)
-
-        # Reshape one-hot data in a way suitable for ImageDataGeneratorMO:
-        # [[a1 v1 h1]...[aN vN hN]] -> [[a1...aN] [v1...vN] [h1...hN]]
-        nclasses = len(AmfConfig.get('header')) # (= 4)
-        yt = [np.array([x[i] for x in yt]) for i in range(nclasses)]
-        yc = [np.array([x[i] for x in yc]) for i in range(nclasses)]
-
-    # Determine weights to counteract class imbalance.
-    weights = class_weights(yt)
-
-    bs = AmfConfig.get('batch_size')
-
-    his = model.fit(t_gen.flow(xt, yt, batch_size=bs),
-                    steps_per_epoch=len(xt) // bs,
-                    class_weight=weights,
-                    epochs=AmfConfig.get('epochs'),
-                    validation_data=v_gen.flow(xc, yc, batch_size=bs),
-                    validation_steps=len(xc) // bs,
-                    callbacks=get_callbacks(),
-                    verbose=2)
+        # Tiles are augmented and normalised by TileSequence.
+        t_seq = TileSequence(store, t_set, AmfConfig.get('data_augm'),
+                             shuffle=True)
+        v_seq = TileSequence(store, v_set)
+
+        # Determine weights to counteract class imbalance.
+        yt = labels[t_set]
+
+        if AmfConfig.get('level') == 2:
+
+            yt = [y for y in yt.T]
+
+        weights = class_weights(yt)
+
+        # Batches are prepared by separate processes. Shuffling is performed
+        # by TileSequence.
+        workers = AmfConfig.get('workers')
+
+        his = model.fit(t_seq,
+                        class_weight=weights,
+                        epochs=AmfConfig.get('epochs'),
+                        validation_data=v_seq,
+                        callbacks=get_callbacks(),
+                        shuffle=False,
+                        workers=workers,
+                        max_queue_size=2 * workers,
+                        use_multiprocessing=workers > 1,
+                        verbose=2)
 
     AmfSave.training_data(his.history, model)
@@ -1657,6 +1657,27 @@ class ZipFile:
 
         return self._remove_member(zinfo)
 
+    def remove_all(self, members):
+        """Remove several files from the archive in a single pass, i.e.
+        entries that follow removed files are moved once. The archive must
+        be open with mode 'a'"""
+
+        if self.mode != 'a':
+            raise RuntimeError("remove_all() requires mode 'a'")
+        if not self.fp:
+            raise ValueError(
+                "Attempt to write to ZIP archive that was already closed")
+        if self._writing:
+            raise ValueError(
+                "Can't write to ZIP archive while an open writing handle exists."
+            )
+
+        zinfos = [x if isinstance(x, ZipInfo) else self.getinfo(x)
+                  for x in members]
+
+        if zinfos:
+            self._remove_members(zinfos)
+
     @classmethod
     def _sanitize_windows_name(cls, arcname, pathsep):
         """Replace bad characters and remove trailing dots from parts."""
@@ -1760,6 +1781,51 @@ class ZipFile:
         # seek to the start of the central dir
         fp.seek(self.start_dir)
 
+    def _remove_members(self, members, chunk_size=1 << 20):
+        # get a sorted filelist by header offset, in case the dir order
+        # doesn't match the actual entry order
+        fp = self.fp
+        removed = set(id(x) for x in members)
+        entry_offset = 0
+        filelist = sorted(self.filelist, key=attrgetter('header_offset'))
+        for i in range(len(filelist)):
+            info = filelist[i]
+
+            # get the total size of the entry
+            if i == len(filelist) - 1:
+                entry_size = self.start_dir - info.header_offset
+            else:
+                entry_size = filelist[i + 1].header_offset - info.header_offset
+
+            # removed entries widen the gap to fill
+            if id(info) in removed:
+                entry_offset += entry_size
+                continue
+
+            if entry_offset == 0:
+                continue
+
+            # Move entry, chunk by chunk (the target is always before the
+            # source, so that chunks are never overwritten before use)
+            source = info.header_offset
+            info.header_offset -= entry_offset
+            for pos in range(0, entry_size, chunk_size):
+                fp.seek(source + pos)
+                data = fp.read(min(chunk_size, entry_size - pos))
+                fp.seek(info.header_offset + pos)
+                fp.write(data)
+            fp.flush()
+
+        # update state
+        self.start_dir -= entry_offset
+        for member in members:
+            self.filelist.remove(member)
+            del self.NameToInfo[member.filename]
+        self._didModify = True
+
+        # seek to the start of the central dir
+        fp.seek(self.start_dir)
+
     def _writecheck(self, zinfo):
         """Check for errors before writing a file to the archive."""
         if zinfo.filename in self.NameToInfo:
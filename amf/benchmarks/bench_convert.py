@@ -0,0 +1,168 @@
+# AMFinder - benchmarks/bench_convert.py
+#
+# MIT License
+# Copyright (c) 2021 Edouard Evangelisti, Carl Turner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+"""
+Benchmark of OCaml annotation matrix generation (`amf convert`).
+
+Compares the vectorised conversion functions with the original iterrows
+implementation, kept below as reference, on a synthetic 300x300 grid, and
+checks that both produce byte-identical annotations.
+
+Usage: python benchmarks/bench_convert.py (from the application folder).
+"""
+
+import os
+import sys
+import time
+import timeit
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import amfinder_config as AmfConfig
+import amfinder_convert as AmfConvert
+
+NROWS = 300
+NCOLS = 300
+
+
+
+def reference_1(out, nrows, ncols):
+    """
+    Original level 1 conversion (one DataFrame row at a time).
+    """
+
+    mat1 = np.zeros((nrows, ncols)).astype('<U1')
+    mat2 = np.zeros((nrows, ncols)).astype('<U1')
+
+    header = AmfConfig.get('header')
+    out = out.reset_index()
+
+    for _, row in out.iterrows():
+        r = row['row']
+        c = row['col']
+        mat1[r, c] = header[np.argmax(row[header])]
+        mat2[r, c] = '' # this one will remain empty.
+
+    return [to_text(mat1), to_text(mat2)]
+
+
+
+def reference_2(out, nrows, ncols):
+    """
+    Original level 2 conversion (one DataFrame row at a time).
+    """
+
+    mat2 = np.zeros((nrows, ncols), str).astype('<U4')
+
+    header = AmfConfig.get('header')
+    out = out.reset_index()
+
+    for _, row in out.iterrows():
+        r = row['row']
+        c = row['col']
+        indices = [i for i, x in enumerate(row[header]) if x == 1]
+        mat2[r, c] = ''.join(sorted([header[i] for i in indices]))
+
+    return [to_text(mat2)]
+
+
+
+def to_text(mat):
+    """
+    Original serialisation of annotation matrices.
+    """
+
+    data = pd.DataFrame(mat).to_csv(sep='\t', encoding='utf-8',
+                                    index=False, header=False,
+                                    mode='a', line_terminator='')
+    # There is still a trailing character at the end of the csv text.
+    return data[:-1]
+
+
+
+def annotations(level, rng):
+    """
+    Builds random annotations, as returned by <preds_to_python_annot>.
+    Level 2 annotations skip tiles without any structure.
+    """
+
+    AmfConfig.set('level', level)
+    header = AmfConfig.get('header')
+
+    rows, cols = np.divmod(np.arange(NROWS * NCOLS), NCOLS)
+
+    if level == 1:
+
+        values = np.eye(len(header), dtype=np.uint8)[
+                     rng.integers(len(header), size=len(rows))]
+
+    else:
+
+        values = rng.integers(2, size=(len(rows), len(header)), dtype=np.uint8)
+
+    out = pd.DataFrame(values, columns=header)
+    out.insert(0, 'col', cols)
+    out.insert(0, 'row', rows)
+
+    if level == 2:
+
+        out = out.loc[out[header].sum(axis=1) != 0]
+
+    return out
+
+
+
+def main():
+
+    rng = np.random.default_rng(0)
+
+    for level, reference, function in [
+        (1, reference_1, AmfConvert.python_annot_to_ocaml_1),
+        (2, reference_2, AmfConvert.python_annot_to_ocaml_2)]:
+
+        out = annotations(level, rng)
+
+        # The reference is slow, and only timed once.
+        t_old = time.perf_counter()
+        old = reference(out, NROWS, NCOLS)
+        t_old = time.perf_counter() - t_old
+
+        new = [data for _, data in function(out, NROWS, NCOLS)]
+        assert [x.encode() for x in old] == [x.encode() for x in new], \
+               f'level {level}: annotations differ'
+
+        t_new = min(timeit.repeat(lambda: function(out, NROWS, NCOLS),
+                                  number=1, repeat=3))
+
+        print(f'Level {level} ({NROWS}x{NCOLS}): iterrows {t_old:.3f} s, '
+              f'vectorised {t_new:.3f} s ({t_old / t_new:.0f}x faster), '
+              'identical output')
+
+
+
+if __name__ == '__main__':
+
+    main()
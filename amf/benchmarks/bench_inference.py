@@ -0,0 +1,84 @@
+# AMFinder - benchmarks/bench_inference.py
+#
+# MIT License
+# Copyright (c) 2021 Edouard Evangelisti, Carl Turner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+"""
+Benchmark of per-call prediction overhead.
+
+Compares <model.predict> with the compiled inference step of
+<AmfModel.Inference> on a randomly initialised CNN1, for the small
+batches predicted by `amf predict`, and checks that both return the
+same probabilities.
+
+Usage: python benchmarks/bench_inference.py (from the application folder).
+"""
+
+import os
+import sys
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Disables tensorflow messages/warnings.
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+import amfinder_model as AmfModel
+import amfinder_config as AmfConfig
+
+CALLS = 50
+
+
+
+def main():
+
+    AmfConfig.set('learning_rate', 0.001)
+    model = AmfModel.create_cnn1()
+    step = AmfModel.inference(model)
+    rng = np.random.default_rng(0)
+    size = AmfModel.INPUT_SIZE
+
+    for batch_size in [1, 8, 32]:
+
+        x = rng.random((batch_size, size, size, 3), dtype=np.float32)
+
+        # Warm-up (graph tracing).
+        expected = model.predict(x, batch_size=batch_size, verbose=0)
+        actual = step.predict(x, batch_size=batch_size)
+        np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-6)
+
+        t_old = min(timeit.repeat(
+                    lambda: model.predict(x, batch_size=batch_size, verbose=0),
+                    number=CALLS, repeat=3)) / CALLS
+        t_new = min(timeit.repeat(
+                    lambda: step.predict(x, batch_size=batch_size),
+                    number=CALLS, repeat=3)) / CALLS
+
+        print(f'Batch size {batch_size:>2}: model.predict {1000 * t_old:.2f} ms, '
+              f'inference step {1000 * t_new:.2f} ms per call '
+              f'({t_old / t_new:.1f}x faster)')
+
+
+
+if __name__ == '__main__':
+
+    main()
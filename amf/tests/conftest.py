@@ -0,0 +1,80 @@
+# AMFinder - tests/conftest.py
+#
+# MIT License
+# Copyright (c) 2021 Edouard Evangelisti, Carl Turner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Test configuration.
+
+AMFinder modules are imported from the application folder, as `amf` does.
+Run the tests from the application folder with `python -m pytest tests`.
+"""
+
+import os
+import sys
+import pytest
+
+AMF_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if AMF_DIR not in sys.path:
+
+    sys.path.insert(0, AMF_DIR)
+
+# Disables tensorflow messages/warnings.
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+
+
+@pytest.fixture
+def networks(monkeypatch):
+    """
+    Saves a random CNN1 and a random generator in the application folder,
+    where worker processes and the prediction daemon look for them.
+    """
+
+    import amfinder_model as AmfModel
+    import amfinder_config as AmfConfig
+    import amfinder_superresolution as AmfSRGAN
+
+    folder = os.path.join(AmfConfig.get_appdir(), 'trained_networks')
+    created = not os.path.isdir(folder)
+    os.makedirs(folder, exist_ok=True)
+
+    cnn1 = os.path.join(folder, f'test-cnn1-{os.getpid()}.h5')
+    gen = os.path.join(folder, f'test-generator-{os.getpid()}.h5')
+
+    AmfConfig.set('learning_rate', 0.001)
+    AmfModel.create_cnn1().save(cnn1)
+    shape = (None, None, AmfSRGAN.CHANNELS)
+    AmfSRGAN.build_generator(shape=shape).save_weights(gen)
+
+    monkeypatch.setitem(AmfConfig.PAR, 'model', os.path.basename(cnn1))
+    monkeypatch.setitem(AmfConfig.PAR, 'generator', os.path.basename(gen))
+    monkeypatch.setitem(AmfConfig.PAR, 'run_mode', 'predict')
+    monkeypatch.setattr(AmfSRGAN, 'GENERATOR', None)
+
+    yield folder
+
+    for path in [cnn1, gen]:
+        os.remove(path)
+
+    if created:
+        os.rmdir(folder)
@@ -0,0 +1,190 @@
+# AMFinder - tests/test_cache.py
+#
+# MIT License
+# Copyright (c) 2021 Edouard Evangelisti, Carl Turner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+"""
+Tests of the on-disk tile cache.
+"""
+
+import os
+import numpy as np
+import pyvips
+import pytest
+
+import amfinder_cache as AmfCache
+import amfinder_config as AmfConfig
+import amfinder_segmentation as AmfSegm
+
+
+
+def save_image(path, seed, nrows=2, ncols=3, edge=126):
+    """
+    Saves a random image of nrows x ncols tiles.
+    """
+
+    rng = np.random.default_rng(seed)
+    data = rng.integers(256, size=(nrows * edge, ncols * edge, 3),
+                        dtype=np.uint8)
+    pyvips.Image.new_from_memory(data.tobytes(), ncols * edge, nrows * edge,
+                                 3, 'uchar').pngsave(str(path))
+
+    return str(path)
+
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    """
+    Enables the tile cache in a temporary folder, and counts the number
+    of cache entries built.
+    """
+
+    folder = tmp_path / 'cache'
+    monkeypatch.setitem(AmfConfig.PAR, 'tile_cache', str(folder))
+    monkeypatch.setitem(AmfConfig.PAR, 'tile_edge', 126)
+    monkeypatch.setitem(AmfConfig.PAR, 'super_resolution', False)
+    AmfCache.open_grid.cache_clear()
+
+    built = []
+    build = AmfCache.build
+
+    def counted(path, edge, target):
+        built.append((os.path.basename(path), edge))
+        build(path, edge, target)
+
+    monkeypatch.setattr(AmfCache, 'build', counted)
+
+    yield built
+
+    AmfCache.open_grid.cache_clear()
+
+
+
+def entries(cache_dir):
+
+    return sorted(os.listdir(cache_dir)) if os.path.isdir(cache_dir) else []
+
+
+
+def test_hit(cache, tmp_path):
+    """
+    Tiles are extracted once, then read from the cache, and each hit
+    marks the entry as recently used.
+    """
+
+    path = save_image(tmp_path / 'a.png', 0)
+    tiles = AmfCache.grid(path)
+
+    assert cache == [('a.png', 126)]
+    assert tiles.shape == (2, 3, 126, 126, 3)
+
+    image = AmfSegm.load(path)
+    for r in range(2):
+        for c in range(3):
+            assert np.array_equal(tiles[r, c], AmfSegm.tile(image, r, c))
+
+    target = AmfCache.entry_path(path, 126)
+    os.utime(target, (1000, 1000))
+
+    assert AmfCache.grid(path) is tiles
+    assert cache == [('a.png', 126)]
+    assert os.stat(target).st_mtime > 1000
+
+
+
+def test_invalidation(cache, tmp_path):
+    """
+    New entries are built when image contents or the tile edge change.
+    """
+
+    path = save_image(tmp_path / 'a.png', 0)
+    first = np.array(AmfCache.grid(path))
+    target = AmfCache.entry_path(path, 126)
+
+    # Same file name, new contents.
+    save_image(tmp_path / 'a.png', 1)
+    second = AmfCache.grid(path)
+
+    assert AmfCache.entry_path(path, 126) != target
+    assert cache == [('a.png', 126)] * 2
+    assert not np.array_equal(first, second)
+
+    # Same contents, another tile edge.
+    AmfCache.grid(path, 63)
+
+    assert cache == [('a.png', 126)] * 2 + [('a.png', 63)]
+    assert len(entries(tmp_path / 'cache')) == 3
+
+
+
+def test_eviction_order(cache, tmp_path, monkeypatch):
+    """
+    Least recently used entries are removed first, hits included.
+    """
+
+    paths = [save_image(tmp_path / f'{x}.png', k)
+             for k, x in enumerate('abcd')]
+
+    for k, path in enumerate(paths[:3]):
+        AmfCache.grid(path)
+        os.utime(AmfCache.entry_path(path, 126), (1000 * k, 1000 * k))
+
+    # Room for three entries.
+    size = os.path.getsize(AmfCache.entry_path(paths[0], 126))
+    monkeypatch.setitem(AmfConfig.PAR, 'tile_cache_size',
+                        3.5 * size / 1024 ** 3)
+
+    # 'a' is used again, so that 'b' becomes the least recently used entry.
+    AmfCache.grid(paths[0])
+    AmfCache.grid(paths[3])
+
+    kept = [os.path.isfile(AmfCache.entry_path(x, 126)) for x in paths]
+
+    assert kept == [True, False, True, True]
+
+
+
+def test_reduced_resolution(cache, tmp_path):
+    """
+    Images loaded at reduced resolution are cached under their own path.
+    """
+
+    data = np.random.default_rng(0).integers(256, size=(504, 756, 3),
+                                             dtype=np.uint8)
+    path = str(tmp_path / 'a.jpg')
+    pyvips.Image.new_from_memory(data.tobytes(), 756, 504, 3,
+                                 'uchar').jpegsave(path)
+
+    image = AmfSegm.load(path, 'sequential', 252)
+    coords = [(r, c) for r in range(2) for c in range(3)]
+
+    assert image.get(AmfSegm.SHRINK) == 2
+    assert AmfSegm.filename(image) == path
+
+    tiles = np.concatenate([x for _, x in AmfCache.batches(image, coords, 4,
+                                                           252)])
+    image = AmfSegm.load(path, edge=252)
+
+    assert cache == [('a.jpg', 252)]
+    for (r, c), x in zip(coords, tiles):
+        assert np.array_equal(x, AmfSegm.tile(image, r, c, 252))
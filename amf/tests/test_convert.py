@@ -0,0 +1,126 @@
+# AMFinder - tests/test_convert.py
+#
+# MIT License
+# Copyright (c) 2021 Edouard Evangelisti, Carl Turner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Tests of the conversion mode (`amf convert`).
+"""
+
+import os
+import sys
+import json
+import subprocess
+
+from PIL import Image
+
+from conftest import AMF_DIR
+
+import amfinder_zipfile as zf
+import amfinder_config as AmfConfig
+import amfinder_convert as AmfConvert
+
+
+
+def make_image(tmp_path, nrows=3, ncols=4, edge=126):
+    """
+    Creates a blank image and an archive with CNN1 predictions.
+    """
+
+    path = str(tmp_path / 'image.jpg')
+    Image.new('RGB', (ncols * edge, nrows * edge), 'white').save(path)
+
+    lines = ['row\tcol\tY\tN\tX']
+    lines += [f'{r}\t{c}\t0.7\t0.2\t0.1'
+              for r in range(nrows) for c in range(ncols)]
+
+    with zf.ZipFile(str(tmp_path / 'image.zip'), 'w') as z:
+        z.writestr('settings.json', json.dumps({'tile_edge': edge}))
+        zi = zf.ZipInfo('predictions/1.tsv')
+        zi.comment = b'col'
+        z.writestr(zi, '\n'.join(lines))
+
+    return path
+
+
+
+def test_convert_does_not_import_tensorflow(tmp_path):
+    """
+    `amf convert` must not import TensorFlow (see the `amf` script).
+    """
+
+    path = make_image(tmp_path)
+    script = (
+        'import sys, runpy\n'
+        f'sys.argv = ["amf", "convert", {path!r}]\n'
+        'runpy.run_path("amf", run_name="__main__")\n'
+        'heavy = [x for x in ("tensorflow", "keras") if x in sys.modules]\n'
+        'assert heavy == [], heavy\n'
+    )
+
+    res = subprocess.run([sys.executable, '-c', script], cwd=AMF_DIR,
+                         capture_output=True, text=True)
+
+    assert res.returncode == 0, res.stderr
+
+    with zf.ZipFile(str(tmp_path / 'image.zip')) as z:
+        assert 'col.tsv' in z.namelist()
+
+
+
+def test_create_annotations_rewrites_archive_once(tmp_path, monkeypatch):
+    """
+    Replaced annotations are removed in a single compaction pass, and
+    entries that follow them (e.g. super-resolution images) stay intact.
+    """
+
+    path = make_image(tmp_path)
+    zfile = str(tmp_path / 'image.zip')
+    sr_data = os.urandom(3 << 20)
+
+    with zf.ZipFile(zfile, 'a') as z:
+        z.writestr('annotations/col.caml', 'old')
+        z.writestr('annotations/myc.caml', 'old')
+        z.writestr('sr/1.jpg', sr_data)
+
+    calls = []
+    remove_members = zf.ZipFile._remove_members
+
+    def spy(self, members, *args, **kwargs):
+        calls.append([x.filename for x in members])
+        return remove_members(self, members, *args, **kwargs)
+
+    monkeypatch.setattr(zf.ZipFile, '_remove_members', spy)
+    monkeypatch.setattr(zf.ZipFile, '_remove_member', None)
+
+    AmfConfig.set('level', 1)
+    AmfConvert.create_annotations(path)
+
+    assert calls == [['annotations/col.caml', 'annotations/myc.caml']]
+
+    with zf.ZipFile(zfile) as z:
+        assert z.testzip() is None
+        assert z.read('sr/1.jpg') == sr_data
+        assert z.read('annotations/col.caml') != b'old'
+        assert sorted(z.namelist()) == ['annotations/col.caml',
+                                        'annotations/myc.caml', 'col.tsv',
+                                        'predictions/1.tsv', 'settings.json',
+                                        'sr/1.jpg']
@@ -0,0 +1,107 @@
+# AMFinder - tests/test_image.py
+#
+# MIT License
+# Copyright (c) 2021 Edouard Evangelisti, Carl Turner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+"""
+Tests of data augmentation.
+"""
+
+import numpy as np
+
+import amfinder_image as AmfImage
+
+
+
+def reference_rotation(pixels, theta):
+    """
+    Per-pixel hue rotation by an angle theta (rotation around the X-axis
+    of normalised colours), as computed before <AmfImage.hue_lut>.
+    """
+
+    norm = AmfImage.do_normalise(pixels.astype(np.float64))
+    cos, sin = np.cos(theta), np.sin(theta)
+
+    rot = norm.copy()
+    rot[:, 1] = cos * norm[:, 1] + sin * norm[:, 2]
+    rot[:, 2] = cos * norm[:, 2] - sin * norm[:, 1]
+
+    return np.clip(np.rint(AmfImage.undo_normalise(rot)), 0, 255)
+
+
+
+def test_hue_lut_matches_reference():
+    """
+    The lookup table gives the per-pixel rotation (within one unit, due to
+    rounding), for every angle.
+    """
+
+    lut = AmfImage.hue_lut()
+    pixels = np.random.default_rng(0).integers(256, size=(10000, 3))
+
+    assert lut.shape == (AmfImage.ANGLES, 256, 256, 2)
+    assert lut.dtype == np.uint8
+
+    for k in range(AmfImage.ANGLES):
+
+        expected = reference_rotation(pixels, k * np.pi / 10)
+        rotated = lut[k, pixels[:, 1], pixels[:, 2]].astype(int)
+
+        assert np.abs(rotated - expected[:, 1:]).max() <= 1
+
+    # No rotation leaves colours unchanged.
+    assert np.array_equal(lut[0, pixels[:, 1], pixels[:, 2]], pixels[:, 1:])
+
+
+
+def test_rotate_colours():
+    """
+    Each tile is rotated by its own angle, and red values are unchanged.
+    """
+
+    rng = np.random.default_rng(0)
+    batch = rng.integers(256, size=(8, 4, 4, 3), dtype=np.uint8)
+
+    output = AmfImage.rotate_colours(batch, np.random.default_rng(1))
+    theta = np.random.default_rng(1).integers(0, AmfImage.ANGLES, len(batch))
+
+    assert np.array_equal(output[..., 0], batch[..., 0])
+
+    for tile, out, k in zip(batch, output, theta):
+
+        expected = reference_rotation(tile.reshape(-1, 3), k * np.pi / 10)
+        diff = out.reshape(-1, 3).astype(int) - expected
+
+        assert np.abs(diff).max() <= 1
+
+
+
+def test_undo_normalise():
+    """
+    <AmfImage.undo_normalise> is the inverse of <AmfImage.do_normalise>.
+    It used to return values two units too high.
+    """
+
+    values = np.arange(256, dtype=np.float64)
+    restored = AmfImage.undo_normalise(AmfImage.do_normalise(values))
+
+    np.testing.assert_allclose(restored, values, atol=1e-9)
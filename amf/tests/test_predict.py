@@ -0,0 +1,598 @@
+# AMFinder - tests/test_predict.py
+#
+# MIT License
+# Copyright (c) 2021 Edouard Evangelisti, Carl Turner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+"""
+Tests of the prediction mode (`amf predict`).
+"""
+
+import io
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import pyvips
+import pytest
+
+import amfinder_model as AmfModel
+import amfinder_config as AmfConfig
+import amfinder_zipfile as zf
+import amfinder_predict as AmfPredict
+import amfinder_segmentation as AmfSegm
+import amfinder_superresolution as AmfSRGAN
+
+
+
+@pytest.fixture
+def image(tmp_path):
+    """
+    Creates a random 3x5 tile image (126 pixel tiles), with extra pixels
+    on the right and bottom edges that do not form whole tiles.
+    """
+
+    rng = np.random.default_rng(0)
+    data = rng.integers(256, size=(3 * 126 + 50, 5 * 126 + 17, 3),
+                        dtype=np.uint8)
+    path = str(tmp_path / 'image.png')
+    height, width, bands = data.shape
+    pyvips.Image.new_from_memory(data.tobytes(), width, height, bands,
+                                 'uchar').pngsave(path)
+
+    AmfConfig.set('tile_edge', 126)
+    AmfConfig.set('level', 1)
+
+    return pyvips.Image.new_from_file(path, access='sequential')
+
+
+
+def test_batches_match_row_predictions(image, monkeypatch):
+    """
+    CNN1 tiles streamed into fixed-size batches across rows give the same
+    prediction table as the original row by row predictions.
+    """
+
+    monkeypatch.setitem(AmfConfig.PAR, 'batch_size', 4)
+    AmfConfig.set('learning_rate', 0.001)
+    model = AmfModel.create_cnn1()
+    nrows, ncols = 3, 5
+
+    table, _ = AmfPredict.predict_level1(image, nrows, ncols, model)
+
+    # Reference: one call to <model.predict> per row.
+    image = pyvips.Image.new_from_file(image.filename)
+    rows = []
+
+    # Tiles are the same, whatever the batch boundaries.
+    coords = [(r, c) for r in range(nrows) for c in range(ncols)]
+    batches = AmfSegm.batches(image, coords, 4)
+    tiles = np.concatenate([x for _, x in batches])
+
+    for (r, c), x in zip(coords, tiles):
+        assert np.array_equal(x, AmfSegm.tile(image, r, c))
+
+    for r in range(nrows):
+
+        row = [AmfSegm.tile(image, r, c) for c in range(ncols)]
+        row = AmfSegm.preprocess(row)
+        rows.append(pd.DataFrame(model.predict(row, batch_size=4, verbose=0)))
+
+    expected = pd.concat(rows, ignore_index=True)
+    expected.insert(0, column='col', value=list(range(ncols)) * nrows)
+    expected.insert(0, column='row', value=[x // ncols for x in
+                                            range(nrows * ncols)])
+    expected.columns = AmfPredict.table_header()
+
+    # Probabilities may differ in the last float32 digits, as the
+    # convolution kernels depend on the batch size.
+    table = pd.read_csv(io.StringIO(table.to_csv(sep='\t', index=False)),
+                        sep='\t')
+    expected = pd.read_csv(io.StringIO(expected.to_csv(sep='\t',
+                                                       index=False)), sep='\t')
+
+    assert list(table.columns) == list(expected.columns)
+    assert table[['row', 'col']].equals(expected[['row', 'col']])
+    np.testing.assert_allclose(table.values, expected.values,
+                               rtol=1e-5, atol=1e-6)
+
+
+
+def test_fully_convolutional_matches_tiles(image):
+    """
+    Whole-row predictions of the fully convolutional CNN1 (TILE_PITCH
+    layout, dense layers converted to convolutions) match tile by tile
+    predictions of the original network.
+    """
+
+    AmfConfig.set('learning_rate', 0.001)
+    model = AmfModel.create_cnn1()
+    nrows, ncols = 3, 5
+
+    coords = [(r, c) for r in range(nrows) for c in range(ncols)]
+    tiles = AmfPredict.predict_tiles(model, image, coords, batch_size=4)
+
+    image = pyvips.Image.new_from_file(image.filename, access='sequential')
+    strips = AmfPredict.predict_strips(model, image, list(range(nrows)),
+                                       ncols, batch_size=8)
+
+    assert strips.shape == tiles.shape == (nrows * ncols, 3)
+    np.testing.assert_allclose(strips, tiles, rtol=1e-4, atol=1e-5)
+
+
+
+def test_fingerprint_depends_on_backend(tmp_path, monkeypatch):
+    """
+    Tables predicted with another backend are not reused (see -inc).
+    """
+
+    path = tmp_path / 'image.jpg'
+    path.write_bytes(b'image')
+    (tmp_path / 'trained_networks').mkdir()
+    (tmp_path / 'trained_networks' / 'CNN1.h5').write_bytes(b'model')
+    monkeypatch.setattr(AmfConfig, 'get_appdir', lambda: str(tmp_path))
+    monkeypatch.setitem(AmfConfig.PAR, 'model', 'CNN1.h5')
+
+    fps = []
+
+    for level in [1, 2]:
+
+        AmfConfig.set('level', level)
+
+        for backend in ['keras', 'tflite-int8']:
+
+            monkeypatch.setitem(AmfConfig.PAR, 'backend', backend)
+            fps.append(AmfPredict.fingerprint(str(path)))
+
+    assert fps[0] != fps[1] and fps[2] != fps[3]
+
+
+
+def save_background_image(path, edge, orientation=None):
+    """
+    Saves a random 3x4 tile image, in which tile (1, 2) is uniform.
+    """
+
+    # Random 16x16 pixel blocks, which remain visible in thumbnails.
+    rng = np.random.default_rng(0)
+    data = rng.integers(256, size=(3 * edge // 16 + 1, 4 * edge // 16 + 1, 3),
+                        dtype=np.uint8)
+    data = data.repeat(16, axis=0).repeat(16, axis=1)
+    data = np.ascontiguousarray(data[:3 * edge, :4 * edge])
+    data[edge:2 * edge, 2 * edge:3 * edge] = (200, 180, 160)
+    image = pyvips.Image.new_from_memory(data.tobytes(), 4 * edge, 3 * edge,
+                                         3, 'uchar')
+
+    if orientation is None:
+
+        image.pngsave(path)
+
+    else:
+
+        image = image.copy()
+        image.set_type(pyvips.GValue.gint_type, 'orientation', orientation)
+        image.jpegsave(path, Q=95)
+
+    return path
+
+
+
+@pytest.mark.parametrize('name, edge, orientation', [
+    ('image.png', 126, None),
+    # JPEG blocks do not straddle tiles. EXIF orientation 6: the image
+    # is displayed rotated by 90 degrees.
+    ('image.jpg', 128, 6),
+    # Loaded at reduced resolution (shrink-on-load).
+    ('large.jpg', 256, 1),
+])
+def test_background_tiles(tmp_path, monkeypatch, name, edge, orientation):
+    """
+    Only the uniform tile is skipped, and the image can still be read
+    sequentially afterwards.
+    """
+
+    path = save_background_image(str(tmp_path / name), edge, orientation)
+    monkeypatch.setitem(AmfConfig.PAR, 'tile_edge', edge)
+    monkeypatch.setitem(AmfConfig.PAR, 'super_resolution', False)
+
+    image = AmfSegm.load(path, 'sequential', edge)
+    skip = AmfPredict.background_tiles(image, 3, 4, threshold=10)
+
+    expected = np.zeros((3, 4), dtype=bool)
+    expected[1, 2] = True
+    assert np.array_equal(skip, expected)
+
+    coords = [(r, c) for r in range(3) for c in range(4)]
+    tiles = np.concatenate([x for _, x in AmfSegm.batches(image, coords, 5)])
+    assert len(tiles) == 12
+
+
+
+def test_fingerprint_depends_on_fully_convolutional(tmp_path, monkeypatch):
+    """
+    Whole-row CNN1 predictions are not reused for tile predictions (and
+    conversely), but the option has no effect on CNN2 fingerprints.
+    """
+
+    path = tmp_path / 'image.jpg'
+    path.write_bytes(b'image')
+    (tmp_path / 'trained_networks').mkdir()
+    (tmp_path / 'trained_networks' / 'CNN1.h5').write_bytes(b'model')
+    monkeypatch.setattr(AmfConfig, 'get_appdir', lambda: str(tmp_path))
+    monkeypatch.setitem(AmfConfig.PAR, 'model', 'CNN1.h5')
+
+    fps = []
+
+    for level in [1, 2]:
+
+        monkeypatch.setitem(AmfConfig.PAR, 'level', level)
+
+        for fcn in [False, True]:
+
+            monkeypatch.setitem(AmfConfig.PAR, 'fully_convolutional', fcn)
+            fps.append(AmfPredict.fingerprint(str(path)))
+
+    assert fps[0] != fps[1] and fps[2] == fps[3]
+
+
+
+class CountingModel:
+    """
+    Stands in for a network, and records the number of tiles predicted.
+    Probabilities are derived from mean tile intensities.
+    """
+
+    def __init__(self, outputs=None):
+
+        self.outputs = outputs
+        self.tiles = 0
+
+
+    def predict(self, x, batch_size=32, verbose=0):
+
+        self.tiles += len(x)
+        mean = np.asarray(x).mean(axis=(1, 2, 3))[:, None]
+
+        if self.outputs is None:
+            return np.hstack([mean, 1 - mean, np.zeros_like(mean)])
+
+        return [mean / (k + 1) for k in range(self.outputs)]
+
+
+
+@pytest.fixture
+def incremental(image, tmp_path, monkeypatch):
+    """
+    Enables incremental predictions, with a stand-in network file.
+    """
+
+    folder = tmp_path / 'appdir' / 'trained_networks'
+    folder.mkdir(parents=True)
+    (folder / 'CNN.h5').write_bytes(b'model')
+    monkeypatch.setattr(AmfConfig, 'get_appdir',
+                        lambda: str(tmp_path / 'appdir'))
+
+    for key, value in [('model', 'CNN.h5'), ('incremental', True),
+                       ('level', 1), ('header', AmfConfig.HEADERS[0]),
+                       ('backend', 'keras'), ('super_resolution', False),
+                       ('background_threshold', None),
+                       ('fully_convolutional', False), ('batch_size', 8),
+                       ('save_conv2d_kernels', False),
+                       ('save_conv2d_outputs', False)]:
+        monkeypatch.setitem(AmfConfig.PAR, key, value)
+
+    return image.filename
+
+
+
+def archive(path):
+
+    with open(AmfConfig.get_zipfile(path), 'rb') as f:
+        return f.read()
+
+
+
+def test_incremental_level1(incremental, monkeypatch):
+    """
+    CNN1 predictions made with the same inputs are reused, and not saved
+    again. Changed images are predicted again.
+    """
+
+    model = CountingModel()
+    AmfPredict.run([incremental], model=model)
+    saved = archive(incremental)
+
+    assert model.tiles == 15
+
+    AmfPredict.run([incremental], model=model)
+
+    assert model.tiles == 15
+    assert archive(incremental) == saved
+
+    # New image contents, same file name.
+    data = np.random.default_rng(1).integers(256, size=(428, 647, 3),
+                                             dtype=np.uint8)
+    pyvips.Image.new_from_memory(data.tobytes(), 647, 428, 3,
+                                 'uchar').pngsave(incremental)
+
+    AmfPredict.run([incremental], model=model)
+
+    assert model.tiles == 30
+    assert archive(incremental) != saved
+
+
+
+def level2_archive(path, colonised):
+    """
+    Writes CNN1 annotations in which the given tiles are colonised.
+    """
+
+    lines = ['row\tcol\tY\tN\tX']
+    lines += [f'{r}\t{c}\t{int((r, c) in colonised)}\t0\t0'
+              for r in range(3) for c in range(5)]
+
+    with zf.ZipFile(AmfConfig.get_zipfile(path), 'w') as z:
+        z.writestr('col.tsv', '\n'.join(lines))
+
+
+
+def test_incremental_level2(incremental, monkeypatch):
+    """
+    CNN2 predictions of tiles which are still colonised are reused, only
+    newly colonised tiles are predicted, and tables without any change
+    are not saved again.
+    """
+
+    monkeypatch.setitem(AmfConfig.PAR, 'level', 2)
+    monkeypatch.setitem(AmfConfig.PAR, 'header', AmfConfig.HEADERS[1])
+    image = pyvips.Image.new_from_file(incremental)
+    model = CountingModel(outputs=4)
+
+    level2_archive(incremental, [(0, 0), (1, 2), (2, 4)])
+    first, _ = AmfPredict.predict_level2(incremental, image, 3, 5, model)
+
+    assert model.tiles == 3
+
+    # Same annotations: nothing to predict.
+    image = pyvips.Image.new_from_file(incremental)
+    table, _ = AmfPredict.predict_level2(incremental, image, 3, 5, model,
+                                         first)
+
+    assert model.tiles == 3
+    assert table.attrs.get('unchanged')
+    assert table.equals(first)
+
+    # (1, 2) is no longer colonised, (2, 1) now is.
+    level2_archive(incremental, [(0, 0), (2, 1), (2, 4)])
+    image = pyvips.Image.new_from_file(incremental)
+    table, _ = AmfPredict.predict_level2(incremental, image, 3, 5, model,
+                                         first)
+
+    assert model.tiles == 4
+    assert not table.attrs.get('unchanged')
+    assert list(zip(table['row'], table['col'])) == [(0, 0), (2, 1), (2, 4)]
+
+    # Reused predictions are those of the previous table.
+    old = first.set_index(['row', 'col'])
+    new = table.set_index(['row', 'col'])
+    assert new.loc[[(0, 0), (2, 4)]].equals(old.loc[[(0, 0), (2, 4)]])
+
+    # Unchanged tables are not saved.
+    saved = archive(incremental)
+    unchanged = first.copy()
+    unchanged.attrs['unchanged'] = True
+    AmfPredict.AmfSave.prediction_table(unchanged, None, incremental)
+
+    assert archive(incremental) == saved
+
+
+
+@pytest.fixture
+def canvas_dir(tmp_path, monkeypatch):
+    """
+    Enables super-resolution, with canvases in a dedicated folder.
+    """
+
+    path = tmp_path / 'canvases'
+    path.mkdir()
+
+    monkeypatch.setitem(AmfConfig.PAR, 'super_resolution', True)
+    monkeypatch.setitem(AmfConfig.PAR, 'background_threshold', 1)
+    monkeypatch.setattr(AmfSRGAN, 'CANVAS_DIR', str(path))
+    AmfConfig.set('level', 1)
+
+    # Row 1 is empty, other rows are predicted.
+    skip = np.zeros((3, 4), dtype=bool)
+    skip[1] = True
+    monkeypatch.setattr(AmfPredict, 'background_tiles', lambda *_: skip)
+
+    return path
+
+
+
+def test_canvas_only_blank_rows_are_filled(canvas_dir, monkeypatch):
+    """
+    Only rows which are not generated are filled with white, and the
+    canvas file is not written otherwise.
+    """
+
+    def predict_tiles(model, image, coords, batch_size, sr_image):
+        return np.zeros((len(coords), 3), dtype=np.float32)
+
+    monkeypatch.setattr(AmfPredict, 'predict_tiles', predict_tiles)
+
+    _, canvas = AmfPredict.predict_level1(None, 3, 4, None)
+    edge = AmfSRGAN.HR_EDGE
+
+    assert canvas.shape == (3 * edge, 4 * edge, 3)
+    assert (canvas[edge:2 * edge] == 255).all()
+    assert (canvas[:edge] == 0).all() and (canvas[2 * edge:] == 0).all()
+    assert os.stat(canvas.filename).st_blocks * 512 < canvas.nbytes
+
+    AmfSRGAN.discard(canvas)
+    assert os.listdir(canvas_dir) == []
+
+
+
+def test_canvas_removed_on_interrupt(canvas_dir, monkeypatch):
+    """
+    Canvas files are removed when predictions fail or are interrupted.
+    """
+
+    def predict_tiles(*_):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(AmfPredict, 'predict_tiles', predict_tiles)
+
+    with pytest.raises(KeyboardInterrupt):
+        AmfPredict.predict_level1(None, 3, 4, None)
+
+    assert os.listdir(canvas_dir) == []
+
+
+
+def test_canvas_removed_when_saving_fails(canvas_dir, monkeypatch):
+
+    def predict_image(model, path, sequential):
+        return (None, None, AmfSRGAN.initialize(3, 4))
+
+    def prediction_table(*_):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(AmfPredict, 'predict_image', predict_image)
+    monkeypatch.setattr(AmfPredict.AmfSave, 'prediction_table',
+                        prediction_table)
+    monkeypatch.setitem(AmfConfig.PAR, 'save_conv2d_kernels', False)
+
+    with pytest.raises(OSError):
+        AmfPredict.run(['image.jpg'], model=object())
+
+    assert os.listdir(canvas_dir) == []
+
+
+
+@pytest.mark.parametrize('level', [1, 2])
+def test_last_batch_padded(level, monkeypatch):
+    """
+    Tile counts which are not a multiple of the batch size are predicted
+    with a single traced step, the last batch being padded (CNN1 and the
+    multiple outputs of CNN2).
+    """
+
+    monkeypatch.setitem(AmfConfig.PAR, 'header', AmfConfig.get('header'))
+    monkeypatch.setitem(AmfConfig.PAR, 'level', AmfConfig.get('level'))
+    AmfConfig.set('learning_rate', 0.001)
+    AmfConfig.set('level', level)
+    model = AmfModel.create_cnn1() if level == 1 else AmfModel.create_cnn2()
+    inference = AmfModel.inference(model)
+
+    rng = np.random.default_rng(0)
+    size = AmfModel.INPUT_SIZE
+    tiles = rng.random((7, size, size, 3), dtype=np.float32)
+
+    prd = inference.predict(tiles, batch_size=4)
+    expected = model.predict(tiles, batch_size=4, verbose=0)
+
+    assert len(inference.steps) == 1
+
+    if level == 1:
+
+        assert prd.shape == (7, 3)
+        np.testing.assert_allclose(prd, expected, rtol=1e-4, atol=1e-5)
+
+    else:
+
+        assert len(prd) == len(AmfConfig.get('header'))
+        for x, y in zip(prd, expected):
+            assert x.shape == (7, 1)
+            np.testing.assert_allclose(x, y, rtol=1e-4, atol=1e-5)
+
+
+
+def last_predictions(path):
+    """
+    Reads the last prediction table saved in the archive of an image.
+    """
+
+    with zf.ZipFile(AmfConfig.get_zipfile(path)) as z:
+
+        tsv = sorted(x for x in z.namelist() if x.startswith('predictions/')
+                     and x.endswith('.tsv'))[-1]
+        data = io.StringIO(z.read(tsv).decode('utf-8'))
+        sr = [x for x in z.namelist() if x.endswith('.jpg')]
+
+        return pd.read_csv(data, sep='\t'), sr
+
+
+
+def test_workers(networks, tmp_path, monkeypatch):
+    """
+    Two images predicted by two worker processes (spawn pool) are saved in
+    their own archives, with the same tables as in a single process, and
+    no canvas file is left behind.
+    """
+
+    edge = AmfSRGAN.LR_EDGE
+    grids = {'a.png': (1, 3), 'b.png': (2, 1)}
+    rng = np.random.default_rng(0)
+    paths = []
+
+    for name, (nrows, ncols) in grids.items():
+
+        data = rng.integers(256, size=(nrows * edge, ncols * edge, 3),
+                            dtype=np.uint8)
+        path = str(tmp_path / name)
+        pyvips.Image.new_from_memory(data.tobytes(), ncols * edge,
+                                     nrows * edge, 3, 'uchar').pngsave(path)
+        paths.append(path)
+
+    scratch = tmp_path / 'tmp'
+    scratch.mkdir()
+    monkeypatch.setattr(tempfile, 'tempdir', str(scratch))
+    monkeypatch.setattr(AmfSRGAN, 'CANVAS_DIR', str(scratch))
+
+    monkeypatch.setitem(AmfConfig.PAR, 'level', 1)
+    monkeypatch.setitem(AmfConfig.PAR, 'tile_edge', edge)
+    monkeypatch.setitem(AmfConfig.PAR, 'batch_size', 4)
+    monkeypatch.setitem(AmfConfig.PAR, 'super_resolution', True)
+
+    results = {}
+
+    for workers in [2, 1]:
+
+        monkeypatch.setitem(AmfConfig.PAR, 'workers', workers)
+        AmfPredict.run(paths)
+
+        canvases = [x for x in os.listdir(scratch)
+                    if x.startswith('amfinder-sr-')]
+        assert canvases == []
+        results[workers] = [last_predictions(x) for x in paths]
+
+    for path, (table, sr), (other, _) in zip(paths, results[2], results[1]):
+
+        nrows, ncols = grids[os.path.basename(path)]
+        rows = [x // ncols for x in range(nrows * ncols)]
+
+        assert table['row'].tolist() == rows
+        assert table['col'].tolist() == list(range(ncols)) * nrows
+        assert len(sr) == 1
+        np.testing.assert_allclose(table.values, other.values,
+                                   rtol=1e-4, atol=1e-5)
@@ -0,0 +1,251 @@
+# AMFinder - tests/test_segmentation.py
+#
+# MIT License
+# Copyright (c) 2021 Edouard Evangelisti, Carl Turner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+"""
+Tests of tile extraction, from images loaded at reduced resolution and
+in background threads.
+"""
+
+import threading
+import numpy as np
+import pyvips
+import pytest
+
+import amfinder_config as AmfConfig
+import amfinder_segmentation as AmfSegm
+
+# Image sizes are not multiples of the tile edge. 503x503 pixels with
+# 252 pixel tiles used to give an extra row and column after shrink.
+CASES = [(503, 503, 252), (1300, 1037, 252), (2100, 1530, 504)]
+
+
+
+def smooth_image(width, height):
+    """
+    Creates a smooth RGB image, on which downsampling methods agree.
+    """
+
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    data = np.stack([127 + 100 * np.sin(x / 97) * np.cos(y / 131),
+                     127 + 100 * np.cos((x + y) / 151),
+                     255 * x / width], axis=-1)
+
+    data = np.ascontiguousarray(np.clip(data, 0, 255).astype(np.uint8))
+    return pyvips.Image.new_from_memory(data.tobytes(), width, height, 3,
+                                        'uchar')
+
+
+
+def full_resolution_tiles(path, edge):
+    """
+    Extracts tiles as before shrink-on-load, i.e. from the full
+    resolution image.
+    """
+
+    image = AmfSegm.load(path)
+    nrows, ncols = image.height // edge, image.width // edge
+
+    return np.array([[AmfSegm.tile(image, r, c, edge) for c in range(ncols)]
+                     for r in range(nrows)])
+
+
+
+def check_tiles(path, edge):
+    """
+    Compares tiles extracted at reduced resolution with tiles extracted
+    from the full resolution image.
+    """
+
+    reference = full_resolution_tiles(path, edge)
+    image = AmfSegm.load(path, access='sequential', edge=edge)
+
+    assert image.get(AmfSegm.SHRINK) > 1
+    assert AmfSegm.grid_size(image, edge) == reference.shape[:2]
+
+    tiles = np.array([x for _, x in AmfSegm.strips(image, edge=edge)])
+    assert tiles.shape == reference.shape
+
+    image = AmfSegm.load(path, edge=edge)
+    r, c = reference.shape[0] - 1, reference.shape[1] - 1
+    assert np.array_equal(AmfSegm.tile(image, r, c, edge), tiles[r, c])
+
+    diff = np.abs(tiles.astype(np.int16) - reference)
+    assert diff.mean() < 2
+    assert np.percentile(diff, 99) < 8
+
+
+
+@pytest.mark.parametrize('width, height, edge', CASES)
+def test_jpeg_shrink_on_load(tmp_path, width, height, edge):
+
+    path = str(tmp_path / 'image.jpg')
+    smooth_image(width, height).jpegsave(path, Q=95)
+
+    check_tiles(path, edge)
+
+
+
+def test_grid_ignores_rounded_up_size():
+    """
+    Shrunk images may be one pixel larger than the full resolution size
+    divided by the downsampling factor (libjpeg rounds up, e.g. 252x252
+    pixels for a 503x503 image shrunk by 2). The grid must not change.
+    """
+
+    base = smooth_image(503, 503)
+    small = base.resize(0.5).embed(0, 0, 252, 252, extend='copy')
+    image = AmfSegm.downsampled(small, 2, base.width, base.height)
+
+    assert AmfSegm.grid_size(image, 252) == (1, 1)
+
+    strips = list(AmfSegm.strips(image, edge=252))
+    assert [r for r, _ in strips] == [0]
+    assert strips[0][1].shape == (1, 126, 126, 3)
+
+
+
+def save_pyramid(path, base, sizes):
+    """
+    Saves a multi-page TIFF image, with one page per reduced level.
+    """
+
+    from PIL import Image
+
+    def pil(x):
+        data = np.ndarray(buffer=x.write_to_memory(), dtype=np.uint8,
+                          shape=[x.height, x.width, x.bands])
+        return Image.fromarray(data)
+
+    levels = [base.resize(w / base.width, vscale=h / base.height)
+              for w, h in sizes]
+    pil(base).save(path, save_all=True, append_images=[pil(x) for x in levels])
+
+
+
+@pytest.mark.parametrize('width, height, edge', CASES)
+def test_pyramidal_tiff(tmp_path, width, height, edge):
+
+    path = str(tmp_path / 'image.tif')
+    base = smooth_image(width, height)
+    save_pyramid(path, base, [(-(-width // 2), -(-height // 2)),
+                              (-(-width // 4), -(-height // 4))])
+
+    check_tiles(path, edge)
+
+
+
+def test_pyramid_level_rounded_up(tmp_path):
+    """
+    Levels rounded up do not add rows or columns to the base level grid.
+    """
+
+    path = str(tmp_path / 'image.tif')
+    save_pyramid(path, smooth_image(503, 503), [(252, 252)])
+    image = AmfSegm.load(path, edge=252)
+
+    assert image.get(AmfSegm.SHRINK) == 2
+    assert AmfSegm.grid_size(image, 252) == (1, 1)
+    assert len(list(AmfSegm.strips(image, edge=252))) == 1
+
+
+
+def test_pyramid_level_too_small(tmp_path):
+    """
+    Levels that do not cover the base level grid are not used.
+    """
+
+    path = str(tmp_path / 'image.tif')
+    save_pyramid(path, smooth_image(504, 504), [(251, 251)])
+    image = AmfSegm.load(path, edge=252)
+
+    assert image.width == 504
+    assert AmfSegm.grid_size(image, 252) == (2, 2)
+
+
+
+def source(count, log):
+    """
+    Yields integers, and records those which have been produced.
+    """
+
+    for x in range(count):
+        log.append(x)
+        yield x
+
+
+
+def test_prefetch_consumer_exits_early():
+    """
+    The producer stops when the consumer leaves the loop early.
+    """
+
+    before = threading.enumerate()
+    log = []
+
+    for x in AmfSegm.prefetch(source(1000, log), 2):
+        if x == 3:
+            break
+
+    assert threading.enumerate() == before
+    # At most <depth> items are buffered ahead of the consumer.
+    assert len(log) < 10
+
+
+
+def test_prefetch_consumer_raises():
+    """
+    The producer stops when the consumer raises an exception.
+    """
+
+    before = threading.enumerate()
+    log = []
+
+    with pytest.raises(ValueError):
+        for x in AmfSegm.prefetch(source(1000, log), 2):
+            if x == 3:
+                raise ValueError(x)
+
+    assert threading.enumerate() == before
+    assert len(log) < 10
+
+
+
+def test_prefetch_producer_raises():
+    """
+    Exceptions raised while producing items reach the consumer, in order.
+    """
+
+    def failing():
+        yield from range(3)
+        raise OSError('truncated image')
+
+    before = threading.enumerate()
+    items = []
+
+    with pytest.raises(OSError):
+        for x in AmfSegm.prefetch(failing(), 2):
+            items.append(x)
+
+    assert items == [0, 1, 2]
+    assert threading.enumerate() == before
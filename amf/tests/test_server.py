@@ -0,0 +1,245 @@
+# AMFinder - tests/test_server.py
+#
+# MIT License
+# Copyright (c) 2021 Edouard Evangelisti, Carl Turner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+"""
+Tests of the prediction daemon (`amf serve`).
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import signal
+import socket
+import subprocess
+import numpy as np
+import pyvips
+import pytest
+
+from conftest import AMF_DIR
+
+import amfinder_zipfile as zf
+import amfinder_config as AmfConfig
+import amfinder_server as AmfServer
+
+
+
+def send_job(client, settings, images):
+    """
+    Sends a job as `amf predict` does, and returns the daemon output.
+    """
+
+    job = {'settings': settings, 'images': images}
+    client.sendall((json.dumps(job) + '\n').encode('utf-8'))
+    client.shutdown(socket.SHUT_WR)
+
+    with client.makefile('r', encoding='utf-8', newline='') as stream:
+
+        return stream.read()
+
+
+
+def test_submit_serve(networks, tmp_path, monkeypatch, capsys):
+    """
+    A job submitted to a daemon listening on a private socket is predicted
+    by the daemon, and its output and exit code are sent back.
+    """
+
+    path = str(tmp_path / 'amf.sock')
+    cmd = [sys.executable, os.path.join(AMF_DIR, 'amf'), 'serve',
+           '-net', AmfConfig.PAR['model'], '-sock', path]
+    daemon = subprocess.Popen(cmd, cwd=tmp_path, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+
+    try:
+
+        deadline = time.monotonic() + 120
+
+        while not os.path.exists(path):
+
+            assert daemon.poll() is None and time.monotonic() < deadline
+            time.sleep(0.1)
+
+        assert AmfServer.owned(path)
+        assert os.stat(path).st_mode & 0o777 == 0o600
+
+        image = str(tmp_path / 'image.png')
+        data = np.random.default_rng(0).integers(256, size=(252, 378, 3),
+                                                 dtype=np.uint8)
+        pyvips.Image.new_from_memory(data.tobytes(), 378, 252, 3,
+                                     'uchar').pngsave(image)
+
+        monkeypatch.setitem(AmfConfig.PAR, 'socket', path)
+        monkeypatch.setitem(AmfConfig.PAR, 'level', 1)
+        monkeypatch.setitem(AmfConfig.PAR, 'tile_edge', 126)
+        monkeypatch.setitem(AmfConfig.PAR, 'super_resolution', False)
+
+        assert AmfServer.submit([image]) == 0
+        assert 'Image image.png' in capsys.readouterr().out
+
+        with zf.ZipFile(AmfConfig.get_zipfile(image)) as z:
+
+            tsv = [x for x in z.namelist() if x.endswith('.tsv')]
+            table = z.read(tsv[0]).decode('utf-8').splitlines()
+
+        assert len(tsv) == 1
+        assert len(table) == 1 + 2 * 3
+
+    finally:
+
+        daemon.send_signal(signal.SIGINT)
+        daemon.wait(60)
+
+    # The daemon removes its socket on exit.
+    assert not os.path.exists(path)
+
+
+
+def test_job_settings_do_not_leak(monkeypatch):
+    """
+    The settings of a job are restored once the job is over.
+    """
+
+    import amfinder_predict as AmfPredict
+
+    seen = {}
+
+    def run(images, model=None):
+        seen.update(copy.deepcopy(AmfConfig.PAR))
+        print('Predicted', *images)
+
+    monkeypatch.setattr(AmfPredict, 'run', run)
+    monkeypatch.setattr(AmfServer, 'get_model', lambda: None)
+
+    before = copy.deepcopy(AmfConfig.PAR)
+    settings = copy.deepcopy(AmfConfig.PAR)
+    settings.update(batch_size=7, incremental=True, tile_edge=200)
+
+    server, client = socket.socketpair()
+
+    with server, client:
+
+        client.sendall((json.dumps({'settings': settings,
+                                    'images': ['a.jpg']}) + '\n').encode())
+        client.shutdown(socket.SHUT_WR)
+        AmfServer.run_job(server)
+        server.shutdown(socket.SHUT_WR)
+        output = client.makefile('r', encoding='utf-8', newline='').read()
+
+    assert output == f'Predicted a.jpg\n{AmfServer.END_OF_JOB}0'
+    assert seen['batch_size'] == 7 and seen['incremental']
+    assert AmfConfig.PAR == before
+
+
+
+def test_job_from_another_user_rejected(monkeypatch):
+    """
+    Jobs sent by another user are not run.
+    """
+
+    def run_job(conn):
+        raise AssertionError('job run')
+
+    monkeypatch.setattr(AmfServer, 'run_job', run_job)
+    monkeypatch.setattr(AmfServer, 'peer_uid', lambda conn: os.getuid() + 1)
+
+    server, client = socket.socketpair()
+
+    with server, client:
+
+        assert not AmfServer.accept_job(server)
+
+
+
+@pytest.mark.skipif(not hasattr(socket, 'SO_PEERCRED') or os.getuid() != 0,
+                    reason='requires SO_PEERCRED, and root to switch users')
+def test_connection_from_another_uid_refused(monkeypatch):
+    """
+    The daemon identifies clients run by another user from the connection
+    itself (SO_PEERCRED), and refuses their jobs.
+    """
+
+    def run_job(conn):
+        raise AssertionError('job run')
+
+    monkeypatch.setattr(AmfServer, 'run_job', run_job)
+
+    # Abstract socket: not subject to file permissions.
+    address = f'\0amfinder-test-{os.getpid()}'
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+
+        server.bind(address)
+        server.listen()
+
+        pid = os.fork()
+
+        if pid == 0:
+
+            try:
+                os.setuid(65534)
+                client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                client.connect(address)
+                client.recv(1)
+            finally:
+                os._exit(0)
+
+        try:
+
+            conn, _ = server.accept()
+
+            with conn:
+
+                assert AmfServer.peer_uid(conn) == 65534
+                assert not AmfServer.accept_job(conn)
+
+        finally:
+
+            os.waitpid(pid, 0)
+
+
+
+def test_submit_to_another_user_refused(tmp_path, monkeypatch):
+    """
+    Jobs are not submitted to a daemon run by another user.
+    """
+
+    path = str(tmp_path / 'amf.sock')
+    monkeypatch.setitem(AmfConfig.PAR, 'socket', path)
+    monkeypatch.setattr(AmfServer, 'peer_uid', lambda conn: os.getuid() + 1)
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+
+        server.bind(path)
+        server.listen()
+
+        assert AmfServer.submit(['a.jpg']) is None
+
+        conn, _ = server.accept()
+
+        with conn:
+
+            # Nothing was sent.
+            assert conn.recv(1) == b''
@@ -0,0 +1,158 @@
+# AMFinder - tests/test_superresolution.py
+#
+# MIT License
+# Copyright (c) 2021 Edouard Evangelisti, Carl Turner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+"""
+Tests of strip-based super-resolution, using a generator with random
+weights (no pre-trained generator is needed).
+"""
+
+import numpy as np
+import pyvips
+import pytest
+
+import amfinder_model as AmfModel
+import amfinder_config as AmfConfig
+import amfinder_superresolution as AmfSRGAN
+
+HALO = AmfSRGAN.HALO
+BIN = AmfSRGAN.BIN_SIZE
+LR_EDGE = AmfSRGAN.LR_EDGE
+HR_EDGE = AmfSRGAN.HR_EDGE
+
+
+
+@pytest.fixture
+def generator(monkeypatch):
+    """
+    Installs a randomly initialised generator in place of the pre-trained
+    one, and returns a function running it on a whole image at once.
+    """
+
+    import tensorflow as tf
+
+    tf.random.set_seed(0)
+    model = AmfSRGAN.build_generator(shape=(None, None, AmfSRGAN.CHANNELS))
+
+    monkeypatch.setitem(AmfConfig.PAR, 'generator', 'random.h5')
+    monkeypatch.setitem(AmfConfig.PAR, 'super_resolution', True)
+    monkeypatch.setitem(AmfConfig.PAR, 'tile_edge', LR_EDGE)
+    monkeypatch.setitem(AmfConfig.PAR, 'batch_size', 16)
+    monkeypatch.setattr(AmfSRGAN, 'GENERATOR', AmfModel.inference(model))
+    monkeypatch.setattr(AmfSRGAN, 'GENERATOR_PATH',
+                        AmfConfig.get('generator'))
+
+    def whole(lr):
+        """
+        Single pass on the whole image, extended by HALO mirrored pixels.
+        """
+        padded = np.pad(lr, ((HALO, HALO), (HALO, HALO), (0, 0)),
+                        mode='reflect')
+        out = model.predict(AmfSRGAN.preprocess([padded]), verbose=0)
+        h = HALO * BIN
+        return AmfSRGAN.restore(out[0, h:-h, h:-h])
+
+    return whole
+
+
+
+def random_image(nrows, ncols):
+
+    rng = np.random.default_rng(0)
+    return rng.integers(256, size=(nrows * LR_EDGE, ncols * LR_EDGE, 3),
+                        dtype=np.uint8)
+
+
+
+def assert_same(actual, expected):
+    """
+    Outputs may only differ by float rounding (one grey level).
+    """
+
+    assert actual.shape == expected.shape
+    diff = np.abs(actual.astype(np.int16) - expected)
+    assert diff.max() <= 1
+    assert diff.mean() < 0.01
+    # The random generator does not produce a uniform image.
+    assert expected.std() > 1
+
+
+
+def test_chunks_match_whole_strip(generator, monkeypatch):
+    """
+    Halo-cropped chunks join without seams (here, two tiles per chunk,
+    the last chunk being incomplete).
+    """
+
+    monkeypatch.setattr(AmfSRGAN, 'CHUNK', 2)
+    strip = random_image(2, 5)
+    actual = AmfSRGAN.improve_strip(None, strip, None, batch_size=2)
+
+    assert_same(actual, generator(strip))
+
+
+
+@pytest.mark.parametrize('height', [1, 2])
+def test_strips_match_whole_image(tmp_path, generator, monkeypatch, height):
+    """
+    Strips of <height> tile rows join without seams.
+    """
+
+    monkeypatch.setattr(AmfSRGAN, 'CHUNK', 1)
+    lr = random_image(4, 2)
+    path = str(tmp_path / 'image.png')
+    pyvips.Image.new_from_memory(lr.tobytes(), lr.shape[1], lr.shape[0], 3,
+                                 'uchar').pngsave(path)
+    image = pyvips.Image.new_from_file(path, access='sequential')
+
+    canvas = np.zeros((lr.shape[0] * BIN, lr.shape[1] * BIN, 3), np.uint8)
+    rows = list(range(4))
+
+    for first, strip in AmfSRGAN.strips(image, rows, height):
+
+        canvas[first * HR_EDGE:first * HR_EDGE + strip.shape[0]] = strip
+
+    assert_same(canvas, generator(lr))
+
+
+
+def test_tile_centres_match_per_tile_generation(generator):
+    """
+    Per-tile generation only differs near tile borders, within the
+    receptive field radius of the generator (18 low-resolution pixels).
+    """
+
+    strip = random_image(1, 4)
+    actual = AmfSRGAN.improve_strip(None, strip, None, batch_size=2)
+
+    tiles = [strip[:, c * LR_EDGE:(c + 1) * LR_EDGE] for c in range(4)]
+    model = AmfSRGAN.load_generator()
+    per_tile = AmfSRGAN.restore(model.predict(AmfSRGAN.preprocess(tiles),
+                                              batch_size=4))
+
+    m = 18 * BIN
+
+    for c, tile in enumerate(per_tile):
+
+        x = c * HR_EDGE
+        assert_same(actual[m:-m, x + m:x + HR_EDGE - m], tile[m:-m, m:-m])
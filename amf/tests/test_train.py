@@ -0,0 +1,298 @@
+# AMFinder - tests/test_train.py
+#
+# MIT License
+# Copyright (c) 2021 Edouard Evangelisti, Carl Turner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+"""
+Tests of the training mode (`amf train`), on small synthetic datasets.
+"""
+
+import os
+import json
+import tracemalloc
+import numpy as np
+import pyvips
+import pytest
+
+import amfinder_zipfile as zf
+import amfinder_config as AmfConfig
+import amfinder_random as AmfRandom
+import amfinder_train as AmfTrain
+import amfinder_segmentation as AmfSegm
+
+
+
+def annotated_image(tmp_path, name, nrows, ncols, edge=126, seed=0):
+    """
+    Creates a random image, and an archive with CNN1 annotations
+    (one class per tile, in turn).
+    """
+
+    rng = np.random.default_rng(seed)
+    data = rng.integers(256, size=(nrows * edge, ncols * edge, 3),
+                        dtype=np.uint8)
+    path = str(tmp_path / f'{name}.png')
+    pyvips.Image.new_from_memory(data.tobytes(), ncols * edge, nrows * edge,
+                                 3, 'uchar').pngsave(path)
+
+    lines = ['row\tcol\tY\tN\tX']
+
+    for r in range(nrows):
+        for c in range(ncols):
+            hot = [int((r * ncols + c) % 3 == k) for k in range(3)]
+            lines.append('\t'.join(str(x) for x in [r, c] + hot))
+
+    with zf.ZipFile(str(tmp_path / f'{name}.zip'), 'w') as z:
+        z.writestr('settings.json', json.dumps({'tile_edge': edge}))
+        z.writestr('col.tsv', '\n'.join(lines))
+
+    return path
+
+
+
+@pytest.fixture
+def dataset(tmp_path, monkeypatch):
+    """
+    Two annotated images (2x3 and 3x2 tiles), at level 1 without
+    background subsampling.
+    """
+
+    monkeypatch.setitem(AmfConfig.PAR, 'level', 1)
+    monkeypatch.setitem(AmfConfig.PAR, 'header', AmfConfig.HEADERS[0])
+    monkeypatch.setitem(AmfConfig.PAR, 'drop', False)
+    monkeypatch.setitem(AmfConfig.PAR, 'batch_size', 4)
+    monkeypatch.setitem(AmfConfig.PAR, 'outdir', str(tmp_path))
+
+    return [annotated_image(tmp_path, 'a', 2, 3, seed=1),
+            annotated_image(tmp_path, 'b', 3, 2, seed=2)]
+
+
+
+def test_load_dataset_returns_indices(dataset, tmp_path):
+    """
+    The training dataset is loaded as tile coordinates and annotations,
+    so that memory use does not grow with tile pixels.
+    """
+
+    dataset = [annotated_image(tmp_path, 'c', 2, 3, edge=504, seed=1),
+               annotated_image(tmp_path, 'd', 3, 2, edge=504, seed=2)]
+
+    tracemalloc.start()
+
+    try:
+
+        images, index, labels = AmfTrain.load_dataset(dataset)
+        _, peak = tracemalloc.get_traced_memory()
+
+    finally:
+
+        tracemalloc.stop()
+
+    assert images == [(dataset[0], 504), (dataset[1], 504)]
+    assert index.dtype == np.int32 and labels.dtype == np.uint8
+    assert index.tolist() == [[0, r, c] for r in range(2) for c in range(3)] + \
+                             [[1, r, c] for r in range(3) for c in range(2)]
+    assert labels.shape == (12, 3)
+    assert labels.argmax(axis=1).tolist() == [0, 1, 2, 0, 1, 2] * 2
+
+    # Far less than the 12 tiles as uint8 (504x504x3 pixels each).
+    assert peak < 12 * 504 * 504 * 3 / 10
+
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """
+    Writes a tile store of 10 tiles, in which tile k is filled with the
+    value k, and labelled with class k % 3.
+    """
+
+    monkeypatch.setitem(AmfConfig.PAR, 'level', 1)
+    monkeypatch.setitem(AmfConfig.PAR, 'batch_size', 4)
+    monkeypatch.setitem(AmfConfig.PAR, 'super_resolution', False)
+
+    size = AmfSegm.tile_size()
+    tiles = np.broadcast_to(np.arange(10, dtype=np.uint8)[:, None, None, None],
+                            (10, size, size, 3))
+    labels = np.eye(3, dtype=np.uint8)[np.arange(10) % 3]
+
+    np.save(str(tmp_path / 'tiles.npy'), tiles)
+    np.save(str(tmp_path / 'labels.npy'), labels)
+
+    return str(tmp_path)
+
+
+
+def epoch(seq):
+    """
+    Returns the tiles (by value) and labels of each batch of an epoch,
+    then moves to the next epoch.
+    """
+
+    batches = []
+
+    for i in range(len(seq)):
+
+        x, y = seq[i]
+        ids = np.rint(x[:, 0, 0, 0] * 255).astype(int).tolist()
+        assert (y.argmax(axis=1) == np.array(ids) % 3).all()
+        batches.append(ids)
+
+    seq.on_epoch_end()
+
+    return batches
+
+
+
+def test_tile_sequence_batches(store):
+    """
+    Batches contain up to --batch_size tiles, and only the tiles
+    given to the sequence.
+    """
+
+    positions = [0, 2, 3, 5, 6, 7, 9]
+    seq = AmfTrain.TileSequence(store, positions)
+    batches = epoch(seq)
+
+    assert len(seq) == 2
+    assert batches == [[0, 2, 3, 5], [6, 7, 9]]
+
+
+
+def test_tile_sequence_validation_order(store):
+    """
+    Validation batches are not shuffled, and stay the same across epochs.
+    """
+
+    seq = AmfTrain.TileSequence(store, [9, 1, 5, 3, 7])
+
+    assert epoch(seq) == epoch(seq) == [[1, 3, 5, 7], [9]]
+
+
+
+def test_tile_sequence_shuffle(store):
+    """
+    Training tiles are reshuffled at every epoch, and each epoch uses
+    every tile once.
+    """
+
+    seq = AmfTrain.TileSequence(store, list(range(10)), shuffle=True)
+    epochs = [epoch(seq) for _ in range(3)]
+
+    for batches in epochs:
+
+        assert [len(x) for x in batches] == [4, 4, 2]
+        assert sorted(sum(batches, [])) == list(range(10))
+
+    orders = [sum(x, []) for x in epochs]
+    assert orders[0] != orders[1] or orders[1] != orders[2]
+
+
+
+def test_write_tile_store(dataset, tmp_path):
+    """
+    The tile store holds the tiles of the index, in index order.
+    """
+
+    images, index, labels = AmfTrain.load_dataset(dataset)
+    store = tmp_path / 'store'
+    store.mkdir()
+
+    AmfTrain.write_tile_store(str(store), images, index, labels)
+    tiles = np.load(str(store / 'tiles.npy'))
+
+    assert sorted(os.listdir(store)) == ['labels.npy', 'tiles.npy']
+    assert np.array_equal(np.load(str(store / 'labels.npy')), labels)
+
+    for (uid, r, c), x in zip(index, tiles):
+        image = AmfSegm.load(images[uid][0])
+        assert np.array_equal(x, AmfSegm.tile(image, r, c)[..., :3])
+
+
+
+def seeded_epochs(store, seed, monkeypatch, count=2):
+    """
+    Returns the augmented batches of a few training epochs.
+    """
+
+    monkeypatch.setitem(AmfConfig.PAR, 'seed', seed)
+    seq = AmfTrain.TileSequence(store, list(range(10)), augment=True,
+                                shuffle=True)
+    batches = []
+
+    for _ in range(count):
+
+        batches += [seq[i] for i in range(len(seq))]
+        seq.on_epoch_end()
+
+    return batches
+
+
+
+@pytest.fixture
+def random_store(store):
+    """
+    Same as <store>, with random tiles, so that augmentation is visible.
+    """
+
+    tiles = np.load(os.path.join(store, 'tiles.npy'))
+    rng = np.random.default_rng(0)
+    np.save(os.path.join(store, 'tiles.npy'),
+            rng.integers(256, size=tiles.shape, dtype=np.uint8))
+
+    return store
+
+
+
+def test_same_seed_same_batches(random_store, monkeypatch):
+    """
+    Runs with the same seed receive identical (augmented) batches
+    and labels.
+    """
+
+    first = seeded_epochs(random_store, 42, monkeypatch)
+    second = seeded_epochs(random_store, 42, monkeypatch)
+
+    for (x1, y1), (x2, y2) in zip(first, second):
+        assert np.array_equal(x1, x2) and np.array_equal(y1, y2)
+
+    # Batches are augmented.
+    tiles = np.load(os.path.join(random_store, 'tiles.npy'))
+    assert not np.array_equal(first[0][0], AmfSegm.preprocess(tiles[:4]))
+
+
+
+def test_other_seed_other_batches(random_store, monkeypatch):
+    """
+    Runs with another seed receive other batches.
+    """
+
+    first = seeded_epochs(random_store, 42, monkeypatch)
+    second = seeded_epochs(random_store, 7, monkeypatch)
+
+    assert not all(np.array_equal(x1, x2) for (x1, _), (x2, _)
+                   in zip(first, second))
+
+    # Dataset splits too.
+    split = AmfRandom.state(AmfRandom.SPLIT)
+    monkeypatch.setitem(AmfConfig.PAR, 'seed', 42)
+    assert AmfRandom.state(AmfRandom.SPLIT) != split